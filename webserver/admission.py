@@ -0,0 +1,105 @@
+"""
+Admission control for the server process.
+
+Caps how many requests the process works on at once and turns the rest away
+with a fast 503, instead of letting threads pile up waiting for a database
+connection until everything times out together.
+
+A request is admitted straight away while fewer than max_in_flight are running.
+Otherwise it queues for at most queue_timeout seconds; when a running request
+finishes, the queued request with the highest priority (then the one that has
+waited longest) goes next. Lower priorities may only fill part of the queue, so
+under overload anonymous browsing is turned away first and writes last:
+
+	WRITE      placing orders and reviews, admin changes, logging in   the whole queue
+	USER       pages for logged-in users                               3/4 of it
+	ANONYMOUS  browsing without logging in                             1/2 of it
+
+While the average wait for a pooled connection is above max_checkout_wait, the
+database is the bottleneck and queueing more reads would only add to it, so
+only writes may queue.
+"""
+import time
+import threading
+import itertools
+
+
+WRITE, USER, ANONYMOUS = 0, 1, 2
+PRIORITY_NAMES = {WRITE: 'write', USER: 'user', ANONYMOUS: 'anonymous'}
+
+# Share of the queue each priority may fill
+QUEUE_SHARE = {WRITE: 1.0, USER: 0.75, ANONYMOUS: 0.5}
+
+
+class Overloaded(Exception):
+	"""Raised by admit() for a request that should be turned away"""
+
+
+class AdmissionController:
+	def __init__(self, max_in_flight, max_queued, queue_timeout, max_checkout_wait, smoothing=0.2):
+		self.max_in_flight = max_in_flight
+		self.max_queued = max_queued
+		self.queue_timeout = queue_timeout
+		self.max_checkout_wait = max_checkout_wait
+		self.smoothing = smoothing
+		self.in_flight = 0
+		self.checkout_wait = 0.0  # moving average of pool checkout waits, in seconds
+		self.shed = {name: 0 for name in PRIORITY_NAMES.values()}
+		self._waiting = []  # (priority, arrival number) of each queued request
+		self._arrivals = itertools.count()
+		self._cond = threading.Condition()
+
+	def observe_checkout(self, seconds):
+		"""Records how long a request waited for a connection from the pool"""
+		with self._cond:
+			self.checkout_wait += self.smoothing * (seconds - self.checkout_wait)
+
+	def admit(self, priority):
+		"""
+		Returns once a request of the given priority may run, or raises Overloaded
+		if it should be turned away. Every admitted request must call release().
+		"""
+		with self._cond:
+			if self.in_flight < self.max_in_flight and not self._waiting:
+				self.in_flight += 1
+				return
+			if not self._may_queue(priority):
+				self._shed(priority)
+
+			ticket = (priority, next(self._arrivals))
+			self._waiting.append(ticket)
+			deadline = time.monotonic() + self.queue_timeout
+			try:
+				while self.in_flight >= self.max_in_flight or min(self._waiting) != ticket:
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						self._shed(priority)
+					self._cond.wait(remaining)
+			finally:
+				self._waiting.remove(ticket)
+				# Whether admitted or given up, someone else may now be first in line
+				self._cond.notify_all()
+			self.in_flight += 1
+
+	def release(self):
+		with self._cond:
+			self.in_flight -= 1
+			self._cond.notify_all()
+
+	def _may_queue(self, priority):
+		if priority != WRITE and self.checkout_wait > self.max_checkout_wait:
+			return False
+		return len(self._waiting) < self.max_queued * QUEUE_SHARE[priority]
+
+	def _shed(self, priority):
+		self.shed[PRIORITY_NAMES[priority]] += 1
+		raise Overloaded()
+
+	def stats(self):
+		with self._cond:
+			return {
+				'in_flight': self.in_flight,
+				'queued': len(self._waiting),
+				'checkout_wait': self.checkout_wait,
+				'shed': dict(self.shed)
+			}
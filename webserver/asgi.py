@@ -0,0 +1,171 @@
+"""
+Async serving mode for the read-only pages.
+
+Serves /restaurants, /restaurants/<id>, /dishes, /orders and /reviews from an
+asyncio event loop (Quart) with an async SQLAlchemy engine on asyncpg, so a
+worker can keep many requests waiting on Postgres without a thread for each.
+The pages are built by the same load_* functions server.py uses, run on the
+async connection with run_sync, so both modes always render the same data.
+
+Everything else (login, forms, admin actions) stays on the threaded Flask app,
+so put both behind a proxy that sends the paths above here. Sessions are
+signed with the same secret key, so a login on the Flask app works here too.
+Reads go to DATABASE_REPLICA_URIS the same way they do on the Flask app.
+
+To run it (needs quart, hypercorn and asyncpg):
+
+	hypercorn asgi:app --bind 0.0.0.0:8112
+
+benchmarks/serving_modes.py compares it with the threaded server under load.
+"""
+import random
+import asyncio
+
+from sqlalchemy.ext.asyncio import create_async_engine
+from quart import Quart, request, render_template, redirect, session
+
+import server
+from fragments import FragmentCacheExtension
+from server import (directory_args, load_restaurant_directory, load_restaurant_details, load_dishes,
+                    load_user_orders, load_user_reviews)
+
+app = Quart(__name__, template_folder=server.tmpl_dir)
+app.secret_key = server.app.secret_key
+# Same compiled-template cache as the threaded server. This process never handles a
+# write, so its caches only hear about writes through the invalidation listener
+# (see invalidation.py); with that turned off, {% cache %} fragments aren't cached.
+app.jinja_options = dict(app.jinja_options,
+	bytecode_cache=server.app.jinja_options['bytecode_cache'],
+	extensions=[FragmentCacheExtension])
+if server.CACHE_INVALIDATION:
+	app.jinja_env.fragment_cache = server.fragment_cache
+
+@app.before_serving
+async def start_invalidation_listener():
+	if server.CACHE_INVALIDATION:
+		server.invalidation_bus.start()
+
+async def build_search_index():
+	"""
+	Builds the search index on a worker thread: it loads the names with a blocking
+	psycopg2 query, which must never run on the event loop. Only the first build
+	waits; after that a stale index is rebuilt in the background (see search.py).
+	"""
+	await asyncio.get_running_loop().run_in_executor(None, server.restaurant_search.ensure_built)
+
+@app.before_serving
+async def require_schema():
+	await asyncio.get_running_loop().run_in_executor(None, server.require_schema)
+
+@app.before_serving
+async def start_search_index():
+	try:
+		await build_search_index()
+	except Exception as e:
+		print(f"Could not build search index yet: {e}")
+
+def make_async_engine(uri, read_only=False):
+	"""
+	An asyncpg engine with the same pool settings as the threaded server. asyncpg
+	sets search_path (and read-only mode for replicas) when it opens each
+	connection, so no connect hook is needed here.
+	"""
+	server_settings = {'search_path': f"{server.DATABASE_SCHEMA}, public"}
+	if read_only:
+		server_settings['default_transaction_read_only'] = 'on'
+	return create_async_engine(
+		uri.replace('postgresql://', 'postgresql+asyncpg://', 1),
+		pool_size=server.DB_POOL_SIZE,
+		max_overflow=server.DB_MAX_OVERFLOW,
+		pool_timeout=server.DB_POOL_TIMEOUT,
+		pool_recycle=server.DB_POOL_RECYCLE,
+		pool_pre_ping=server.DB_POOL_PRE_PING,
+		connect_args={'server_settings': server_settings}
+	)
+
+engine = make_async_engine(server.DATABASEURI)
+replica_engines = [make_async_engine(uri, read_only=True) for uri in server.DATABASE_REPLICA_URIS]
+
+
+def read_engine():
+	"""A replica, unless there are none or the session wrote recently (see server.recent_write)"""
+	if not replica_engines or server.recent_write(session):
+		return engine
+	return random.choice(replica_engines)
+
+
+def login_redirect():
+	return redirect(f'/login?next={request.url}')
+
+
+@app.route('/restaurants')
+async def restaurants():
+	args = directory_args(request.args)
+	if args['search'] and not server.restaurant_search.ready:
+		await build_search_index()
+	async with read_engine().connect() as conn:
+		context = await conn.run_sync(load_restaurant_directory, args)
+	return await render_template("restaurants.html", **context)
+
+
+@app.route('/restaurants/<int:restaurant_id>')
+async def restaurant_details(restaurant_id):
+	# The detail page is already a single query (see RESTAURANT_DETAILS_QUERY),
+	# so there are no separate sub-queries left to run concurrently
+	try:
+		async with read_engine().connect() as conn:
+			context = await conn.run_sync(load_restaurant_details, restaurant_id)
+	except Exception as e:
+		print(f"Error querying restaurant details: {e}")
+		import traceback
+		traceback.print_exc()
+		return f"Error: {e}", 500
+
+	if not context:
+		return "Restaurant not found", 404
+	return await render_template("restaurant_details.html", **context)
+
+
+@app.route('/dishes')
+async def dishes():
+	async with read_engine().connect() as conn:
+		context = await conn.run_sync(load_dishes)
+	return await render_template("dishes.html", **context)
+
+
+@app.route('/orders')
+async def orders():
+	if 'user_id' not in session:
+		return login_redirect()
+	async with read_engine().connect() as conn:
+		context = await conn.run_sync(load_user_orders, session.get('user_id'), request.args)
+	return await render_template("orders.html", **context)
+
+
+@app.route('/reviews')
+async def reviews():
+	if 'user_id' not in session:
+		return login_redirect()
+	async with read_engine().connect() as conn:
+		context = await conn.run_sync(load_user_reviews, session.get('user_id'))
+	return await render_template("reviews.html", **context)
+
+
+if __name__ == "__main__":
+	import click
+
+	@click.command()
+	@click.argument('HOST', default='0.0.0.0')
+	@click.argument('PORT', default=8112, type=int)
+	def run(host, port):
+		"""
+		Run the async pages with Quart's development server:
+
+			python asgi.py
+
+		For production use hypercorn (see the top of this file).
+		"""
+		print("running async pages on %s:%d" % (host, port))
+		app.run(host=host, port=port)
+
+	run()
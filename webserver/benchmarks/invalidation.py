@@ -0,0 +1,131 @@
+"""
+Checks that a write handled by one server process reaches the caches of the
+others (see invalidation.py), and how long it takes.
+
+Starts --workers copies of server.py on consecutive ports against DATABASEURI
+(a local database seeded by benchmarks/seed.py), loads a restaurant's page on
+each of them so its dish table and reviews are cached, then adds a dish and a
+review through the first worker and polls the others until they show them:
+
+	DATABASEURI=postgresql://localhost/restaurant_bench python benchmarks/invalidation.py --workers 4
+
+Run it from the webserver directory. Each run leaves one dish and one review on
+the restaurant. Exits with status 1 if any worker still shows the old page after
+--timeout seconds.
+"""
+import os
+import sys
+import time
+import uuid
+import subprocess
+import urllib.error
+import urllib.parse
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from loadgen import make_opener, login
+
+
+WEBSERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def fetch(opener, url):
+	try:
+		with opener.open(url, timeout=10) as response:
+			return response.status, response.read().decode('utf-8')
+	except urllib.error.HTTPError as e:
+		return e.code, ''
+
+
+def post(opener, url, form):
+	try:
+		opener.open(url, data=urllib.parse.urlencode(form).encode(), timeout=10).read()
+	except urllib.error.HTTPError as e:
+		# Redirects show up as errors because they aren't followed
+		if e.code not in (301, 302, 303):
+			raise click.ClickException("POST %s failed with status %d" % (url, e.code))
+
+
+def wait_until_up(opener, url, timeout):
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		try:
+			if fetch(opener, url)[0] == 200:
+				return
+		except OSError:
+			pass
+		time.sleep(0.2)
+	raise click.ClickException("%s did not come up" % url)
+
+
+def wait_for_text(opener, urls, text, timeout):
+	"""Polls each URL until its page contains text. Returns {url: seconds taken or None}"""
+	started = time.monotonic()
+	seen = {}
+	while len(seen) < len(urls) and time.monotonic() - started < timeout:
+		for url in urls:
+			if url not in seen and text in fetch(opener, url)[1]:
+				seen[url] = time.monotonic() - started
+		time.sleep(0.005)
+	return {url: seen.get(url) for url in urls}
+
+
+@click.command()
+@click.option('--workers', default=3, type=int, help='Server processes to start')
+@click.option('--base-port', default=8121, type=int, help='Port of the first worker')
+@click.option('--restaurant-id', default=1, type=int, help='Restaurant to add the dish and review to')
+@click.option('--admin', default='admin1', help='Seeded admin to log in as')
+@click.option('--timeout', default=5.0, type=float, help='Seconds the other workers have to catch up')
+def run(workers, base_port, restaurant_id, admin, timeout):
+	if workers < 2:
+		raise click.UsageError("--workers must be at least 2")
+	base_urls = ['http://127.0.0.1:%d' % (base_port + i) for i in range(workers)]
+	processes = [subprocess.Popen([sys.executable, 'server.py', '--threaded', '127.0.0.1', str(base_port + i)],
+	                              cwd=WEBSERVER_DIR, stdout=subprocess.DEVNULL)
+	             for i in range(workers)]
+	failed = False
+	try:
+		page = '/restaurants/%d' % restaurant_id
+		# The session cookie is signed with the app's secret key, so one login works on every worker
+		opener = make_opener()
+		for base_url in base_urls:
+			wait_until_up(opener, base_url + page, timeout=30)
+		login(opener, base_urls[0], admin, 'pw' + admin)
+
+		# Each worker starts its listener on its first request and drops its caches
+		# once connected, so load the pages again after that to have them cached
+		for _ in range(2):
+			for base_url in base_urls:
+				fetch(opener, base_url + page)
+			time.sleep(1)
+
+		others = [base_url + page for base_url in base_urls[1:]]
+		marker = uuid.uuid4().hex[:12]
+		checks = [
+			('dish', '/restaurants/%d/add-dish' % restaurant_id, 'Dish check ' + marker,
+			 {'name': 'Dish check ' + marker, 'ingredients': 'salt', 'price': '9.99'}),
+			('review', '/restaurants/%d/add-review' % restaurant_id, 'Review check ' + marker,
+			 {'rating': 5, 'comment': 'Review check ' + marker}),
+		]
+		for name, path, expected, form in checks:
+			post(opener, base_urls[0] + path, form)
+			if expected not in fetch(opener, base_urls[0] + page)[1]:
+				raise click.ClickException("the worker that added the %s doesn't show it" % name)
+			for url, seconds in wait_for_text(opener, others, expected, timeout).items():
+				if seconds is None:
+					failed = True
+					print("%-8s %s still stale after %.1fs" % (name, url, timeout))
+				else:
+					print("%-8s %s updated after %.1f ms" % (name, url, seconds * 1000))
+	finally:
+		for process in processes:
+			process.terminate()
+		for process in processes:
+			process.wait()
+	if failed:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	run()
@@ -0,0 +1,163 @@
+"""
+A small HTTP load generator used by the benchmark scripts.
+
+Runs a number of client threads against a server for a fixed time, each one
+repeatedly picking a request from a workload, and records the latency of every
+response by route name. Only uses the standard library so it runs anywhere.
+
+A request's path and form can be callables taking the client's state dict, and
+its after callback sees the response, so a workload can chain requests (place
+an order, then edit that order) per client.
+"""
+import time
+import random
+import threading
+import statistics
+import urllib.error
+import urllib.parse
+import urllib.request
+import http.cookiejar
+
+
+class Request:
+	"""
+	One kind of request in a workload.
+	path and form are values or callables taking the client's state dict; a path
+	callable can return None to skip the request this time. after(state, status, headers)
+	is called with each response. role limits the request to clients logged in with that role.
+	"""
+	def __init__(self, route, path, method='GET', form=None, weight=1, after=None, role=None):
+		self.route = route
+		self.path = path
+		self.method = method
+		self.form = form
+		self.weight = weight
+		self.after = after
+		self.role = role
+
+
+def make_opener():
+	"""A urllib opener that keeps cookies (so a login sticks) and doesn't follow redirects"""
+	class NoRedirect(urllib.request.HTTPRedirectHandler):
+		def redirect_request(self, *args, **kwargs):
+			return None
+	return urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect)
+
+
+def login(opener, base_url, username, password):
+	data = urllib.parse.urlencode({'username': username, 'password': password}).encode()
+	try:
+		opener.open(base_url + '/login', data=data, timeout=30).read()
+	except urllib.error.HTTPError as e:
+		# The login redirect shows up as an error because redirects aren't followed
+		if e.code not in (301, 302, 303):
+			raise
+
+
+def send(opener, base_url, req, state):
+	"""Sends one request and returns its HTTP status, or None if the request was skipped"""
+	path = req.path(state) if callable(req.path) else req.path
+	if path is None:
+		return None
+	form = req.form(state) if callable(req.form) else req.form
+	data = None
+	if req.method == 'POST':
+		data = urllib.parse.urlencode(form or {}, doseq=True).encode()
+	try:
+		response = opener.open(base_url + path, data=data, timeout=60)
+		response.read()
+		status, headers = response.status, response.headers
+	except urllib.error.HTTPError as e:
+		e.read()
+		status, headers = e.code, e.headers
+	if req.after:
+		req.after(state, status, headers)
+	return status
+
+
+def run_load(base_url, workload, concurrency=10, duration=30, credentials=None, warmup=2):
+	"""
+	Runs workload (a list of Request) against base_url from concurrency threads
+	for duration seconds. If credentials is a list of (username, password) or
+	(username, password, role), each thread logs in as one of them first and
+	only sends requests for its role.
+	Returns {route: {'latencies': [ms, ...], 'errors': n}} and the elapsed seconds.
+	"""
+	results = {}
+	lock = threading.Lock()
+	start_at = time.monotonic() + warmup
+	stop_at = start_at + duration
+
+	def client(index):
+		opener = make_opener()
+		role = None
+		if credentials:
+			username, password, *rest = credentials[index % len(credentials)]
+			role = rest[0] if rest else None
+			login(opener, base_url, username, password)
+		requests = [req for req in workload if req.role is None or req.role == role]
+		weights = [req.weight for req in requests]
+		state = {'rng': random.Random(index)}
+		local = {}
+		while True:
+			now = time.monotonic()
+			if now >= stop_at:
+				break
+			req = state['rng'].choices(requests, weights)[0]
+			began = time.perf_counter()
+			try:
+				status = send(opener, base_url, req, state)
+				if status is None:
+					continue
+			except Exception:
+				status = 0
+			elapsed = (time.perf_counter() - began) * 1000
+			if now < start_at:
+				continue
+			entry = local.setdefault(req.route, {'latencies': [], 'errors': 0})
+			if status == 0 or status >= 400:
+				entry['errors'] += 1
+			else:
+				entry['latencies'].append(elapsed)
+		with lock:
+			for route, entry in local.items():
+				total = results.setdefault(route, {'latencies': [], 'errors': 0})
+				total['latencies'].extend(entry['latencies'])
+				total['errors'] += entry['errors']
+
+	threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(concurrency)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return results, duration
+
+
+def percentile(sorted_values, fraction):
+	if not sorted_values:
+		return 0.0
+	return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def report(results, elapsed, title=None):
+	"""Prints throughput and p50/p95/p99 latency per route, plus a total line"""
+	if title:
+		print(title)
+	print("%-28s %8s %8s %9s %9s %9s %7s" % ('route', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+	all_latencies = []
+	all_errors = 0
+	for route in sorted(results):
+		latencies = sorted(results[route]['latencies'])
+		errors = results[route]['errors']
+		all_latencies.extend(latencies)
+		all_errors += errors
+		print("%-28s %8d %8.1f %9.1f %9.1f %9.1f %7d" % (
+			route, len(latencies), len(latencies) / elapsed,
+			statistics.median(latencies) if latencies else 0.0,
+			percentile(latencies, 0.95), percentile(latencies, 0.99), errors))
+	all_latencies.sort()
+	print("%-28s %8d %8.1f %9.1f %9.1f %9.1f %7d" % (
+		'TOTAL', len(all_latencies), len(all_latencies) / elapsed,
+		statistics.median(all_latencies) if all_latencies else 0.0,
+		percentile(all_latencies, 0.95), percentile(all_latencies, 0.99), all_errors))
+	print()
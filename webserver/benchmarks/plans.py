@@ -0,0 +1,245 @@
+"""
+Runs EXPLAIN (ANALYZE, BUFFERS) on every query the app sends and flags
+sequential scans and sorts over more than --min-rows rows.
+
+Seed a database with benchmarks/seed.py (which applies migrations.py), then run
+this from the webserver directory with the same scale options used for seeding:
+
+	DATABASEURI=postgresql://localhost/restaurant_bench python benchmarks/plans.py \
+		--restaurants 10000 --dishes-per-restaurant 20
+
+The GET routes from benchmarks/routes.py are requested once each through the
+Flask test client, logged in as a seeded customer (and an admin for the admin
+pages), and every statement they run is recorded with its parameters. The write
+statements (creating and editing orders, the restaurantstats and dataversion updates) are run
+directly. Each statement is then explained once, inside a transaction that is
+rolled back, so writes leave no trace.
+
+Before a deploy, save the flags of a known-good run and compare against them:
+
+	python benchmarks/plans.py --save-baseline plans.json
+	python benchmarks/plans.py --baseline plans.json
+
+With a baseline, only flags it doesn't already have count; without one, every flag
+does. The command exits with status 1 if any flags count (except when saving a baseline).
+"""
+import os
+import re
+import sys
+import json
+import random
+import hashlib
+
+import click
+from sqlalchemy import event, text
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from routes import build_workload
+
+import server
+import stats
+import versions
+
+
+SORT_NODES = ('Sort', 'Incremental Sort')
+
+# Statements the app runs that aren't queries worth explaining
+SKIPPED_PREFIXES = ('EXPLAIN', 'SET', 'SHOW', 'COPY', 'BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE')
+
+
+class StatementLog:
+	"""Records each distinct statement sent to the app's engines, with the first parameters seen"""
+
+	def __init__(self):
+		self.label = None
+		self.statements = {}  # statement -> (parameters, [labels])
+
+	def attach(self, engines):
+		for db_engine in engines:
+			event.listen(db_engine, 'before_cursor_execute', self.record)
+
+	def record(self, conn, cursor, statement, parameters, context, executemany):
+		if executemany or statement.lstrip().upper().startswith(SKIPPED_PREFIXES):
+			return
+		params, labels = self.statements.setdefault(statement, (parameters, []))
+		if self.label not in labels:
+			labels.append(self.label)
+
+
+def statement_key(statement):
+	return hashlib.sha1(' '.join(statement.split()).encode('utf-8')).hexdigest()[:12]
+
+
+def login(client, username, password):
+	response = client.post('/login', data={'username': username, 'password': password})
+	if response.status_code not in (301, 302, 303):
+		raise click.ClickException("could not log in as %s" % username)
+
+
+def drive_routes(log, restaurants, dishes_per_restaurant, customer, admin):
+	"""Requests each GET route once as the customer (or the admin, for admin pages)"""
+	clients = {}
+	for role, (username, password) in ((None, customer), ('Admin', admin)):
+		clients[role] = server.app.test_client()
+		login(clients[role], username, password)
+
+	state = {'rng': random.Random(0)}
+	with server.engine.connect() as conn:
+		user_id = conn.execute(text("SELECT userid FROM users WHERE username = :username;"),
+		                       {'username': customer[0]}).scalar()
+		state['orders'] = [tuple(row) for row in conn.execute(
+			text("SELECT orderid, restaurantid FROM orders WHERE userid = :user_id ORDER BY orderid LIMIT 1;"),
+			{'user_id': user_id})]
+
+	requests = [req for req in build_workload(restaurants, dishes_per_restaurant) if req.method == 'GET']
+	for req in requests:
+		path = req.path(state) if callable(req.path) else req.path
+		if path is None:
+			continue
+		log.label = req.route
+		response = clients[req.role].get(path)
+		body = response.get_data(as_text=True)
+		if path == '/orders':
+			# Also the second page, which seeks past the first
+			match = re.search(r'href="(/orders\?after=[^"]+)"', body)
+			if match:
+				log.label = 'GET /orders?after'
+				clients[req.role].get(match.group(1).replace('&amp;', '&')).get_data()
+	return user_id, state['orders']
+
+
+def run_writes(log, user_id, orders, dishes_per_restaurant):
+	"""Runs the write statements in a transaction that is rolled back"""
+	restaurant_id = 1
+	lines = {dish_id: 1 for dish_id in range(1, min(dishes_per_restaurant, 3) + 1)}
+	writes = [
+		('POST /restaurants/<id>/add-order', server.CREATE_ORDER_QUERY,
+		 dict(server.order_line_params(lines), user_id=user_id, restaurant_id=restaurant_id)),
+		('stats record_review', stats.RECORD_REVIEW_QUERY,
+		 {'restaurant_id': restaurant_id, 'review_delta': 1, 'rating_count_delta': 1, 'rating_delta': 4}),
+		('stats record_order', stats.RECORD_ORDER_QUERY,
+		 {'restaurant_id': restaurant_id, 'order_delta': 1, 'revenue_delta': 10}),
+		('publish_changes data versions', versions.BUMP_VERSIONS_QUERY,
+		 {'names': versions.version_names('orders', restaurant_id)}),
+	]
+	if orders:
+		order_id, order_restaurant = orders[0]
+		first_dish = (order_restaurant - 1) * dishes_per_restaurant + 1
+		edit = {'order_id': order_id, 'dish_ids': [first_dish], 'quantities': [2]}
+		writes += [
+			('POST /orders/<id>/edit', server.ADD_ORDER_ITEMS_QUERY, edit),
+			('POST /orders/<id>/edit', server.UPDATE_ORDER_ITEMS_QUERY, edit),
+			('POST /orders/<id>/edit', server.DELETE_ORDER_ITEMS_QUERY, {'order_id': order_id, 'dish_ids': [first_dish]}),
+		]
+	with server.engine.connect() as conn:
+		transaction = conn.begin()
+		try:
+			for label, statement, params in writes:
+				log.label = label
+				conn.execute(text(statement), params)
+		finally:
+			transaction.rollback()
+
+
+def explain(dbapi_conn, statement, parameters):
+	"""Returns the EXPLAIN (ANALYZE, BUFFERS) plan of a statement, run and then rolled back"""
+	cursor = dbapi_conn.cursor()
+	try:
+		cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement, parameters)
+		return cursor.fetchone()[0][0]
+	finally:
+		cursor.close()
+		dbapi_conn.rollback()
+
+
+def walk(node):
+	yield node
+	for child in node.get('Plans', []):
+		yield from walk(child)
+
+
+def node_rows(node):
+	"""Rows a node read (for a scan, including those its filter removed), over all its loops"""
+	rows = node.get('Actual Rows', 0) + node.get('Rows Removed by Filter', 0)
+	return rows * node.get('Actual Loops', 1)
+
+
+def find_flags(plan, min_rows):
+	"""
+	Returns {flag: rows} for the plan's sequential scans and sorts over min_rows rows.
+	A sort's size is the rows fed into it, so a top-N sort under a LIMIT still counts.
+	"""
+	flags = {}
+	for node in walk(plan['Plan']):
+		if node['Node Type'] == 'Seq Scan':
+			flag, rows = 'Seq Scan on %s' % node.get('Relation Name'), node_rows(node)
+		elif node['Node Type'] in SORT_NODES:
+			children = node.get('Plans') or [node]
+			flag, rows = '%s by %s' % (node['Node Type'], ', '.join(node.get('Sort Key', []))), node_rows(children[0])
+		else:
+			continue
+		if rows >= min_rows:
+			flags[flag] = max(rows, flags.get(flag, 0))
+	return flags
+
+
+@click.command()
+@click.option('--restaurants', default=10000, type=int, help='Same as used for seed.py')
+@click.option('--dishes-per-restaurant', default=20, type=int, help='Same as used for seed.py')
+@click.option('--customer', default='user1', help='Seeded customer to log in as')
+@click.option('--admin', default='admin1', help='Seeded admin to log in as')
+@click.option('--min-rows', default=1000, type=int, help='Ignore scans and sorts of fewer rows than this')
+@click.option('--baseline', type=click.Path(exists=True), help='Only report flags this earlier run did not have')
+@click.option('--save-baseline', type=click.Path(), help='Save this run\'s flags for later --baseline runs')
+@click.option('--verbose', is_flag=True, help='Also print queries with nothing flagged')
+def run(restaurants, dishes_per_restaurant, customer, admin, min_rows, baseline, save_baseline, verbose):
+	log = StatementLog()
+	log.attach(server.ENGINE_NAMES)
+	user_id, orders = drive_routes(log, restaurants, dishes_per_restaurant,
+	                               (customer, 'pw' + customer), (admin, 'pw' + admin))
+	run_writes(log, user_id, orders, dishes_per_restaurant)
+
+	known = {}
+	if baseline:
+		with open(baseline) as f:
+			known = json.load(f)
+
+	results = {}
+	new_flag_count = 0
+	dbapi_conn = server.engine.raw_connection()
+	try:
+		for statement, (parameters, labels) in log.statements.items():
+			key = statement_key(statement)
+			plan = explain(dbapi_conn, statement, parameters)
+			flags = find_flags(plan, min_rows)
+			results[key] = sorted(flags)
+			new_flags = [flag for flag in sorted(flags) if flag not in known.get(key, [])]
+			new_flag_count += len(new_flags)
+			if not (flags or verbose):
+				continue
+
+			root = plan['Plan']
+			print("%s  %s" % (key, ', '.join(labels)))
+			print("  %.2f ms, %d shared buffers hit, %d read" % (
+				plan.get('Execution Time', 0.0), root.get('Shared Hit Blocks', 0), root.get('Shared Read Blocks', 0)))
+			for flag in sorted(flags):
+				print("  %s %s (%d rows)" % ('NEW' if flag in new_flags else '   ', flag, flags[flag]))
+			print("  " + ' '.join(statement.split())[:300])
+			print()
+	finally:
+		dbapi_conn.close()
+
+	print("%d statements explained, %d flags%s" % (
+		len(results), sum(map(len, results.values())),
+		", %d not in the baseline" % new_flag_count if baseline else ""))
+
+	if save_baseline:
+		with open(save_baseline, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+	elif new_flag_count:
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	run()
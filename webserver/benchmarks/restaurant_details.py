@@ -0,0 +1,83 @@
+"""
+Compares the restaurant details loader in server.py (one round trip, JSON
+aggregation) with the five sequential queries the page used to run.
+
+Run from the webserver directory against the database configured in server.py:
+
+	python benchmarks/restaurant_details.py --runs 200 1 2 3
+
+Prints the mean, p50 and p95 time per page load for each path.
+"""
+import os
+import sys
+import time
+import statistics
+
+import click
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from server import engine, load_restaurant_details
+
+
+# The queries restaurant_details ran before it was consolidated, one round trip each
+FIVE_QUERY_PATH = [
+	"SELECT restaurantid, name, location FROM restaurant WHERE restaurantid = :id;",
+	"SELECT dishid, name, ingredients, COALESCE(price, 0.0) as price FROM dish WHERE restaurantid = :id ORDER BY name;",
+	"""
+	SELECT r.reviewid, r.userid, r.rating, r.comment, u.name as user_name
+	FROM review r
+	LEFT JOIN users u ON r.userid = u.userid
+	WHERE r.restaurantid = :id
+	ORDER BY r.reviewid DESC;
+	""",
+	"""
+	SELECT c.cuisineid, c.cuisinename as cuisine_name
+	FROM cuisine c
+	JOIN restaurantcuisine rc ON c.cuisineid = rc.cuisineid
+	WHERE rc.restaurantid = :id
+	ORDER BY c.cuisinename;
+	""",
+	"SELECT orderid, userid, date, totalprice FROM orders WHERE restaurantid = :id ORDER BY date DESC;",
+]
+
+
+def load_five_queries(conn, restaurant_id):
+	for query in FIVE_QUERY_PATH:
+		cursor = conn.execute(text(query), {'id': restaurant_id})
+		cursor.fetchall()
+		cursor.close()
+
+
+def time_loader(conn, loader, restaurant_ids, runs):
+	"""Returns a list of per-call timings in milliseconds"""
+	timings = []
+	for i in range(runs):
+		restaurant_id = restaurant_ids[i % len(restaurant_ids)]
+		start = time.perf_counter()
+		loader(conn, restaurant_id)
+		timings.append((time.perf_counter() - start) * 1000)
+	return timings
+
+
+def summarize(name, timings):
+	timings = sorted(timings)
+	p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+	print("%-14s mean %8.2f ms   p50 %8.2f ms   p95 %8.2f ms" % (
+		name, statistics.mean(timings), statistics.median(timings), p95))
+
+
+@click.command()
+@click.option('--runs', default=100, type=int, help='Page loads to time for each path')
+@click.option('--warmup', default=10, type=int, help='Untimed page loads before measuring')
+@click.argument('RESTAURANT_IDS', nargs=-1, type=int, required=True)
+def run(runs, warmup, restaurant_ids):
+	with engine.connect() as conn:
+		for loader in (load_five_queries, load_restaurant_details):
+			time_loader(conn, loader, restaurant_ids, warmup)
+		summarize("five queries", time_loader(conn, load_five_queries, restaurant_ids, runs))
+		summarize("single query", time_loader(conn, load_restaurant_details, restaurant_ids, runs))
+
+
+if __name__ == "__main__":
+	run()
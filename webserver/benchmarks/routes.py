@@ -0,0 +1,147 @@
+"""
+Runs a read/write workload against every route in server.py and reports
+throughput and p50/p95/p99 latency per route.
+
+Seed a local database with benchmarks/seed.py, start the app against it, then run
+this from the webserver directory with the same scale options used for seeding:
+
+	DATABASEURI=postgresql://localhost/restaurant_bench python server.py --threaded
+	python benchmarks/routes.py --restaurants 10000 --dishes-per-restaurant 20 --customers 50000
+
+Most clients log in as seeded customers and browse, place orders, edit their own
+orders and write reviews. A few log in as admins and also add restaurants and
+dishes and edit dishes. The delete routes and /logout are left out: they would
+drain the seeded data or end the client's session.
+"""
+import os
+import re
+import sys
+import uuid
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from loadgen import Request, run_load, report
+
+
+SEARCH_TERMS = ['pizza', 'sushi', 'burger', 'garden', 'dragon', 'noodle', 'piza', 'cafe']
+CUISINES = ['Italian', 'Chinese', 'Mexican', 'Japanese', 'Thai', 'Indian']
+PRICE_RANGES = ['$', '$$', '$$$', '$$$$']
+
+
+def build_workload(restaurants, dishes_per_restaurant):
+	def random_restaurant(state):
+		return state['rng'].randint(1, restaurants)
+
+	def random_dish(state):
+		return state['rng'].randint(1, restaurants * dishes_per_restaurant)
+
+	def cart_form(state, restaurant_id):
+		"""A cart of 1-4 dishes from the restaurant's menu"""
+		rng = state['rng']
+		first = (restaurant_id - 1) * dishes_per_restaurant + 1
+		dish_ids = rng.sample(range(first, first + dishes_per_restaurant), min(dishes_per_restaurant, rng.randint(1, 4)))
+		return {'dish_id[]': dish_ids, 'quantity[]': [rng.randint(1, 3) for _ in dish_ids]}
+
+	def order_path(state):
+		"""
+		Picks an order this client placed, for the order detail and edit pages.
+		Seeded orders belong to random customers, so clients only use their own.
+		"""
+		if not state.get('orders'):
+			return None
+		state['order'] = state['rng'].choice(state['orders'])
+		return '/orders/%d' % state['order'][0]
+
+	def new_order_path(state):
+		state['order_restaurant'] = random_restaurant(state)
+		return '/restaurants/%d/add-order' % state['order_restaurant']
+
+	def remember_order(state, status, headers):
+		match = re.search(r'/orders/(\d+)', headers.get('Location') or '')
+		if match:
+			state.setdefault('orders', []).append((int(match.group(1)), state['order_restaurant']))
+			del state['orders'][:-50]
+
+	def edit_path(state):
+		path = order_path(state)
+		return path + '/edit' if path else None
+
+	def edit_form(state):
+		return cart_form(state, state['order'][1])
+
+	def directory_path(state):
+		rng = state['rng']
+		args = []
+		if rng.random() < 0.3:
+			args.append('cuisine=' + rng.choice(CUISINES))
+		if rng.random() < 0.3:
+			args.append('price_range=' + rng.choice(PRICE_RANGES).replace('$', '%24'))
+		return '/restaurants' + ('?' + '&'.join(args) if args else '')
+
+	return [
+		# Anyone
+		Request('GET /', '/', weight=2),
+		Request('GET /restaurants', directory_path, weight=30),
+		Request('GET /restaurants?search', lambda s: '/restaurants?search=' + s['rng'].choice(SEARCH_TERMS), weight=10),
+		Request('GET /restaurants/<id>', lambda s: '/restaurants/%d' % random_restaurant(s), weight=25),
+		Request('GET /dishes', '/dishes', weight=1),
+		Request('GET /cuisines', '/cuisines', weight=2),
+		Request('GET /users', '/users', weight=1),
+		Request('GET /login', '/login', weight=1),
+		Request('GET /register', '/register', weight=1),
+		Request('POST /register', '/register', method='POST', weight=1,
+		        form=lambda s: {'name': 'Bench User', 'username': 'bench-' + uuid.uuid4().hex[:12], 'password': 'benchpassword'}),
+		Request('GET /metrics', '/metrics', weight=1),
+		Request('GET /orders', '/orders', weight=5),
+		Request('GET /orders/export', '/orders/export?format=csv', weight=1),
+		Request('GET /orders/<id>', order_path, weight=4),
+		Request('GET /reviews', '/reviews', weight=3),
+		Request('GET /restaurants/<id>/add-order', new_order_path, weight=3),
+		Request('POST /restaurants/<id>/add-order', new_order_path, method='POST', weight=5,
+		        form=lambda s: cart_form(s, s['order_restaurant']), after=remember_order),
+		Request('GET /orders/<id>/edit', edit_path, weight=2),
+		Request('POST /orders/<id>/edit', edit_path, method='POST', form=edit_form, weight=2),
+		Request('GET /restaurants/<id>/add-review', lambda s: '/restaurants/%d/add-review' % random_restaurant(s), weight=1),
+		Request('POST /restaurants/<id>/add-review', lambda s: '/restaurants/%d/add-review' % random_restaurant(s),
+		        method='POST', weight=2, form=lambda s: {'rating': s['rng'].randint(1, 5), 'comment': 'Benchmark review'}),
+		# Admins only
+		Request('GET /restaurants/add', '/restaurants/add', role='Admin', weight=1),
+		Request('POST /restaurants/add', '/restaurants/add', method='POST', role='Admin', weight=1,
+		        form=lambda s: {'name': 'Bench Restaurant ' + uuid.uuid4().hex[:6], 'location': 'Midtown', 'price_range': '$$'}),
+		Request('GET /restaurants/<id>/add-dish', lambda s: '/restaurants/%d/add-dish' % random_restaurant(s), role='Admin', weight=1),
+		Request('POST /restaurants/<id>/add-dish', lambda s: '/restaurants/%d/add-dish' % random_restaurant(s),
+		        method='POST', role='Admin', weight=1,
+		        form=lambda s: {'name': 'Bench Dish', 'ingredients': 'salt', 'price': '%.2f' % s['rng'].uniform(4, 40)}),
+		Request('GET /restaurants/<id>/import-dishes', lambda s: '/restaurants/%d/import-dishes' % random_restaurant(s), role='Admin', weight=1),
+		Request('GET /dishes/<id>/edit', lambda s: '/dishes/%d/edit' % random_dish(s), role='Admin', weight=1),
+		Request('POST /dishes/<id>/edit', lambda s: '/dishes/%d/edit' % random_dish(s), method='POST', role='Admin', weight=1,
+		        form=lambda s: {'name': 'Edited Dish', 'ingredients': 'pepper', 'price': '%.2f' % s['rng'].uniform(4, 40)}),
+	]
+
+
+@click.command()
+@click.option('--base-url', default='http://localhost:8111', help='Base URL of the server under test')
+@click.option('--concurrency', default=20, type=int, help='Simultaneous clients')
+@click.option('--duration', default=60, type=int, help='Seconds to measure for')
+@click.option('--restaurants', default=10000, type=int, help='Same as used for seed.py')
+@click.option('--dishes-per-restaurant', default=20, type=int, help='Same as used for seed.py')
+@click.option('--customers', default=50000, type=int, help='Same as used for seed.py')
+@click.option('--admins', default=5, type=int, help='Same as used for seed.py')
+@click.option('--admin-clients', default=2, type=int, help='How many of the clients log in as admins')
+def run(base_url, concurrency, duration, restaurants, dishes_per_restaurant, customers, admins, admin_clients):
+	credentials = []
+	for i in range(concurrency):
+		if i < admin_clients:
+			n = i % admins + 1
+			credentials.append(('admin%d' % n, 'pwadmin%d' % n, 'Admin'))
+		else:
+			n = (i * 7919) % customers + 1
+			credentials.append(('user%d' % n, 'pwuser%d' % n, 'Cust'))
+	workload = build_workload(restaurants, dishes_per_restaurant)
+	results, elapsed = run_load(base_url, workload, concurrency, duration, credentials)
+	report(results, elapsed, title="%s, %d clients, %ds" % (base_url, concurrency, duration))
+
+
+if __name__ == "__main__":
+	run()
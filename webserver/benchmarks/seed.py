@@ -0,0 +1,251 @@
+"""
+Creates the app's tables in a local Postgres database and fills them with
+synthetic data at a configurable scale, for benchmarking without the class server.
+
+	createdb restaurant_bench
+	python benchmarks/seed.py --database-uri postgresql://localhost/restaurant_bench \
+		--restaurants 10000 --orders 5000000
+
+Everything is generated from --seed, so the same options always produce the same
+data. Rows are loaded with COPY in chunks, so large scales don't need much memory.
+
+Seeded logins (passwords are the username with "pw" in front):
+	customers user1 .. userN  (password pwuser1 ..)   role Cust
+	admins    admin1 .. adminN (password pwadmin1 ..) role Admin
+
+Restaurant r owns dishes (r - 1) * D + 1 .. r * D, where D is --dishes-per-restaurant,
+which benchmarks/routes.py relies on to build valid orders.
+
+The indexes in migrations.py are applied after the data is loaded; pass
+--skip-migrations to leave them out, e.g. to see what benchmarks/plans.py flags without them.
+The tables the server needs (restaurantstats, dataversion) are created either way.
+
+Point the app at the seeded database with:
+
+	DATABASEURI=postgresql://localhost/restaurant_bench python server.py
+"""
+import io
+import os
+import sys
+import csv
+import random
+import datetime
+
+import click
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from stats import rebuild_stats
+from versions import CREATE_VERSIONS_TABLE
+from migrations import migrate
+
+
+SCHEMA_DDL = """
+CREATE TABLE IF NOT EXISTS restaurant (
+	restaurantid serial PRIMARY KEY,
+	name text NOT NULL,
+	location text,
+	pricerange text
+);
+CREATE TABLE IF NOT EXISTS cuisine (
+	cuisineid serial PRIMARY KEY,
+	cuisinename text NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS restaurantcuisine (
+	restaurantid integer REFERENCES restaurant(restaurantid) ON DELETE CASCADE,
+	cuisineid integer REFERENCES cuisine(cuisineid) ON DELETE CASCADE,
+	PRIMARY KEY (restaurantid, cuisineid)
+);
+CREATE TABLE IF NOT EXISTS dish (
+	dishid serial PRIMARY KEY,
+	name text NOT NULL,
+	ingredients text,
+	restaurantid integer REFERENCES restaurant(restaurantid) ON DELETE CASCADE,
+	price numeric(8, 2)
+);
+CREATE TABLE IF NOT EXISTS users (
+	userid serial PRIMARY KEY,
+	name text NOT NULL,
+	username text NOT NULL UNIQUE,
+	password text NOT NULL,
+	role text NOT NULL
+);
+CREATE TABLE IF NOT EXISTS orders (
+	orderid serial PRIMARY KEY,
+	date timestamp DEFAULT now(),
+	totalprice numeric(10, 2),
+	userid integer REFERENCES users(userid) ON DELETE CASCADE,
+	restaurantid integer REFERENCES restaurant(restaurantid) ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS orderitem (
+	orderitemid serial PRIMARY KEY,
+	orderid integer REFERENCES orders(orderid) ON DELETE CASCADE,
+	dishid integer REFERENCES dish(dishid) ON DELETE CASCADE,
+	quantity integer NOT NULL,
+	price numeric(8, 2)
+);
+CREATE TABLE IF NOT EXISTS review (
+	reviewid serial PRIMARY KEY,
+	rating integer CHECK (rating BETWEEN 1 AND 5),
+	comment text,
+	userid integer REFERENCES users(userid) ON DELETE CASCADE,
+	restaurantid integer REFERENCES restaurant(restaurantid) ON DELETE CASCADE
+);
+"""
+
+# (table, serial column) pairs whose sequences need moving past the copied IDs
+SERIAL_COLUMNS = [
+	('restaurant', 'restaurantid'), ('cuisine', 'cuisineid'), ('dish', 'dishid'), ('users', 'userid'),
+	('orders', 'orderid'), ('orderitem', 'orderitemid'), ('review', 'reviewid'),
+]
+
+CUISINES = ['Italian', 'Chinese', 'Mexican', 'Japanese', 'Thai', 'Indian', 'French', 'Greek', 'Korean',
+            'Vietnamese', 'American', 'Spanish', 'Lebanese', 'Turkish', 'Ethiopian', 'Brazilian',
+            'Caribbean', 'German', 'Peruvian', 'Moroccan']
+NAME_WORDS = ['Golden', 'Dragon', 'Pizza', 'Palace', 'Sushi', 'Garden', 'Burger', 'Barn', 'Taco', 'Corner',
+              'Bistro', 'Kitchen', 'Grill', 'House', 'Noodle', 'Bar', 'Spice', 'Route', 'Little', 'Blue',
+              'Olive', 'Tree', 'Harbor', 'Lotus', 'Smoke', 'Pit', 'Curry', 'Leaf', 'Village', 'Cafe']
+LOCATIONS = ['Morningside Heights', 'Harlem', 'Upper West Side', 'Upper East Side', 'Midtown', 'Chelsea',
+             'Greenwich Village', 'SoHo', 'Tribeca', 'Financial District', 'Williamsburg', 'Astoria',
+             'Park Slope', 'Long Island City', 'Flushing', 'Bushwick']
+PRICE_RANGES = ['$', '$$', '$$$', '$$$$']
+DISH_WORDS = ['Spicy', 'Chicken', 'Beef', 'Tofu', 'Noodles', 'Rice', 'Salad', 'Soup', 'Dumplings', 'Curry',
+              'Tacos', 'Burger', 'Pizza', 'Roll', 'Platter', 'Wrap', 'Bowl', 'Skewers', 'Pie', 'Stew']
+INGREDIENTS = ['garlic', 'onion', 'tomato', 'basil', 'chili', 'ginger', 'cheese', 'lettuce', 'rice',
+               'soy sauce', 'cilantro', 'lime', 'mushroom', 'pepper', 'egg']
+COMMENTS = ['Great food!', 'Would come again.', 'Too salty for me.', 'Fast delivery.', 'Portions were small.',
+            'Best in the neighborhood.', 'Friendly staff.', None]
+
+
+def copy_rows(cursor, table, columns, rows, chunk_size=100000):
+	"""Streams an iterable of row tuples into table with COPY, chunk_size rows per COPY"""
+	sql = "COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (table, ', '.join(columns))
+	buf = io.StringIO()
+	writer = csv.writer(buf)
+	pending = 0
+	for row in rows:
+		writer.writerow(row)
+		pending += 1
+		if pending >= chunk_size:
+			buf.seek(0)
+			cursor.copy_expert(sql, buf)
+			buf.seek(0)
+			buf.truncate()
+			pending = 0
+	if pending:
+		buf.seek(0)
+		cursor.copy_expert(sql, buf)
+
+
+def generate_orders(rng, order_count, customer_count, restaurant_count, dishes_per_restaurant, dish_prices, items_out):
+	"""
+	Yields order rows. Each order's item rows are appended to items_out so they can
+	be copied right after the chunk of orders they belong to.
+	"""
+	now = datetime.datetime(2025, 1, 1)
+	item_id = 1
+	for order_id in range(1, order_count + 1):
+		restaurant_id = rng.randint(1, restaurant_count)
+		first_dish = (restaurant_id - 1) * dishes_per_restaurant + 1
+		dish_ids = rng.sample(range(first_dish, first_dish + dishes_per_restaurant), min(dishes_per_restaurant, rng.randint(1, 4)))
+		total = 0
+		for dish_id in dish_ids:
+			quantity = rng.randint(1, 3)
+			price = dish_prices[dish_id - 1]
+			total += price * quantity
+			items_out.append((item_id, order_id, dish_id, quantity, '%.2f' % price))
+			item_id += 1
+		date = now - datetime.timedelta(minutes=rng.randint(0, 2 * 365 * 24 * 60))
+		yield (order_id, date.isoformat(sep=' '), '%.2f' % total, rng.randint(1, customer_count), restaurant_id)
+
+
+@click.command()
+@click.option('--database-uri', default='postgresql://localhost/restaurant_bench', help='Database to seed')
+@click.option('--schema', default='jcw2239', help='Schema to create the tables in (the app uses jcw2239)')
+@click.option('--reset', is_flag=True, help='Drop the schema first')
+@click.option('--restaurants', default=10000, type=int)
+@click.option('--dishes-per-restaurant', default=20, type=int)
+@click.option('--customers', default=50000, type=int)
+@click.option('--admins', default=5, type=int)
+@click.option('--orders', default=500000, type=int)
+@click.option('--reviews', default=200000, type=int)
+@click.option('--seed', default=4111, type=int, help='Random seed')
+@click.option('--skip-migrations', is_flag=True, help="Don't create the indexes from migrations.py")
+def run(database_uri, schema, reset, restaurants, dishes_per_restaurant, customers, admins, orders, reviews, seed, skip_migrations):
+	rng = random.Random(seed)
+	engine = create_engine(database_uri, connect_args={'options': f'-c search_path={schema},public'})
+
+	with engine.begin() as conn:
+		if reset:
+			conn.execute(text(f"DROP SCHEMA IF EXISTS {schema} CASCADE;"))
+		conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {schema};"))
+		conn.execute(text(SCHEMA_DDL))
+
+	dbapi_conn = engine.raw_connection()
+	try:
+		cursor = dbapi_conn.cursor()
+
+		print("restaurants and cuisines")
+		cuisine_names = list(CUISINES)
+		copy_rows(cursor, 'cuisine', ['cuisineid', 'cuisinename'], enumerate(cuisine_names, 1))
+		copy_rows(cursor, 'restaurant', ['restaurantid', 'name', 'location', 'pricerange'], (
+			(i, ' '.join(rng.sample(NAME_WORDS, rng.randint(2, 3))), rng.choice(LOCATIONS), rng.choice(PRICE_RANGES))
+			for i in range(1, restaurants + 1)))
+		copy_rows(cursor, 'restaurantcuisine', ['restaurantid', 'cuisineid'], (
+			(i, cuisine_id)
+			for i in range(1, restaurants + 1)
+			for cuisine_id in rng.sample(range(1, len(cuisine_names) + 1), rng.randint(1, 2))))
+
+		print("dishes")
+		dish_prices = [round(rng.uniform(4, 40), 2) for _ in range(restaurants * dishes_per_restaurant)]
+		copy_rows(cursor, 'dish', ['dishid', 'name', 'ingredients', 'restaurantid', 'price'], (
+			(dish_id, ' '.join(rng.sample(DISH_WORDS, 2)), ', '.join(rng.sample(INGREDIENTS, 3)),
+			 (dish_id - 1) // dishes_per_restaurant + 1, '%.2f' % dish_prices[dish_id - 1])
+			for dish_id in range(1, len(dish_prices) + 1)))
+
+		print("users")
+		users = [(i, 'Customer %d' % i, 'user%d' % i, 'pwuser%d' % i, 'Cust') for i in range(1, customers + 1)]
+		users += [(customers + i, 'Admin %d' % i, 'admin%d' % i, 'pwadmin%d' % i, 'Admin') for i in range(1, admins + 1)]
+		copy_rows(cursor, 'users', ['userid', 'name', 'username', 'password', 'role'], users)
+
+		print("orders")
+		items = []
+		chunk = []
+		for order in generate_orders(rng, orders, customers, restaurants, dishes_per_restaurant, dish_prices, items):
+			chunk.append(order)
+			if len(chunk) >= 100000:
+				copy_rows(cursor, 'orders', ['orderid', 'date', 'totalprice', 'userid', 'restaurantid'], chunk)
+				copy_rows(cursor, 'orderitem', ['orderitemid', 'orderid', 'dishid', 'quantity', 'price'], items)
+				chunk = []
+				items.clear()
+				print("  %d" % order[0])
+		copy_rows(cursor, 'orders', ['orderid', 'date', 'totalprice', 'userid', 'restaurantid'], chunk)
+		copy_rows(cursor, 'orderitem', ['orderitemid', 'orderid', 'dishid', 'quantity', 'price'], items)
+
+		print("reviews")
+		copy_rows(cursor, 'review', ['reviewid', 'rating', 'comment', 'userid', 'restaurantid'], (
+			(i, rng.randint(1, 5), rng.choice(COMMENTS), rng.randint(1, customers), rng.randint(1, restaurants))
+			for i in range(1, reviews + 1)))
+
+		for table, column in SERIAL_COLUMNS:
+			cursor.execute("SELECT setval(pg_get_serial_sequence(%s, %s), GREATEST((SELECT MAX(" + column + ") FROM " + table + "), 1));",
+			               (table, column))
+		cursor.close()
+		dbapi_conn.commit()
+	finally:
+		dbapi_conn.close()
+
+	if not skip_migrations:
+		print("migrations")
+		migrate(engine)
+
+	print("restaurantstats")
+	with engine.begin() as conn:
+		rebuild_stats(conn)
+		conn.execute(text(CREATE_VERSIONS_TABLE))
+		conn.execute(text("ANALYZE;"))
+	print("done")
+
+
+if __name__ == "__main__":
+	run()
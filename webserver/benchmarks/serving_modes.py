@@ -0,0 +1,60 @@
+"""
+Load-tests the read-only pages on the threaded Flask server and on the async
+server (asgi.py) with the same workload, one after the other.
+
+Start both servers against the same database, for example:
+
+	python server.py --threaded 0.0.0.0 8111
+	hypercorn asgi:app --bind 0.0.0.0:8112
+
+then run from the webserver directory:
+
+	python benchmarks/serving_modes.py --concurrency 200 --restaurant-id 1 --restaurant-id 2 \
+		--login jcw2239:password12324
+
+Use the same --concurrency for both modes and raise it until one of them stops
+keeping up; the async server should hold its latency at much higher values.
+"""
+import os
+import sys
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from loadgen import Request, run_load, report
+
+
+def read_workload(restaurant_ids, logged_in):
+	"""Directory views dominate, then detail pages, then the other listings"""
+	workload = [
+		Request('/restaurants', '/restaurants', weight=40),
+		Request('/restaurants?search', lambda state: '/restaurants?search=' + state['rng'].choice(['pizza', 'sushi', 'burger', 'thai']), weight=10),
+		Request('/restaurants/<id>', lambda state: '/restaurants/%d' % state['rng'].choice(restaurant_ids), weight=35),
+		Request('/dishes', '/dishes', weight=5),
+	]
+	if logged_in:
+		workload += [
+			Request('/orders', '/orders', weight=5),
+			Request('/reviews', '/reviews', weight=5),
+		]
+	return workload
+
+
+@click.command()
+@click.option('--threaded-url', default='http://localhost:8111', help='Base URL of the threaded Flask server')
+@click.option('--async-url', default='http://localhost:8112', help='Base URL of the async server')
+@click.option('--concurrency', default=50, type=int, help='Simultaneous clients')
+@click.option('--duration', default=30, type=int, help='Seconds to measure each mode for')
+@click.option('--restaurant-id', 'restaurant_ids', multiple=True, type=int, required=True,
+              help='Restaurant IDs to request detail pages for (repeatable)')
+@click.option('--login', 'logins', multiple=True, help='USERNAME:PASSWORD to log clients in as (repeatable)')
+def run(threaded_url, async_url, concurrency, duration, restaurant_ids, logins):
+	credentials = [tuple(login.split(':', 1)) for login in logins]
+	workload = read_workload(list(restaurant_ids), bool(credentials))
+	for title, base_url in (('threaded', threaded_url), ('async', async_url)):
+		results, elapsed = run_load(base_url, workload, concurrency, duration, credentials)
+		report(results, elapsed, title="%s (%s, %d clients)" % (title, base_url, concurrency))
+
+
+if __name__ == "__main__":
+	run()
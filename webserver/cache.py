@@ -0,0 +1,129 @@
+"""
+Small in-process caches used by server.py.
+
+Each server process keeps its own copy, so anything cached here must be
+invalidated by apply_change in server.py, which every process runs for every
+write (see invalidation.py).
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+	"""
+	A thread-safe key/value cache where entries expire after ttl seconds.
+	If maxsize is set, the least recently used entry is evicted once the cache is full.
+	Keeps hit/miss counters so we can see whether a cache is earning its keep.
+	If may_fill is set, get_or_load only stores what it loaded while may_fill() is true.
+	"""
+	def __init__(self, ttl, maxsize=None, may_fill=None):
+		self.ttl = ttl
+		self.maxsize = maxsize
+		self.may_fill = may_fill
+		self.hits = 0
+		self.misses = 0
+		self._data = OrderedDict()  # key -> (expires_at, value)
+		self._lock = threading.Lock()
+
+	def get(self, key, default=None):
+		"""Returns the cached value for key, or default if it is missing or expired"""
+		with self._lock:
+			entry = self._data.get(key)
+			if entry is not None:
+				if entry[0] > time.monotonic():
+					self._data.move_to_end(key)
+					self.hits += 1
+					return entry[1]
+				del self._data[key]
+			self.misses += 1
+			return default
+
+	def set(self, key, value):
+		with self._lock:
+			self._data[key] = (time.monotonic() + self.ttl, value)
+			self._data.move_to_end(key)
+			if self.maxsize is not None:
+				while len(self._data) > self.maxsize:
+					self._data.popitem(last=False)
+
+	def get_or_load(self, key, loader):
+		"""
+		Returns the cached value for key, calling loader() to fill the cache on a miss.
+		The lock isn't held while loading, so a slow query doesn't block other keys.
+		"""
+		missing = object()
+		value = self.get(key, missing)
+		if value is missing:
+			value = loader()
+			if self.may_fill is None or self.may_fill():
+				self.set(key, value)
+		return value
+
+	def invalidate(self, key=None):
+		"""Drops one entry, or every entry if no key is given"""
+		with self._lock:
+			if key is None:
+				self._data.clear()
+			else:
+				self._data.pop(key, None)
+
+	def stats(self):
+		with self._lock:
+			return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+class SingleFlight:
+	"""
+	Coalesces concurrent loads of the same key. The first caller runs the loader;
+	callers that arrive while it is still running wait for its result instead of
+	running the same queries again. Nothing is kept after the load finishes, so a
+	caller only ever shares a load that was in progress when it arrived.
+
+	A waiting caller gives up after timeout seconds, or if the shared load raises,
+	and runs the loader itself.
+	"""
+	class _Call:
+		def __init__(self):
+			self.done = threading.Event()
+			self.ok = False
+			self.result = None
+
+	def __init__(self, timeout):
+		self.timeout = timeout
+		self.counts = {'run': 0, 'shared': 0, 'timeout': 0, 'failed': 0}
+		self._calls = {}  # key -> _Call in progress
+		self._lock = threading.Lock()
+
+	def do(self, key, loader):
+		"""Returns loader()'s result, shared with any other caller loading the same key"""
+		with self._lock:
+			call = self._calls.get(key)
+			leader = call is None
+			if leader:
+				call = self._calls[key] = self._Call()
+		
+		if leader:
+			try:
+				call.result = loader()
+				call.ok = True
+				return call.result
+			finally:
+				with self._lock:
+					del self._calls[key]
+					self.counts['run'] += 1
+				call.done.set()
+		
+		if call.done.wait(self.timeout) and call.ok:
+			outcome = 'shared'
+		else:
+			outcome = 'failed' if call.done.is_set() else 'timeout'
+		with self._lock:
+			self.counts[outcome] += 1
+		if outcome == 'shared':
+			return call.result
+		return loader()
+
+	def stats(self):
+		with self._lock:
+			return dict(self.counts, in_progress=len(self._calls))
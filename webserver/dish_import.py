@@ -0,0 +1,150 @@
+"""
+Bulk import of dishes from a CSV file.
+
+The CSV needs a header row with name and price columns, and may have an
+ingredients column. Rows are read and validated a batch at a time and each
+batch of valid rows is loaded with Postgres COPY, so a file with thousands of
+dishes is never held in memory and costs one statement per batch instead of one
+per dish. Invalid rows are skipped and reported with their line numbers.
+
+Used by the /restaurants/<id>/import-dishes page, or from the command line:
+
+	python dish_import.py RESTAURANT_ID dishes.csv
+"""
+import io
+import csv
+import codecs
+
+
+COPY_DISHES = "COPY dish (name, ingredients, restaurantid, price) FROM STDIN WITH (FORMAT csv)"
+
+# Only the first this many row errors are kept, so a completely wrong file
+# doesn't build up an error list as large as the file
+MAX_REPORTED_ERRORS = 1000
+
+
+def validate_dish_row(row):
+	"""
+	Checks one CSV row the same way the Add Dish form does.
+	Returns (name, ingredients, price) or raises ValueError with a message for the user.
+	"""
+	name = (row.get('name') or '').strip()
+	ingredients = (row.get('ingredients') or '').strip() or None
+	price_str = (row.get('price') or '').strip()
+
+	if not name:
+		raise ValueError("Dish name is required")
+	if not price_str:
+		raise ValueError("Price is required")
+	try:
+		price = float(price_str)
+	except ValueError:
+		raise ValueError(f"Invalid price format: {price_str}")
+	if price < 0:
+		raise ValueError("Price must be non-negative")
+	return name, ingredients, price
+
+
+def copy_batch(cursor, restaurant_id, batch):
+	"""Loads a batch of validated (name, ingredients, price) rows with one COPY"""
+	buf = io.StringIO()
+	writer = csv.writer(buf)
+	for name, ingredients, price in batch:
+		# An empty unquoted field is NULL in COPY's csv format
+		writer.writerow([name, ingredients, restaurant_id, price])
+	buf.seek(0)
+	cursor.copy_expert(COPY_DISHES, buf)
+
+
+def csv_lines(byte_stream, encoding='utf-8-sig', chunk_size=64 * 1024):
+	"""
+	Decodes an uploaded file's binary stream into lines for the csv module, split on
+	newlines only, as a file opened with newline='' would be. io.TextIOWrapper can't
+	wrap an upload spooled to disk before Python 3.11, which lacks readable().
+	"""
+	reader = codecs.getreader(encoding)(byte_stream)
+	pending = ''
+	while True:
+		chunk = reader.read(chunk_size)
+		if not chunk:
+			break
+		lines = (pending + chunk).split('\n')
+		pending = lines.pop()
+		for line in lines:
+			yield line + '\n'
+	if pending:
+		yield pending
+
+
+def import_dishes(dbapi_conn, restaurant_id, text_stream, batch_size=1000):
+	"""
+	Imports dishes for restaurant_id from a CSV text stream (or csv_lines) using a raw DBAPI
+	(psycopg2) connection. Valid rows are loaded and committed together; rows
+	that fail validation are skipped.
+	Returns (imported_count, error_count, errors) where errors is a list of
+	(line_number, message) for up to MAX_REPORTED_ERRORS bad rows.
+	"""
+	reader = csv.DictReader(text_stream)
+	if reader.fieldnames is None:
+		return 0, 1, [(1, "The file is empty")]
+	fieldnames = [field.strip().lower() for field in reader.fieldnames]
+	missing = [field for field in ('name', 'price') if field not in fieldnames]
+	if missing:
+		return 0, 1, [(1, f"Missing column(s): {', '.join(missing)}")]
+	reader.fieldnames = fieldnames
+
+	imported = 0
+	error_count = 0
+	errors = []
+	batch = []
+	cursor = dbapi_conn.cursor()
+	try:
+		for row in reader:
+			try:
+				batch.append(validate_dish_row(row))
+			except ValueError as e:
+				error_count += 1
+				if len(errors) < MAX_REPORTED_ERRORS:
+					errors.append((reader.line_num, str(e)))
+				continue
+			if len(batch) >= batch_size:
+				copy_batch(cursor, restaurant_id, batch)
+				imported += len(batch)
+				batch = []
+		if batch:
+			copy_batch(cursor, restaurant_id, batch)
+			imported += len(batch)
+		dbapi_conn.commit()
+	except Exception:
+		dbapi_conn.rollback()
+		raise
+	finally:
+		cursor.close()
+	return imported, error_count, errors
+
+
+if __name__ == "__main__":
+	import click
+
+	@click.command()
+	@click.option('--batch-size', default=1000, type=int, help='Rows loaded per COPY')
+	@click.argument('RESTAURANT_ID', type=int)
+	@click.argument('CSV_FILE', type=click.Path(exists=True, dir_okay=False))
+	def run(batch_size, restaurant_id, csv_file):
+		"""Import dishes for RESTAURANT_ID from CSV_FILE (columns: name, ingredients, price)"""
+		from server import engine, announce_changes
+		from invalidation import Change
+		dbapi_conn = engine.raw_connection()
+		try:
+			with open(csv_file, encoding='utf-8-sig', newline='') as f:
+				imported, error_count, errors = import_dishes(dbapi_conn, restaurant_id, f, batch_size)
+		finally:
+			dbapi_conn.close()
+		if imported:
+			# Running servers drop the restaurant's cached menu
+			announce_changes(Change('dish', restaurant_id=restaurant_id))
+		for line_number, message in errors:
+			print("line %d: %s" % (line_number, message))
+		print("imported %d dish(es), skipped %d invalid row(s)" % (imported, error_count))
+
+	run()
@@ -0,0 +1,42 @@
+"""
+Keyed fragment caching for templates.
+
+Wrap an expensive block in a cache tag with a key made of one or more expressions:
+
+	{% cache 'restaurant-dishes', restaurant.id %}
+	  ... the dish table ...
+	{% endcache %}
+
+The rendered HTML is stored under the key tuple ('restaurant-dishes', 7) in the
+cache set as the environment's fragment_cache, and later renders reuse it without
+running the block. Routes that change the rows behind a fragment drop it with
+fragment_cache.invalidate(key). With no fragment_cache set the block always renders,
+so a template using the tag works in an app that doesn't cache.
+
+Only wrap blocks whose output depends on the key alone, not on the session.
+"""
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+class FragmentCacheExtension(Extension):
+	tags = {'cache'}
+
+	def __init__(self, environment):
+		super().__init__(environment)
+		environment.extend(fragment_cache=None)
+
+	def parse(self, parser):
+		lineno = next(parser.stream).lineno
+		key = [parser.parse_expression()]
+		while parser.stream.skip_if('comma'):
+			key.append(parser.parse_expression())
+		body = parser.parse_statements(['name:endcache'], drop_needle=True)
+		return nodes.CallBlock(self.call_method('_render_cached', [nodes.Tuple(key, 'load')]),
+		                       [], [], body).set_lineno(lineno)
+
+	def _render_cached(self, key, caller):
+		cache = self.environment.fragment_cache
+		if cache is None:
+			return caller()
+		return cache.get_or_load(key, caller)
@@ -0,0 +1,141 @@
+"""
+Cross-process cache invalidation over Postgres LISTEN/NOTIFY.
+
+Every server process keeps its own caches (cache.py, template fragments, the
+search index, the data versions behind ETags), so a write handled by one process
+has to reach the others. Write routes publish a Change for each row they touched,
+in the same transaction as the write. Postgres only delivers a NOTIFY when its
+transaction commits, so a rolled back write never invalidates anything. Each
+process runs a listener thread that receives the changes made by the others and
+passes them to on_change, the same function the writing process applied locally.
+
+Notifications sent while a listener is disconnected are lost, so on_reconnect is
+called every time the listener (re)connects and should drop everything it caches.
+
+LISTEN needs the psycopg2 driver (the default for postgresql:// URIs) and a
+connection to the primary; a read replica can't send or receive notifications.
+"""
+import os
+import json
+import time
+import select
+import threading
+from typing import NamedTuple, Optional
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+
+
+class Change(NamedTuple):
+	"""
+	A change to one row of table, or to several rows when id is None (a bulk import).
+	restaurant_id is the restaurant the row belongs to, for the caches scoped to one
+	restaurant; user_id the user whose cached data it affects. A table of ANY_TABLE
+	means anything may have changed (stats.py rebuild), and every cache is dropped.
+	dish_ids lists the dishes of a newly placed order, for the recommendations.
+	versions holds the data versions the change bumped (see versions.py), filled in
+	by the writer so every process takes in the same ones.
+	"""
+	table: str
+	id: Optional[int] = None
+	restaurant_id: Optional[int] = None
+	user_id: Optional[int] = None
+	deleted: bool = False
+	name: Optional[str] = None
+	dish_ids: Optional[list] = None
+	versions: Optional[dict] = None
+
+
+ANY_TABLE = '*'
+
+NOTIFY = text("SELECT pg_notify(:channel, :payload);")
+
+
+class InvalidationBus:
+	def __init__(self, uri, channel, on_change, on_reconnect, poll_interval=5.0, retry_interval=1.0):
+		self.channel = channel
+		self.on_change = on_change
+		self.on_reconnect = on_reconnect
+		self.poll_interval = poll_interval
+		self.retry_interval = retry_interval
+		self.counts = {'published': 0, 'received': 0, 'connects': 0}
+		self._engine = create_engine(uri, poolclass=NullPool)
+		self._origin = ''
+		self._pid = None
+		self._lock = threading.Lock()
+
+	def publish(self, conn, change):
+		"""Sends change to the other processes when conn's transaction commits"""
+		payload = json.dumps([self._origin] + list(change))
+		conn.execute(NOTIFY, {'channel': self.channel, 'payload': payload})
+		with self._lock:
+			self.counts['published'] += 1
+
+	def start(self):
+		"""
+		Starts this process's listener thread, if it isn't running yet. Cheap enough
+		to call on every request; a forked worker starts its own on its first call.
+		"""
+		if self._pid == os.getpid():
+			return
+		with self._lock:
+			if self._pid == os.getpid():
+				return
+			self._pid = os.getpid()
+			# Lets the listener skip the changes this process already applied itself
+			self._origin = os.urandom(8).hex()
+		threading.Thread(target=self._listen, name='cache-invalidation', daemon=True).start()
+
+	def _listen(self):
+		while True:
+			try:
+				conn = self._engine.raw_connection()
+			except Exception as e:
+				print(f"Cache invalidation listener could not connect: {e}")
+				time.sleep(self.retry_interval)
+				continue
+			try:
+				dbapi_conn = conn.driver_connection
+				dbapi_conn.autocommit = True
+				cursor = dbapi_conn.cursor()
+				cursor.execute('LISTEN "%s";' % self.channel.replace('"', '""'))
+				with self._lock:
+					self.counts['connects'] += 1
+				self.on_reconnect()
+
+				while True:
+					readable, _, _ = select.select([dbapi_conn], [], [], self.poll_interval)
+					if not readable:
+						# Nothing for a while; make sure the connection is still alive
+						cursor.execute("SELECT 1;")
+					dbapi_conn.poll()
+					while dbapi_conn.notifies:
+						self._receive(dbapi_conn.notifies.pop(0).payload)
+			except Exception as e:
+				print(f"Cache invalidation listener lost its connection: {e}")
+				time.sleep(self.retry_interval)
+			finally:
+				try:
+					conn.close()
+				except Exception:
+					pass
+
+	def _receive(self, payload):
+		try:
+			origin, *fields = json.loads(payload)
+			change = Change(*fields)
+		except (ValueError, TypeError):
+			print(f"Ignoring malformed cache invalidation: {payload!r}")
+			return
+		if origin == self._origin:
+			return
+		with self._lock:
+			self.counts['received'] += 1
+		try:
+			self.on_change(change)
+		except Exception as e:
+			print(f"Error applying cache invalidation {change}: {e}")
+
+	def stats(self):
+		with self._lock:
+			return dict(self.counts)
@@ -0,0 +1,123 @@
+"""
+Minimal Prometheus-style metrics.
+
+Counters and histograms are kept in memory per server process and rendered in
+the Prometheus text exposition format by render(), which server.py serves on
+/metrics. Callback metrics read their values when scraped, which suits numbers
+that already live somewhere else (cache hit counters, pool sizes).
+"""
+import threading
+
+
+# Default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def format_labels(labelnames, labels, extra=None):
+	pairs = list(zip(labelnames, labels))
+	if extra:
+		pairs.append(extra)
+	if not pairs:
+		return ''
+	escaped = []
+	for name, value in pairs:
+		value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+		escaped.append('%s="%s"' % (name, value))
+	return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value):
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value))
+
+
+class Counter:
+	"""A count that only goes up, per combination of label values"""
+	type = 'counter'
+
+	def __init__(self, name, documentation, labelnames=()):
+		self.name = name
+		self.documentation = documentation
+		self.labelnames = tuple(labelnames)
+		self._values = {}
+		self._lock = threading.Lock()
+		_registry.append(self)
+
+	def inc(self, *labels, amount=1):
+		with self._lock:
+			self._values[labels] = self._values.get(labels, 0) + amount
+
+	def samples(self):
+		with self._lock:
+			values = dict(self._values)
+		for labels, value in sorted(values.items()):
+			yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Histogram:
+	"""Counts observations into cumulative buckets, per combination of label values"""
+	type = 'histogram'
+
+	def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+		self.name = name
+		self.documentation = documentation
+		self.labelnames = tuple(labelnames)
+		self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+		self._values = {}  # labels -> [bucket counts..., sum, count]
+		self._lock = threading.Lock()
+		_registry.append(self)
+
+	def observe(self, value, *labels):
+		with self._lock:
+			entry = self._values.get(labels)
+			if entry is None:
+				entry = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					entry[i] += 1
+					break
+			entry[-2] += value
+			entry[-1] += 1
+
+	def samples(self):
+		with self._lock:
+			values = {labels: list(entry) for labels, entry in self._values.items()}
+		for labels, entry in sorted(values.items()):
+			cumulative = 0
+			for i, bound in enumerate(self.buckets):
+				cumulative += entry[i]
+				yield self.name + '_bucket', format_labels(self.labelnames, labels, ('le', format_value(bound))), cumulative
+			yield self.name + '_sum', format_labels(self.labelnames, labels), entry[-2]
+			yield self.name + '_count', format_labels(self.labelnames, labels), entry[-1]
+
+
+class CallbackMetric:
+	"""
+	A gauge or counter whose values come from callback() at scrape time.
+	callback returns a dict of label value tuples -> value.
+	"""
+	def __init__(self, name, documentation, type, labelnames, callback):
+		self.name = name
+		self.documentation = documentation
+		self.type = type
+		self.labelnames = tuple(labelnames)
+		self.callback = callback
+		_registry.append(self)
+
+	def samples(self):
+		for labels, value in sorted(self.callback().items()):
+			yield self.name, format_labels(self.labelnames, labels), value
+
+
+def render():
+	"""Returns every registered metric in the Prometheus text exposition format"""
+	lines = []
+	for metric in _registry:
+		lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+		lines.append('# TYPE %s %s' % (metric.name, metric.type))
+		for name, labels, value in metric.samples():
+			lines.append('%s%s %s' % (name, labels, format_value(value)))
+	return '\n'.join(lines) + '\n'
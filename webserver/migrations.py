@@ -0,0 +1,132 @@
+"""
+Versioned schema changes.
+
+Each migration has a version number and runs once, in its own transaction,
+recorded in the schema_migrations table. Add new ones to the end of MIGRATIONS
+with the next number; never edit one that has already been applied somewhere.
+
+Most of them are indexes for the queries the pages run on every request:
+
+	dish       (restaurantid, name)               a restaurant's menu, by name
+	orders     (restaurantid, date DESC)          a restaurant's orders, newest first
+	orders     (userid, date DESC, orderid DESC)  order history paging (see repository.py)
+	review     (restaurantid, reviewid DESC)      a restaurant's reviews, newest first
+	review     (userid, reviewid DESC)            a user's reviews, newest first
+	orderitem  (orderid)                          an order's items
+	restaurant (name, restaurantid)               directory paging, by name (see server.py)
+
+The INCLUDE columns let the menu and order item lookups be answered from the
+index alone. Creating an index locks writes to its table while it builds, so
+apply migrations to a large database when it is quiet.
+
+	python migrations.py status
+	python migrations.py migrate
+
+benchmarks/plans.py checks that the queries actually use these indexes.
+"""
+from sqlalchemy import text
+
+from stats import rebuild_stats
+from versions import CREATE_VERSIONS_TABLE
+
+
+# (version, description, SQL or a function that runs it on the migration's connection)
+MIGRATIONS = [
+	# Filled in the same transaction, so the routes' incremental updates start from
+	# the real totals rather than from zero
+	(1, "restaurantstats summary table", rebuild_stats),
+	(2, "index dish by restaurant and name",
+	 "CREATE INDEX IF NOT EXISTS dish_restaurant_name ON dish (restaurantid, name) INCLUDE (dishid, price);"),
+	(3, "index orders by restaurant and date",
+	 "CREATE INDEX IF NOT EXISTS orders_restaurant_date ON orders (restaurantid, date DESC);"),
+	(4, "index orders by user and date for order history paging",
+	 "CREATE INDEX IF NOT EXISTS orders_user_date ON orders "
+	 "(userid, (COALESCE(date, CAST('-infinity' AS timestamp))) DESC, orderid DESC);"),
+	(5, "index review by restaurant, newest first",
+	 "CREATE INDEX IF NOT EXISTS review_restaurant_reviewid ON review (restaurantid, reviewid DESC);"),
+	(6, "index review by user, newest first",
+	 "CREATE INDEX IF NOT EXISTS review_user_reviewid ON review (userid, reviewid DESC);"),
+	(7, "index orderitem by order",
+	 "CREATE INDEX IF NOT EXISTS orderitem_order ON orderitem (orderid) INCLUDE (dishid, quantity, price);"),
+	(8, "index restaurant by name for directory paging",
+	 "CREATE INDEX IF NOT EXISTS restaurant_name_id ON restaurant (name, restaurantid);"),
+	# Version 1 used to create the table empty; recount databases it was applied to that way
+	(9, "recompute restaurantstats", rebuild_stats),
+	(10, "dataversion table behind the catalog pages' ETags", CREATE_VERSIONS_TABLE),
+]
+
+# Tables the server can't run without, which it checks for when it starts
+REQUIRED_TABLES = ('restaurantstats', 'dataversion')
+
+CREATE_MIGRATIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+	version integer PRIMARY KEY,
+	description text NOT NULL,
+	applied_at timestamptz NOT NULL DEFAULT now()
+);
+"""
+
+
+def missing_tables(conn):
+	"""Returns the REQUIRED_TABLES that don't exist yet"""
+	return [table for table in REQUIRED_TABLES
+	        if conn.execute(text("SELECT to_regclass(:table) IS NULL;"), {'table': table}).scalar()]
+
+
+def applied_versions(conn):
+	"""Returns the set of migration versions already applied"""
+	conn.execute(text(CREATE_MIGRATIONS_TABLE))
+	return {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations;"))}
+
+
+def migrate(engine, target=None):
+	"""
+	Applies every pending migration up to target (all of them by default),
+	each in its own transaction. Returns the versions applied.
+	"""
+	with engine.begin() as conn:
+		done = applied_versions(conn)
+	applied = []
+	for version, description, sql in MIGRATIONS:
+		if version in done or (target is not None and version > target):
+			continue
+		with engine.begin() as conn:
+			# Serializes concurrent runs (two deploys at once) on the same migration
+			conn.execute(text("LOCK TABLE schema_migrations IN EXCLUSIVE MODE;"))
+			if conn.execute(text("SELECT 1 FROM schema_migrations WHERE version = :version;"), {'version': version}).first():
+				continue
+			if callable(sql):
+				sql(conn)
+			else:
+				conn.execute(text(sql))
+			conn.execute(text("INSERT INTO schema_migrations (version, description) VALUES (:version, :description);"),
+			             {'version': version, 'description': description})
+		applied.append(version)
+	return applied
+
+
+if __name__ == "__main__":
+	import click
+
+	@click.group()
+	def cli():
+		"""Apply and inspect schema migrations"""
+
+	@cli.command()
+	def status():
+		"""List migrations and whether each has been applied"""
+		from server import engine
+		with engine.begin() as conn:
+			done = applied_versions(conn)
+		for version, description, sql in MIGRATIONS:
+			print("%3d  %-8s %s" % (version, 'applied' if version in done else 'pending', description))
+
+	@cli.command(name='migrate')
+	@click.option('--target', type=int, help='Stop after this version')
+	def migrate_command(target):
+		"""Apply pending migrations"""
+		from server import engine
+		applied = migrate(engine, target)
+		print("applied %s" % (', '.join(map(str, applied)) if applied else 'nothing, already up to date'))
+
+	cli()
@@ -0,0 +1,236 @@
+"""
+"People also ordered" and "recommended for you" lists.
+
+The model is built in batch from the orders, orderitem and review tables:
+
+  * Dish co-occurrence: an orders x dishes sparse matrix O gives O^T O, the number
+    of orders each pair of dishes appeared in together. Scores are cosine
+    normalized (pair count / sqrt(count_a * count_b)) so popular dishes don't
+    crowd out everything else, and each dish keeps its top K neighbours.
+  * Restaurant affinity: a users x restaurants matrix of order counts plus review
+    sentiment gives restaurant-restaurant cosine similarity; each restaurant keeps
+    its top K neighbours, and each user's recommendations are the top K of their
+    affinity row times that neighbour matrix, minus places they've already ordered from.
+
+Only the top K lists are kept, in plain dicts, so a lookup is a dict access.
+create_order feeds every new order to add_order(), which updates the counts and
+lists it touches without a rebuild.
+
+Build the model and save it for the server to load at startup:
+
+	python recommend.py build --output recommendations.pickle
+"""
+import math
+import pickle
+import threading
+
+import numpy as np
+import scipy.sparse as sp
+from sqlalchemy import text
+
+
+def top_k_rows(matrix, k, exclude_diagonal=False):
+	"""Returns {row index: [(column index, score), ...]} with the k best scores of each CSR row"""
+	matrix = sp.csr_matrix(matrix)
+	result = {}
+	for row in range(matrix.shape[0]):
+		start, end = matrix.indptr[row], matrix.indptr[row + 1]
+		if start == end:
+			continue
+		cols = matrix.indices[start:end]
+		scores = matrix.data[start:end]
+		if exclude_diagonal:
+			keep = cols != row
+			cols, scores = cols[keep], scores[keep]
+		if len(scores) > k:
+			best = np.argpartition(-scores, k)[:k]
+			cols, scores = cols[best], scores[best]
+		order = np.argsort(-scores, kind='stable')
+		result[row] = [(int(cols[i]), float(scores[i])) for i in order if scores[i] > 0]
+	return result
+
+
+def cosine_normalize(counts, frequencies):
+	"""Divides entry (i, j) of a sparse count matrix by sqrt(freq_i * freq_j)"""
+	inv = sp.diags(1.0 / np.sqrt(np.maximum(frequencies, 1)))
+	return inv @ counts @ inv
+
+
+def fetch_array(conn, query, columns, chunk_size=100000):
+	"""Reads a query through a server-side cursor into one int64 numpy array per column"""
+	parts = [[] for _ in range(columns)]
+	result = conn.execution_options(stream_results=True).execute(text(query))
+	for rows in result.partitions(chunk_size):
+		block = np.array(rows, dtype=np.int64).reshape(-1, columns)
+		for i in range(columns):
+			parts[i].append(block[:, i])
+	result.close()
+	return [np.concatenate(p) if p else np.zeros(0, dtype=np.int64) for p in parts]
+
+
+class Recommender:
+	"""Precomputed top K recommendation lists, with incremental updates for new orders"""
+
+	def __init__(self, k=10):
+		self.k = k
+		self.dish_neighbors = {}        # dishid -> [(dishid, score), ...]
+		self.dish_counts = {}           # dishid -> orders containing it
+		self.pair_counts = {}           # (dishid, dishid) -> orders containing both, for pairs in a top K list or added live
+		self.restaurant_neighbors = {}  # restaurantid -> [(restaurantid, score), ...]
+		self.user_recs = {}             # userid -> [(restaurantid, score), ...]
+		self.user_visited = {}          # userid -> set of restaurantids ordered from
+		self._lock = threading.Lock()
+
+	# Lookups
+
+	def also_ordered(self, dish_id, limit=3):
+		"""Dish IDs most often ordered together with dish_id"""
+		return [dish for dish, score in self.dish_neighbors.get(dish_id, ())[:limit]]
+
+	def recommended_restaurants(self, user_id, limit=5):
+		"""Restaurant IDs recommended for user_id, best first"""
+		return [restaurant for restaurant, score in self.user_recs.get(user_id, ())[:limit]]
+
+	# Batch build
+
+	def build(self, conn):
+		"""Rebuilds the whole model from the database"""
+		order_ids, dish_ids = fetch_array(conn, "SELECT orderid, dishid FROM orderitem WHERE dishid IS NOT NULL;", 2)
+		user_ids, restaurant_ids = fetch_array(conn, "SELECT userid, restaurantid FROM orders WHERE userid IS NOT NULL AND restaurantid IS NOT NULL;", 2)
+		review_users, review_restaurants, ratings = fetch_array(
+			conn, "SELECT userid, restaurantid, rating FROM review WHERE userid IS NOT NULL AND rating IS NOT NULL;", 3)
+		self.build_from_arrays(order_ids, dish_ids, user_ids, restaurant_ids, review_users, review_restaurants, ratings)
+
+	def build_from_arrays(self, order_ids, dish_ids, user_ids, restaurant_ids, review_users, review_restaurants, ratings):
+		# Dish co-occurrence
+		orders, order_index = np.unique(order_ids, return_inverse=True)
+		dishes, dish_index = np.unique(dish_ids, return_inverse=True)
+		basket = sp.csr_matrix((np.ones(len(dish_index)), (order_index, dish_index)), shape=(len(orders), len(dishes)))
+		basket.data[:] = 1  # a dish listed twice in one order counts once
+		cooccur = (basket.T @ basket).tocsr()
+		frequencies = cooccur.diagonal()
+		neighbors = top_k_rows(cosine_normalize(cooccur, frequencies), self.k, exclude_diagonal=True)
+
+		dish_neighbors, pair_counts = {}, {}
+		for row, entries in neighbors.items():
+			dish = int(dishes[row])
+			dish_neighbors[dish] = [(int(dishes[col]), score) for col, score in entries]
+			for col, score in entries:
+				# Undo the normalization rather than indexing back into the matrix
+				pair_counts[(dish, int(dishes[col]))] = int(round(score * math.sqrt(frequencies[row] * frequencies[col])))
+		dish_counts = {int(dish): int(count) for dish, count in zip(dishes, frequencies)}
+
+		# User-restaurant affinity: one point per order, plus (rating - 3) per review
+		users, user_index = np.unique(np.concatenate([user_ids, review_users]), return_inverse=True)
+		restaurants, restaurant_index = np.unique(np.concatenate([restaurant_ids, review_restaurants]), return_inverse=True)
+		weights = np.concatenate([np.ones(len(user_ids)), ratings.astype(float) - 3])
+		affinity = sp.csr_matrix((weights, (user_index, restaurant_index)), shape=(len(users), len(restaurants)))
+		affinity.data = np.maximum(affinity.data, 0)
+		affinity.eliminate_zeros()
+
+		column_norms = np.sqrt(np.asarray(affinity.multiply(affinity).sum(axis=0)).ravel())
+		normalized = affinity @ sp.diags(1.0 / np.maximum(column_norms, 1e-9))
+		similarity = (normalized.T @ normalized).tocsr()
+		restaurant_top = top_k_rows(similarity, self.k, exclude_diagonal=True)
+
+		restaurant_neighbors = {}
+		rows, cols, data = [], [], []
+		for row, entries in restaurant_top.items():
+			restaurant_neighbors[int(restaurants[row])] = [(int(restaurants[col]), score) for col, score in entries]
+			for col, score in entries:
+				rows.append(row)
+				cols.append(col)
+				data.append(score)
+		neighbor_matrix = sp.csr_matrix((data, (rows, cols)), shape=(len(restaurants), len(restaurants)))
+
+		# Score every restaurant near the ones a user likes, then drop the ones they've been to
+		scores = (affinity @ neighbor_matrix).tocsr()
+		visited = sp.csr_matrix((np.ones(len(user_ids)), (user_index[:len(user_ids)], restaurant_index[:len(user_ids)])),
+		                        shape=(len(users), len(restaurants)))
+		visited.data[:] = 1
+		scores = (scores - scores.multiply(visited)).tocsr()
+		scores.eliminate_zeros()
+		user_top = top_k_rows(scores, self.k)
+
+		user_recs = {int(users[row]): [(int(restaurants[col]), score) for col, score in entries]
+		             for row, entries in user_top.items()}
+		user_visited = {}
+		for row in range(visited.shape[0]):
+			cols = visited.indices[visited.indptr[row]:visited.indptr[row + 1]]
+			if len(cols):
+				user_visited[int(users[row])] = {int(restaurants[col]) for col in cols}
+
+		with self._lock:
+			self.dish_neighbors, self.dish_counts, self.pair_counts = dish_neighbors, dish_counts, pair_counts
+			self.restaurant_neighbors, self.user_recs, self.user_visited = restaurant_neighbors, user_recs, user_visited
+
+	# Incremental updates
+
+	def add_order(self, user_id, restaurant_id, dish_ids):
+		"""Folds one new order into the counts and top K lists it affects"""
+		dish_ids = sorted(set(dish_ids))
+		with self._lock:
+			for dish in dish_ids:
+				self.dish_counts[dish] = self.dish_counts.get(dish, 0) + 1
+			for a in dish_ids:
+				for b in dish_ids:
+					if a == b:
+						continue
+					count = self.pair_counts.get((a, b), 0) + 1
+					self.pair_counts[(a, b)] = count
+					score = count / math.sqrt(self.dish_counts[a] * self.dish_counts[b])
+					self.dish_neighbors[a] = self._merge(self.dish_neighbors.get(a, []), {b: score})
+
+			visited = self.user_visited.setdefault(user_id, set())
+			visited.add(restaurant_id)
+			candidates = {restaurant: score for restaurant, score in self.restaurant_neighbors.get(restaurant_id, ())}
+			current = [(restaurant, score) for restaurant, score in self.user_recs.get(user_id, ()) if restaurant not in visited]
+			merged = dict(current)
+			for restaurant, score in candidates.items():
+				if restaurant not in visited:
+					merged[restaurant] = merged.get(restaurant, 0.0) + score
+			self.user_recs[user_id] = self._merge([], merged)
+
+	def _merge(self, entries, updates):
+		"""Applies {id: new score} to a top K list and returns the new list"""
+		scores = dict(entries)
+		scores.update(updates)
+		return sorted(scores.items(), key=lambda entry: -entry[1])[:self.k]
+
+	# Saving and loading
+
+	def save(self, path):
+		with self._lock:
+			state = {key: value for key, value in self.__dict__.items() if key != '_lock'}
+		with open(path, 'wb') as f:
+			pickle.dump(state, f)
+
+	@classmethod
+	def load(cls, path):
+		recommender = cls()
+		with open(path, 'rb') as f:
+			recommender.__dict__.update(pickle.load(f))
+		return recommender
+
+
+if __name__ == "__main__":
+	import click
+
+	@click.group()
+	def cli():
+		"""Build the recommendation model"""
+
+	@cli.command()
+	@click.option('--output', default='recommendations.pickle', help='File the server loads the model from')
+	@click.option('--k', default=10, type=int, help='Recommendations kept per dish, restaurant and user')
+	def build(output, k):
+		"""Build the model from the database and save it"""
+		from server import engine
+		recommender = Recommender(k=k)
+		with engine.connect() as conn:
+			recommender.build(conn)
+		recommender.save(output)
+		print("saved recommendations for %d dishes and %d users to %s" % (
+			len(recommender.dish_neighbors), len(recommender.user_recs), output))
+
+	cli()
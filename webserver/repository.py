@@ -0,0 +1,287 @@
+"""
+Read queries shared by the routes, and the row types they return.
+
+Each statement is wrapped in text() once, when the module is imported, instead
+of on every request. Rows come back as NamedTuples built straight from the
+result rows with _make, so a listing of thousands of rows doesn't build a dict
+per row. Templates read their fields by name (dish.name) just as they did the dicts.
+
+Display fallbacks ('N/A' for a missing name or total, and so on) are applied in
+the SQL with COALESCE, so the Python side only has to wrap each row.
+"""
+from typing import NamedTuple, Optional
+
+from sqlalchemy import text
+
+
+class RestaurantRef(NamedTuple):
+	id: int
+	name: str
+
+
+class MenuDish(NamedTuple):
+	"""A dish as shown on the order forms; price is 0.0 when not set"""
+	id: int
+	name: str
+	price: float
+
+
+class DishListing(NamedTuple):
+	"""A row of the /dishes listing; price is None when not set"""
+	id: int
+	name: str
+	restaurant_id: Optional[int]
+	price: Optional[float]
+	restaurant_name: str
+
+
+class DishDetail(NamedTuple):
+	"""A dish as shown on the edit form"""
+	id: int
+	name: str
+	ingredients: str
+	price: float
+	restaurant_id: Optional[int]
+	restaurant_name: Optional[str]
+
+
+class OrderSummary(NamedTuple):
+	id: int
+	user_id: Optional[int]
+	restaurant_id: Optional[int]
+	date: str
+	total: str
+	restaurant_name: str
+	username: str
+
+
+class OrderStats(NamedTuple):
+	"""A user's totals across all their orders"""
+	order_count: int
+	lifetime_spend: float
+	favourite_restaurant_id: Optional[int]
+	favourite_restaurant_name: Optional[str]
+
+
+class OrderItem(NamedTuple):
+	id: int
+	dish_id: Optional[int]
+	quantity: int
+	dish_name: str
+
+
+class UserReview(NamedTuple):
+	id: int
+	user_id: Optional[int]
+	restaurant_id: Optional[int]
+	rating: str
+	text: str
+	restaurant_name: str
+	username: str
+	date: str
+
+
+class UserRef(NamedTuple):
+	id: int
+	username: str
+
+
+class CuisineRef(NamedTuple):
+	id: int
+	name: str
+
+
+# Restaurants
+
+FIND_RESTAURANT = text("SELECT restaurantid, name FROM restaurant WHERE restaurantid = :id;")
+
+RESTAURANT_MENU = text("""
+SELECT dishid, name, CAST(COALESCE(price, 0.0) AS float8) AS price
+FROM dish
+WHERE restaurantid = :id
+ORDER BY name;
+""")
+
+def find_restaurant(conn, restaurant_id):
+	"""Returns the restaurant's RestaurantRef, or None if it doesn't exist"""
+	row = conn.execute(FIND_RESTAURANT, {'id': restaurant_id}).fetchone()
+	return RestaurantRef._make(row) if row else None
+
+def restaurant_menu(conn, restaurant_id):
+	"""Returns the restaurant's dishes as MenuDish rows, by name"""
+	return list(map(MenuDish._make, conn.execute(RESTAURANT_MENU, {'id': restaurant_id})))
+
+
+# Dishes
+
+LIST_DISHES = text("""
+SELECT d.dishid, d.name, d.restaurantid, CAST(NULLIF(d.price, 0) AS float8) AS price,
+       COALESCE(NULLIF(r.name, ''), 'N/A') AS restaurant_name
+FROM dish d
+LEFT JOIN restaurant r ON d.restaurantid = r.restaurantid
+ORDER BY d.name;
+""")
+
+FIND_DISH = text("""
+SELECT d.dishid, d.name, COALESCE(d.ingredients, ''), CAST(COALESCE(NULLIF(d.price, 0), 0.0) AS float8),
+       d.restaurantid, r.name AS restaurant_name
+FROM dish d
+LEFT JOIN restaurant r ON d.restaurantid = r.restaurantid
+WHERE d.dishid = :id;
+""")
+
+DISH_RESTAURANT = text("SELECT restaurantid FROM dish WHERE dishid = :id;")
+
+def list_dishes(conn):
+	"""Returns every dish as DishListing rows, by name"""
+	return list(map(DishListing._make, conn.execute(LIST_DISHES)))
+
+def find_dish(conn, dish_id):
+	"""Returns the dish's DishDetail, or None if it doesn't exist"""
+	row = conn.execute(FIND_DISH, {'id': dish_id}).fetchone()
+	return DishDetail._make(row) if row else None
+
+def dish_restaurant_id(conn, dish_id):
+	"""Returns the ID of the restaurant a dish belongs to, or None"""
+	return conn.execute(DISH_RESTAURANT, {'id': dish_id}).scalar()
+
+
+# Orders
+
+ORDER_SUMMARY_SELECT = """
+SELECT o.orderid, o.userid, o.restaurantid,
+       COALESCE(CAST(o.date AS text), 'N/A') AS date,
+       COALESCE(CAST(NULLIF(o.totalprice, 0) AS text), 'N/A') AS total,
+       COALESCE(NULLIF(r.name, ''), 'N/A') AS restaurant_name,
+       COALESCE(NULLIF(u.username, ''), 'N/A') AS username"""
+
+ORDER_SUMMARY_FROM = """
+FROM orders o
+LEFT JOIN restaurant r ON o.restaurantid = r.restaurantid
+LEFT JOIN users u ON o.userid = u.userid
+"""
+
+FIND_ORDER = text(ORDER_SUMMARY_SELECT + ORDER_SUMMARY_FROM + "WHERE o.orderid = :id;")
+
+# Order history is paged newest first on (date, orderid). Orders without a date
+# sort as -infinity, i.e. last, so the seek condition never has to deal with NULLs;
+# the orders_user_date index is built on the same expression.
+ORDER_SORT_DATE = "COALESCE(o.date, CAST('-infinity' AS timestamp))"
+
+USER_ORDERS_PAGE_QUERY = (ORDER_SUMMARY_SELECT + ", CAST(" + ORDER_SORT_DATE + " AS text) AS sort_date" + ORDER_SUMMARY_FROM
+	+ "WHERE o.userid = :user_id {seek}ORDER BY " + ORDER_SORT_DATE + " DESC, o.orderid DESC LIMIT :page_limit;")
+
+USER_ORDERS_FIRST_PAGE = text(USER_ORDERS_PAGE_QUERY.format(seek=""))
+
+USER_ORDERS_PAGE_AFTER = text(USER_ORDERS_PAGE_QUERY.format(
+	seek="AND (" + ORDER_SORT_DATE + ", o.orderid) < (CAST(:after_date AS timestamp), :after_id) "))
+
+ORDER_ITEM_SUMMARIES = text("""
+SELECT oi.orderid,
+       string_agg(oi.quantity || ' x ' || COALESCE(NULLIF(d.name, ''), 'N/A'), ', ' ORDER BY d.name) AS items
+FROM orderitem oi
+LEFT JOIN dish d ON oi.dishid = d.dishid
+WHERE oi.orderid = ANY(CAST(:order_ids AS integer[]))
+GROUP BY oi.orderid;
+""")
+
+# Favourite restaurant is the one ordered from most often, then the one spent most at
+USER_ORDER_STATS = text("""
+WITH per_restaurant AS (
+	SELECT restaurantid, COUNT(*) AS order_count, COALESCE(SUM(totalprice), 0) AS spend
+	FROM orders
+	WHERE userid = :user_id
+	GROUP BY restaurantid
+), favourite AS (
+	SELECT p.restaurantid, r.name
+	FROM per_restaurant p
+	JOIN restaurant r ON r.restaurantid = p.restaurantid
+	ORDER BY p.order_count DESC, p.spend DESC, p.restaurantid
+	LIMIT 1
+)
+SELECT CAST(COALESCE(SUM(p.order_count), 0) AS integer), CAST(COALESCE(SUM(p.spend), 0) AS float8),
+       (SELECT restaurantid FROM favourite), (SELECT name FROM favourite)
+FROM per_restaurant p;
+""")
+
+ORDER_OWNER = text("SELECT userid FROM orders WHERE orderid = :id;")
+
+ORDER_ITEMS = text("""
+SELECT oi.orderitemid, oi.dishid, oi.quantity, COALESCE(NULLIF(d.name, ''), 'N/A') AS dish_name
+FROM orderitem oi
+LEFT JOIN dish d ON oi.dishid = d.dishid
+WHERE oi.orderid = :id;
+""")
+
+ORDER_QUANTITIES = text("SELECT dishid, quantity FROM orderitem WHERE orderid = :id;")
+
+def user_orders_page(conn, user_id, limit, after=None):
+	"""
+	Returns up to limit of the user's orders, newest first, as a list of
+	(OrderSummary, sort_date) pairs. after is the (sort_date, orderid) of the
+	row the page starts after, as returned for the last row of the previous page.
+	"""
+	params = {'user_id': user_id, 'page_limit': limit}
+	statement = USER_ORDERS_FIRST_PAGE
+	if after:
+		statement = USER_ORDERS_PAGE_AFTER
+		params['after_date'], params['after_id'] = after
+	return [(OrderSummary._make(row[:7]), row[7]) for row in conn.execute(statement, params)]
+
+def order_item_summaries(conn, order_ids):
+	"""Returns {orderid: "2 x Dish, 1 x Other dish"} for a page of orders, in one query"""
+	if not order_ids:
+		return {}
+	return dict(conn.execute(ORDER_ITEM_SUMMARIES, {'order_ids': list(order_ids)}).fetchall())
+
+def user_order_stats(conn, user_id):
+	"""Returns the user's OrderStats"""
+	return OrderStats._make(conn.execute(USER_ORDER_STATS, {'user_id': user_id}).fetchone())
+
+def find_order(conn, order_id):
+	"""Returns the order's OrderSummary, or None if it doesn't exist"""
+	row = conn.execute(FIND_ORDER, {'id': order_id}).fetchone()
+	return OrderSummary._make(row) if row else None
+
+def order_owner(conn, order_id):
+	"""Returns the user ID an order belongs to, or None"""
+	return conn.execute(ORDER_OWNER, {'id': order_id}).scalar()
+
+def order_items(conn, order_id):
+	"""Returns the order's items as OrderItem rows"""
+	return list(map(OrderItem._make, conn.execute(ORDER_ITEMS, {'id': order_id})))
+
+def order_quantities(conn, order_id):
+	"""Returns {dish_id: quantity} for the order's items"""
+	return dict(conn.execute(ORDER_QUANTITIES, {'id': order_id}).fetchall())
+
+
+# Reviews, users and cuisines
+
+LIST_USER_REVIEWS = text("""
+SELECT r.reviewid, r.userid, r.restaurantid,
+       COALESCE(CAST(NULLIF(r.rating, 0) AS text), 'N/A') AS rating,
+       COALESCE(NULLIF(r.comment, ''), 'No text') AS text,
+       COALESCE(NULLIF(rest.name, ''), 'N/A') AS restaurant_name,
+       COALESCE(NULLIF(u.username, ''), 'N/A') AS username,
+       'N/A' AS date
+FROM review r
+LEFT JOIN restaurant rest ON r.restaurantid = rest.restaurantid
+LEFT JOIN users u ON r.userid = u.userid
+WHERE r.userid = :user_id
+ORDER BY r.reviewid DESC;
+""")
+
+LIST_USERS = text("SELECT userid, username FROM users ORDER BY username;")
+
+LIST_CUISINES = text("SELECT cuisineid, cuisinename FROM cuisine ORDER BY cuisinename;")
+
+def list_user_reviews(conn, user_id):
+	"""Returns the user's reviews as UserReview rows, newest first (there is no date column)"""
+	return list(map(UserReview._make, conn.execute(LIST_USER_REVIEWS, {'user_id': user_id})))
+
+def list_users(conn):
+	return list(map(UserRef._make, conn.execute(LIST_USERS)))
+
+def list_cuisines(conn):
+	return list(map(CuisineRef._make, conn.execute(LIST_CUISINES)))
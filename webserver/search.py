@@ -0,0 +1,188 @@
+"""
+In-process trigram index for searching restaurants by name.
+
+Names are split into trigrams the same way Postgres' pg_trgm does it (lowercased,
+each word padded with two spaces in front and one behind), and each trigram maps to
+the set of restaurants whose name contains it. A search looks up the trigrams of
+the search term and ranks restaurants by how many of them they share, so typos
+like "piza" still find "Pizza Palace" and a lookup never scans the whole table.
+"""
+import re
+import time
+import threading
+from collections import Counter
+
+
+def trigrams(value):
+	"""Returns the set of pg_trgm style trigrams for a string"""
+	result = set()
+	for word in re.findall(r'\w+', value.lower()):
+		padded = '  ' + word + ' '
+		for i in range(len(padded) - 2):
+			result.add(padded[i:i + 3])
+	return result
+
+
+class RestaurantSearchIndex:
+	"""
+	Trigram inverted index over restaurant names.
+
+	loader is called with no arguments and must return (restaurantid, name) rows
+	for every restaurant. The index is built from it on first use and rebuilt
+	every refresh_interval seconds, or after invalidate(), so changes made outside
+	the app are picked up eventually. add() and remove() keep it current.
+
+	Only one build runs at a time. The first one blocks searches until it is done;
+	after that a stale index is rebuilt on a background thread while searches keep
+	using the old one. An add() or remove() made while a build is loading is
+	replayed onto the new index, so it isn't lost when that replaces the old one.
+	"""
+	def __init__(self, loader, threshold=0.5, max_results=500, refresh_interval=600):
+		self.loader = loader
+		self.threshold = threshold
+		self.max_results = max_results
+		self.refresh_interval = refresh_interval
+		self._names = {}     # restaurantid -> lowercased name
+		self._grams = {}     # restaurantid -> set of trigrams
+		self._postings = {}  # trigram -> set of restaurantids
+		self._built_at = None
+		self.ready = False       # whether a build has ever finished
+		self._building = False
+		self._changes = None     # (method, args) of each add/remove made during a build
+		self._invalidations = 0  # invalidate() calls so far
+		self._lock = threading.RLock()
+		self._built = threading.Condition(self._lock)
+
+	def build(self):
+		"""(Re)builds the whole index from the loader, unless another build is already running"""
+		with self._lock:
+			if self._building:
+				return
+			invalidations = self._claim()
+		self._load(invalidations)
+
+	def _claim(self):
+		"""Marks a build as running and starts recording changes. Call with the lock held."""
+		self._building = True
+		self._changes = []
+		return self._invalidations
+
+	def _load(self, invalidations):
+		try:
+			names, grams, postings = {}, {}, {}
+			for restaurant_id, name in self.loader():
+				names[restaurant_id] = (name or '').lower()
+				grams[restaurant_id] = trigrams(name or '')
+				for gram in grams[restaurant_id]:
+					postings.setdefault(gram, set()).add(restaurant_id)
+			with self._lock:
+				self._names, self._grams, self._postings = names, grams, postings
+				for method, args in self._changes:
+					method(*args)
+				self.ready = True
+				# Invalidated while loading: the rows may predate what it was for
+				self._built_at = time.monotonic() if self._invalidations == invalidations else None
+		finally:
+			with self._lock:
+				self._building = False
+				self._changes = None
+				self._built.notify_all()
+
+	def ensure_built(self):
+		"""
+		Builds the index if it has never been built, waiting for a build another
+		thread already started. Starts a background rebuild if it is stale.
+		"""
+		with self._lock:
+			while not self.ready and self._building:
+				self._built.wait()
+			if self.ready:
+				stale = self._built_at is None or time.monotonic() - self._built_at > self.refresh_interval
+				if stale and not self._building:
+					threading.Thread(target=self._rebuild, args=(self._claim(),),
+					                 name='search-index', daemon=True).start()
+				return
+		self.build()
+
+	def _rebuild(self, invalidations):
+		try:
+			self._load(invalidations)
+		except Exception as e:
+			print(f"Could not rebuild search index: {e}")
+
+	def invalidate(self):
+		"""Rebuilds the whole index on the next search"""
+		with self._lock:
+			self._built_at = None
+			self._invalidations += 1
+
+	def add(self, restaurant_id, name):
+		"""Adds or renames a restaurant"""
+		with self._lock:
+			self._add(restaurant_id, name)
+			if self._changes is not None:
+				self._changes.append((self._add, (restaurant_id, name)))
+
+	def remove(self, restaurant_id):
+		with self._lock:
+			self._remove(restaurant_id)
+			if self._changes is not None:
+				self._changes.append((self._remove, (restaurant_id,)))
+
+	def _add(self, restaurant_id, name):
+		self._remove(restaurant_id)
+		self._names[restaurant_id] = (name or '').lower()
+		self._grams[restaurant_id] = trigrams(name or '')
+		for gram in self._grams[restaurant_id]:
+			self._postings.setdefault(gram, set()).add(restaurant_id)
+
+	def _remove(self, restaurant_id):
+		self._names.pop(restaurant_id, None)
+		for gram in self._grams.pop(restaurant_id, ()):
+			ids = self._postings.get(gram)
+			if ids is not None:
+				ids.discard(restaurant_id)
+				if not ids:
+					del self._postings[gram]
+
+	def search(self, term, capped=True):
+		"""
+		Returns restaurant IDs matching term, best match first: at most max_results
+		of them, or all of them if not capped (when the caller filters them further).
+		Names containing the term itself always match and rank first. Otherwise a
+		restaurant matches if it shares at least threshold of the term's trigrams;
+		ties are broken by overall name similarity so shorter, closer names win.
+		"""
+		self.ensure_built()
+		term = term.strip().lower()
+		if not term:
+			return []
+		query_grams = trigrams(term)
+
+		with self._lock:
+			shared = Counter()
+			for gram in query_grams:
+				for restaurant_id in self._postings.get(gram, ()):
+					shared[restaurant_id] += 1
+
+			# Terms too short to have trigrams in the middle of a word (like "iz")
+			# can still be found as plain substrings
+			if len(term) < 3:
+				for restaurant_id, name in self._names.items():
+					if term in name and restaurant_id not in shared:
+						shared[restaurant_id] = 0
+
+			scored = []
+			for restaurant_id, count in shared.items():
+				substring = term in self._names[restaurant_id]
+				coverage = count / len(query_grams) if query_grams else 0.0
+				if not substring and coverage < self.threshold:
+					continue
+				union = len(query_grams) + len(self._grams[restaurant_id]) - count
+				similarity = count / union if union else 0.0
+				scored.append((not substring, -coverage, -similarity, restaurant_id))
+
+		scored.sort()
+		if capped:
+			scored = scored[:self.max_results]
+		return [entry[3] for entry in scored]
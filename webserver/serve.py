@@ -0,0 +1,187 @@
+"""
+Production server: the app on gunicorn, with worker processes forked from a
+master that has already imported it.
+
+	python serve.py start     # run in the foreground
+	python serve.py reload    # switch a running server to the current code
+
+server.py's own __main__ runs Werkzeug's development server in a single process,
+which keeps only one core busy. Here each core gets a worker process (gunicorn's
+gthread worker, with worker_threads() threads each), all accepting from the same socket.
+
+The master imports server.py (loading the recommendation model) and compiles every
+template before forking (preload_app), so workers start with all of that in place
+instead of each doing it on its first requests. Database connections are not
+shared: server.reset_after_fork drops the pooled connections a worker inherits.
+
+reload starts a second master on the new code next to the running one (USR2),
+waits for it to come up, then stops the old one gracefully (TERM): the old
+workers finish the requests they have while the new workers take every new
+connection from the shared socket, so no request is dropped. If the new code
+fails to import, the new master exits and the old one keeps serving. (HUP also
+restarts the workers gracefully, but with preload_app they keep the old code.)
+
+Needs gunicorn (pip install gunicorn). Settings can be overridden with
+environment variables, e.g. WEB_WORKERS=8 python serve.py start
+"""
+import os
+import time
+import signal
+
+import click
+
+
+def available_cores():
+	"""Cores this process may run on, which can be fewer than the machine has (containers, taskset)"""
+	try:
+		return len(os.sched_getaffinity(0))
+	except AttributeError:  # not available on macOS
+		return os.cpu_count() or 1
+
+#
+# Serving settings. Each worker holds up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections
+# (see server.py), so Postgres sees at most WEB_WORKERS times that, plus one listener
+# connection per worker for cache invalidation.
+#
+WEB_BIND = os.environ.get('WEB_BIND', '0.0.0.0:8111')
+WEB_WORKERS = int(os.environ.get('WEB_WORKERS', available_cores()))  # one per core
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 0))                    # requests each worker handles at once (see worker_threads)
+WEB_TIMEOUT = int(os.environ.get('WEB_TIMEOUT', 60))                   # seconds before a stuck worker is restarted
+WEB_GRACEFUL_TIMEOUT = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30)) # seconds a stopping worker gets to finish its requests
+WEB_PIDFILE = os.environ.get('WEB_PIDFILE',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.pid'))
+
+
+def warm_up(server):
+	"""
+	Does the work every worker would otherwise repeat, once, in the master. The
+	search index isn't built here: each worker drops its caches when its invalidation
+	listener connects, so it would be thrown away again.
+	"""
+	server.require_schema()
+	for name in server.app.jinja_env.list_templates():
+		server.app.jinja_env.get_template(name)
+
+
+def post_fork(arbiter, worker):
+	"""Subscribes a new worker to cache invalidations before it takes any requests"""
+	import server
+	if server.CACHE_INVALIDATION:
+		server.invalidation_bus.start()
+
+
+def worker_threads(server):
+	"""
+	Threads per worker. With admission control on, every request the controller has
+	admitted or queued needs a thread, so a worker gets max_in_flight + max_queued:
+	with fewer, the overflow waits in gunicorn's connection backlog, where it can't
+	be put in priority order or turned away with a 503 (see admission.py). A
+	WEB_THREADS below that lowers the controller's limits to fit instead.
+	"""
+	if not server.ADMISSION_CONTROL:
+		# More threads than a worker's pool can give connections to would only wait in the pool
+		return max(1, min(WEB_THREADS or 4, server.DB_POOL_SIZE + server.DB_MAX_OVERFLOW))
+	admission = server.admission
+	threads = max(1, WEB_THREADS or admission.max_in_flight + admission.max_queued)
+	admission.max_in_flight = max(1, min(admission.max_in_flight, threads))
+	admission.max_queued = max(0, min(admission.max_queued, threads - admission.max_in_flight))
+	return threads
+
+
+def gunicorn_options(bind):
+	import server
+	threads = worker_threads(server)
+	return {
+		'bind': bind,
+		'workers': WEB_WORKERS,
+		'worker_class': 'gthread',
+		'threads': threads,
+		'preload_app': True,
+		'timeout': WEB_TIMEOUT,
+		'graceful_timeout': WEB_GRACEFUL_TIMEOUT,
+		'keepalive': 5,
+		'pidfile': WEB_PIDFILE,
+		'accesslog': '-',
+		'post_fork': post_fork,
+	}
+
+
+def read_pid(path):
+	try:
+		with open(path) as f:
+			return int(f.read().strip())
+	except (OSError, ValueError):
+		return None
+
+
+def is_running(pid):
+	try:
+		os.kill(pid, 0)
+		return True
+	except OSError:
+		return False
+
+
+@click.group()
+def cli():
+	"""Run the app on gunicorn"""
+
+
+@cli.command()
+@click.option('--bind', default=WEB_BIND, help='Address to listen on, host:port')
+def start(bind):
+	"""Start the server in the foreground"""
+	from gunicorn.app.base import BaseApplication
+
+	class ProductionServer(BaseApplication):
+		def __init__(self, options):
+			self.options = options
+			super().__init__()
+
+		def load_config(self):
+			for key, value in self.options.items():
+				self.cfg.set(key, value)
+
+		def load(self):
+			import server
+			warm_up(server)
+			return server.app
+
+	options = gunicorn_options(bind)
+	print("%d workers x %d threads on %s" % (options['workers'], options['threads'], bind))
+	ProductionServer(options).run()
+
+
+@cli.command()
+@click.option('--pidfile', default=WEB_PIDFILE, help="The running server's pidfile")
+@click.option('--timeout', default=60, type=int, help='Seconds to wait for the new server to start')
+@click.option('--settle', default=2.0, type=float, help='Seconds to give the new workers before stopping the old ones')
+def reload(pidfile, timeout, settle):
+	"""Replace a running server with one on the current code, without dropping requests"""
+	old_pid = read_pid(pidfile)
+	if old_pid is None or not is_running(old_pid):
+		raise click.ClickException("no server running with pidfile %s" % pidfile)
+
+	os.kill(old_pid, signal.SIGUSR2)
+	# The old master moves its pidfile aside and the new one writes its own once
+	# the app has been imported, so a new pid there means the new code loaded
+	deadline = time.monotonic() + timeout
+	new_pid = None
+	while time.monotonic() < deadline:
+		pid = read_pid(pidfile)
+		if pid and pid != old_pid and is_running(pid):
+			new_pid = pid
+			break
+		time.sleep(0.2)
+	if new_pid is None:
+		raise click.ClickException("new server didn't start within %ds; the old one (pid %d) is still serving" % (timeout, old_pid))
+
+	time.sleep(settle)
+	if not is_running(new_pid):
+		raise click.ClickException("new server (pid %d) exited; the old one (pid %d) is still serving" % (new_pid, old_pid))
+	os.kill(old_pid, signal.SIGTERM)
+	print("reloaded: pid %d is stopping gracefully, pid %d is serving" % (old_pid, new_pid))
+
+
+if __name__ == "__main__":
+	cli()
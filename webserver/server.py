@@ -5,14 +5,44 @@ Example Webserver
 To run locally:
     python server.py
 Go to http://localhost:8111 in your browser.
+In production, run it on gunicorn with: python serve.py start
 A debugger such as "pdb" may be helpful for debugging.
 Read about it online.
 """
 import os
+import io
+import time
+import csv
+import json
+import math
+import base64
+import random
+import functools
+from datetime import datetime, timezone
+from urllib.parse import urlencode
 # accessible as a variable in index.html:
 from sqlalchemy import *
-from sqlalchemy.pool import NullPool
-from flask import Flask, request, render_template, g, redirect, Response, abort, session
+from sqlalchemy import event
+from sqlalchemy.pool import NullPool, QueuePool
+from flask import Flask, request, render_template, g, redirect, Response, abort, session, has_request_context, make_response
+from flask import before_render_template, template_rendered
+from flask.ctx import _AppCtxGlobals
+from jinja2 import FileSystemBytecodeCache
+import metrics
+import repository
+from cache import TTLCache, SingleFlight
+from search import RestaurantSearchIndex
+from stats import STATS_COLUMNS, record_review, record_order
+from migrations import missing_tables
+from dish_import import import_dishes, csv_lines
+from fragments import FragmentCacheExtension
+from versions import DataVersions, LOAD_VERSIONS_QUERY
+from invalidation import Change, InvalidationBus, ANY_TABLE
+from admission import AdmissionController, Overloaded, WRITE, USER, ANONYMOUS
+try:
+	from recommend import Recommender
+except ImportError:  # numpy/scipy not installed; the pages just leave recommendations out
+	Recommender = None
 
 tmpl_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 app = Flask(__name__, template_folder=tmpl_dir)
@@ -35,12 +65,178 @@ DATABASE_USERNAME = "jcw2239"
 DATABASE_PASSWRD = "047453"
 DATABASE_HOST = "34.139.8.30"
 DATABASEURI = f"postgresql://{DATABASE_USERNAME}:{DATABASE_PASSWRD}@{DATABASE_HOST}/proj1part2"
+# Point the app at another database (e.g. a local one seeded by benchmarks/seed.py)
+DATABASEURI = os.environ.get('DATABASEURI', DATABASEURI)
+DATABASE_SCHEMA = "jcw2239"
 
+#
+# Connection pool settings. Each can be overridden with an environment variable,
+# e.g. DB_POOL_SIZE=10 python server.py
+#
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))          # connections kept open in the pool
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))   # extra connections allowed under load
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 30))   # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800)) # seconds before a connection is replaced
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') != '0'  # test connections on checkout
+
+#
+# Read replicas, as comma-separated URIs. GET requests read from one of them while
+# the write routes use DATABASEURI; with none set, everything uses DATABASEURI.
+# For READ_YOUR_WRITES_WINDOW seconds after a session writes, its reads stay on the
+# primary too, so it never sees a replica that hasn't caught up with its own write.
+#
+DATABASE_REPLICA_URIS = [uri.strip() for uri in os.environ.get('DATABASE_REPLICA_URIS', '').split(',') if uri.strip()]
+READ_YOUR_WRITES_WINDOW = float(os.environ.get('READ_YOUR_WRITES_WINDOW', 10))
+
+#
+# Restaurant directory paging. ?per_page= can ask for a different page size, up to the max.
+#
+RESTAURANTS_PAGE_SIZE = int(os.environ.get('RESTAURANTS_PAGE_SIZE', 25))
+RESTAURANTS_MAX_PAGE_SIZE = int(os.environ.get('RESTAURANTS_MAX_PAGE_SIZE', 100))
+RESTAURANTS_COUNT_ESTIMATE = os.environ.get('RESTAURANTS_COUNT_ESTIMATE', '1') != '0'  # show "about N results"
+RESTAURANTS_COUNT_ESTIMATE_TTL = int(os.environ.get('RESTAURANTS_COUNT_ESTIMATE_TTL', 60))     # seconds an estimate is reused
+RESTAURANTS_COUNT_ESTIMATE_CACHE_SIZE = int(os.environ.get('RESTAURANTS_COUNT_ESTIMATE_CACHE_SIZE', 1000))
+
+# Order history paging, and how long each user's order totals are cached for
+ORDERS_PAGE_SIZE = int(os.environ.get('ORDERS_PAGE_SIZE', 20))
+ORDER_STATS_TTL = int(os.environ.get('ORDER_STATS_TTL', 600))
+ORDER_STATS_CACHE_SIZE = int(os.environ.get('ORDER_STATS_CACHE_SIZE', 10000))
+
+# Seconds the directory's filter dropdown options are cached for
+FILTER_OPTIONS_TTL = int(os.environ.get('FILTER_OPTIONS_TTL', 300))
+
+# Seconds a user's role is trusted before it is checked against the database again,
+# and how many users' roles are kept
+ROLE_CACHE_TTL = int(os.environ.get('ROLE_CACHE_TTL', 60))
+ROLE_CACHE_SIZE = int(os.environ.get('ROLE_CACHE_SIZE', 10000))
+
+#
+# Restaurant name search (see search.py)
+#
+SEARCH_SIMILARITY_THRESHOLD = float(os.environ.get('SEARCH_SIMILARITY_THRESHOLD', 0.5))  # share of the term's trigrams a name needs
+SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 500))
+SEARCH_INDEX_REFRESH = int(os.environ.get('SEARCH_INDEX_REFRESH', 600))  # seconds between full rebuilds
+
+# Rows fetched from the server-side cursor at a time when exporting orders
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 2000))
+
+# Model built by "python recommend.py build", and how many recommendations each page shows
+RECOMMENDATIONS_FILE = os.environ.get('RECOMMENDATIONS_FILE',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recommendations.pickle'))
+ALSO_ORDERED_SHOWN = int(os.environ.get('ALSO_ORDERED_SHOWN', 3))
+RECOMMENDED_RESTAURANTS_SHOWN = int(os.environ.get('RECOMMENDED_RESTAURANTS_SHOWN', 5))
+
+#
+# Template rendering. Compiled templates are saved in TEMPLATE_BYTECODE_DIR so a
+# new worker loads bytecode instead of compiling every template again, and
+# {% cache %} fragments (see fragments.py) are kept for FRAGMENT_CACHE_TTL seconds.
+#
+TEMPLATE_BYTECODE_DIR = os.environ.get('TEMPLATE_BYTECODE_DIR',
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__', 'templates'))
+FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL', 300))
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 500))
+
+#
+# Conditional GETs on the catalog pages (see versions.py). Browsers and proxies may
+# reuse an anonymous catalog page for CATALOG_MAX_AGE seconds before revalidating,
+# and ETags roll over every ETAG_REFRESH_INTERVAL seconds to pick up changes made
+# outside the app.
+#
+CATALOG_MAX_AGE = int(os.environ.get('CATALOG_MAX_AGE', 30))
+ETAG_REFRESH_INTERVAL = int(os.environ.get('ETAG_REFRESH_INTERVAL', 300))
+
+#
+# Request coalescing on the directory and restaurant details pages. Identical
+# requests that arrive while one is already loading wait up to COALESCE_WAIT
+# seconds for its result, then give up and run the queries themselves.
+#
+COALESCE_LOADS = os.environ.get('COALESCE_LOADS', '1') != '0'
+COALESCE_WAIT = float(os.environ.get('COALESCE_WAIT', 5))
+
+#
+# Cache invalidation between server processes (see invalidation.py). Changes are
+# sent on CACHE_INVALIDATION_CHANNEL through the primary; set CACHE_INVALIDATION=0
+# when only one process serves the app.
+#
+CACHE_INVALIDATION = os.environ.get('CACHE_INVALIDATION', '1') != '0'
+CACHE_INVALIDATION_CHANNEL = os.environ.get('CACHE_INVALIDATION_CHANNEL', 'cache_invalidation')
+
+#
+# Admission control (see admission.py). By default a process runs as many requests
+# at once as its pool has connections; up to ADMISSION_MAX_QUEUED more wait up to
+# ADMISSION_QUEUE_TIMEOUT seconds for a turn, and the rest get a 503 asking them
+# to retry after ADMISSION_RETRY_AFTER seconds. While pool checkouts take longer
+# than ADMISSION_MAX_CHECKOUT_WAIT seconds on average, only writes may queue.
+#
+ADMISSION_CONTROL = os.environ.get('ADMISSION_CONTROL', '1') != '0'
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', DB_POOL_SIZE + DB_MAX_OVERFLOW))
+ADMISSION_MAX_QUEUED = int(os.environ.get('ADMISSION_MAX_QUEUED', 50))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 2))
+ADMISSION_MAX_CHECKOUT_WAIT = float(os.environ.get('ADMISSION_MAX_CHECKOUT_WAIT', 0.25))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 2))
+
+os.makedirs(TEMPLATE_BYTECODE_DIR, exist_ok=True)
+app.jinja_options = dict(app.jinja_options,
+	bytecode_cache=FileSystemBytecodeCache(TEMPLATE_BYTECODE_DIR),
+	extensions=[FragmentCacheExtension])
+
+
+def make_engine(uri):
+	"""Creates an engine with the pool settings above"""
+	return create_engine(
+		uri,
+		poolclass=QueuePool,
+		pool_size=DB_POOL_SIZE,
+		max_overflow=DB_MAX_OVERFLOW,
+		pool_timeout=DB_POOL_TIMEOUT,
+		pool_recycle=DB_POOL_RECYCLE,
+		pool_pre_ping=DB_POOL_PRE_PING
+	)
 
 #
 # This line creates a database engine that knows how to connect to the URI above.
+# Connections are pooled, so a request reuses an already open Postgres backend
+# instead of opening a new one every time. Each replica gets a pool of its own.
 #
-engine = create_engine(DATABASEURI)
+engine = make_engine(DATABASEURI)
+replica_engines = [make_engine(uri) for uri in DATABASE_REPLICA_URIS]
+
+# Pool names used in the metrics
+ENGINE_NAMES = {engine: 'primary'}
+ENGINE_NAMES.update((replica, 'replica%d' % i) for i, replica in enumerate(replica_engines))
+
+
+def set_search_path(dbapi_connection, connection_record):
+	"""
+	Runs once for every new physical connection the pool opens, so routes
+	no longer need to run SET search_path themselves.
+	SET is transactional in Postgres, so it is run in autocommit mode to keep
+	the pool's rollback-on-return from undoing it.
+	"""
+	existing_autocommit = dbapi_connection.autocommit
+	dbapi_connection.autocommit = True
+	cursor = dbapi_connection.cursor()
+	cursor.execute(f"SET search_path TO {DATABASE_SCHEMA}, public")
+	cursor.close()
+	dbapi_connection.autocommit = existing_autocommit
+
+def set_read_only(dbapi_connection, connection_record):
+	"""
+	Makes every transaction on a replica connection read-only, so a write that
+	gets routed to a replica by mistake fails instead of going unnoticed when the
+	"replica" is really a second writable server (as in local testing).
+	"""
+	existing_autocommit = dbapi_connection.autocommit
+	dbapi_connection.autocommit = True
+	cursor = dbapi_connection.cursor()
+	cursor.execute("SET default_transaction_read_only = on")
+	cursor.close()
+	dbapi_connection.autocommit = existing_autocommit
+
+for db_engine in ENGINE_NAMES:
+	event.listen(db_engine, "connect", set_search_path)
+for replica in replica_engines:
+	event.listen(replica, "connect", set_read_only)
 
 #
 # Example of running queries in your database
@@ -60,32 +256,282 @@ engine = create_engine(DATABASEURI)
 # 	# engine.begin() automatically commits when the context exits
 
 
-@app.before_request
-def before_request():
+# Routes marked with @uses_primary. All their queries, including the GET that
+# shows the form, go to the primary.
+PRIMARY_ENDPOINTS = set()
+
+def uses_primary(view):
+	"""Marks a route that writes to the database"""
+	PRIMARY_ENDPOINTS.add(view.__name__)
+	return view
+
+def recent_write(session):
+	"""True if the session wrote something in the last READ_YOUR_WRITES_WINDOW seconds"""
+	return time.time() - session.get('last_write', 0) < READ_YOUR_WRITES_WINDOW
+
+def pick_replica():
+	"""A replica engine chosen at random, or the primary if there are no replicas"""
+	return random.choice(replica_engines) if replica_engines else engine
+
+def read_engine():
+	"""The engine this request's session should read from"""
+	if recent_write(session) or g.get('_read_primary', False):
+		return engine
+	return pick_replica()
+
+def request_engine():
+	"""The primary for writes and for sessions that just wrote, otherwise a replica"""
+	if reads_primary():
+		return engine
+	return pick_replica()
+
+def reads_primary():
+	"""True if the current request's queries go to the primary"""
+	if not replica_engines:
+		return True
+	if not has_request_context():
+		return False
+	return (request.method not in ('GET', 'HEAD') or request.endpoint in PRIMARY_ENDPOINTS
+	        or recent_write(session) or g.get('_read_primary', False))
+
+def replicas_may_lag():
+	"""True if a replica might still be missing a change this process has applied"""
+	return bool(replica_engines) and time.time() - data_versions.last_bump < READ_YOUR_WRITES_WINDOW
+
+def may_fill_shared_caches():
+	"""
+	Whether what the current request read may be stored in the caches every session
+	shares. Not if it read from a replica shortly after a change: the entry would
+	outlive the replica's lag and be served stale for its whole TTL, even to the
+	session that made the change.
 	"""
-	This function is run at the beginning of every web request 
-	(every time you enter an address in the web browser).
-	We use it to setup a database connection that can be used throughout the request.
+	return reads_primary() or not replicas_may_lag()
+
+
+class DatabaseUnavailable(Exception):
+	"""Raised by get_db when no connection could be had; the request is answered with 503"""
+
 
-	The variable g is globally accessible.
+def get_db():
 	"""
-	try:
-		g.conn = engine.connect()
-	except:
-		print("uh oh, problem connecting to database")
-		import traceback; traceback.print_exc()
-		g.conn = None
+	Returns the database connection for the current request, checking one out
+	of the pool the first time it is needed. Requests that never touch the
+	database (redirects, logout, static files) never take a connection.
+	Raises DatabaseUnavailable if the database can't be reached.
+	"""
+	if '_db_conn' not in g:
+		started = time.perf_counter()
+		try:
+			g._db_conn = request_engine().connect()
+		except:
+			print("uh oh, problem connecting to database")
+			import traceback; traceback.print_exc()
+			g._db_conn = None
+			ERRORS.inc(request.endpoint or 'not_found', 'db_connect')
+		waited = time.perf_counter() - started
+		POOL_CHECKOUT_TIME.observe(waited)
+		admission.observe_checkout(waited)
+	if g._db_conn is None:
+		raise DatabaseUnavailable()
+	return g._db_conn
+
+
+class LazyConnGlobals(_AppCtxGlobals):
+	"""
+	Flask's g object, except g.conn is only connected when a route first uses it.
+	"""
+	def __getattr__(self, name):
+		if name == 'conn':
+			return get_db()
+		return super().__getattr__(name)
+
+app.app_ctx_globals_class = LazyConnGlobals
+
+
+@app.after_request
+def start_read_your_writes_window(response):
+	"""After a successful write, keeps the session's reads on the primary for a while"""
+	if request.method == 'POST' and request.endpoint in PRIMARY_ENDPOINTS and response.status_code < 400:
+		session['last_write'] = time.time()
+	return response
 
 @app.teardown_request
 def teardown_request(exception):
 	"""
-	At the end of the web request, this makes sure to close the database connection.
-	If you don't, the database could run out of memory!
+	At the end of the web request, this returns the database connection to the pool
+	(if the request used one). If you don't, the pool will run out of connections!
 	"""
+	conn = g.pop('_db_conn', None)
+	if conn is not None:
+		try:
+			conn.close()
+		except Exception as e:
+			pass
+	# Only now, with its connection back in the pool, let the next request in
+	if g.pop('_admitted', False):
+		admission.release()
+
+
+#
+# Metrics, served in Prometheus text format on /metrics (see metrics.py).
+# Each server process keeps its own numbers.
+#
+REQUEST_LATENCY = metrics.Histogram('http_request_duration_seconds', 'Time to handle a request, by endpoint', ['endpoint', 'method'])
+REQUESTS = metrics.Counter('http_requests_total', 'Requests handled, by endpoint and status', ['endpoint', 'method', 'status'])
+ERRORS = metrics.Counter('app_errors_total', 'Unhandled exceptions and database connection failures', ['endpoint', 'type'])
+REQUEST_DB_TIME = metrics.Histogram('db_time_per_request_seconds', 'Time spent executing SQL during a request', ['endpoint'])
+REQUEST_DB_QUERIES = metrics.Histogram('db_queries_per_request', 'SQL statements executed during a request', ['endpoint'],
+                                       buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+DB_STATEMENTS = metrics.Counter('db_statements_total', 'SQL statements executed, by pool', ['pool'])
+POOL_CHECKOUT_TIME = metrics.Histogram('db_pool_checkout_seconds', 'Time waiting for a connection from the pool')
+TEMPLATE_RENDER_TIME = metrics.Histogram('template_render_seconds', 'Time to render a Jinja template', ['template'])
+
+def pool_connections():
+	counts = {}
+	for db_engine, name in ENGINE_NAMES.items():
+		counts[(name, 'checked_out')] = db_engine.pool.checkedout()
+		counts[(name, 'idle')] = db_engine.pool.checkedin()
+		counts[(name, 'overflow')] = max(db_engine.pool.overflow(), 0)
+	return counts
+
+metrics.CallbackMetric('db_pool_connections', 'Connections in each pool by state', 'gauge', ['pool', 'state'], pool_connections)
+
+metrics.CallbackMetric('admission_requests', 'Requests running and waiting to be admitted', 'gauge', ['state'],
+	lambda: {(state,): admission.stats()[state] for state in ('in_flight', 'queued')})
+metrics.CallbackMetric('admission_shed_total', 'Requests turned away with 503 by admission control, by priority', 'counter',
+	['priority'], lambda: {(priority,): count for priority, count in admission.stats()['shed'].items()})
+metrics.CallbackMetric('db_pool_checkout_wait_average_seconds', 'Moving average of pool checkout waits, as seen by admission control',
+	'gauge', [], lambda: {(): admission.stats()['checkout_wait']})
+
+
+def cache_stats():
+	"""Every in-process cache by name, for the cache metrics"""
+	return {
+		'filter_options': filter_options_cache.stats(),
+		'role': role_cache.stats(),
+		'fragments': fragment_cache.stats(),
+		'order_stats': order_stats_cache.stats(),
+		'count_estimates': count_estimate_cache.stats()
+	}
+
+metrics.CallbackMetric('cache_hits_total', 'Cache lookups that found a value', 'counter', ['cache'],
+	lambda: {(name,): stats['hits'] for name, stats in cache_stats().items()})
+metrics.CallbackMetric('cache_misses_total', 'Cache lookups that had to load the value', 'counter', ['cache'],
+	lambda: {(name,): stats['misses'] for name, stats in cache_stats().items()})
+metrics.CallbackMetric('cache_entries', 'Entries currently cached', 'gauge', ['cache'],
+	lambda: {(name,): stats['size'] for name, stats in cache_stats().items()})
+metrics.CallbackMetric('cache_invalidations_total', 'Change notices published to and received from other server processes', 'counter',
+	['direction'], lambda: {(name,): count for name, count in invalidation_bus.stats().items() if name != 'connects'})
+metrics.CallbackMetric('coalesced_loads_total',
+	'Directory and restaurant page loads, by whether they ran, shared a load in progress, or gave up waiting for one',
+	'counter', ['outcome'], lambda: {(outcome,): count for outcome, count in page_loads.stats().items() if outcome != 'in_progress'})
+
+
+# The start time goes on the statement's execution context, which is dropped with it
+# when the statement fails, rather than on the connection, which outlives the request
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	context._query_started = time.perf_counter()
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+	elapsed = time.perf_counter() - context._query_started
+	DB_STATEMENTS.inc(ENGINE_NAMES.get(conn.engine, 'other'))
+	if has_request_context():
+		g._db_time = g.get('_db_time', 0.0) + elapsed
+		g._db_queries = g.get('_db_queries', 0) + 1
+
+for db_engine in ENGINE_NAMES:
+	event.listen(db_engine, "before_cursor_execute", before_cursor_execute)
+	event.listen(db_engine, "after_cursor_execute", after_cursor_execute)
+
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+	g._render_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def stop_template_timer(sender, template, context, **extra):
+	started = g.pop('_render_started', None)
+	if started is not None:
+		TEMPLATE_RENDER_TIME.observe(time.perf_counter() - started, template.name or 'unknown')
+
+
+@app.before_request
+def start_request_timer():
+	g._request_started = time.perf_counter()
+
+@app.after_request
+def remember_response_status(response):
+	g._response_status = response.status_code
+	return response
+
+@app.teardown_request
+def record_request_metrics(exception):
+	started = g.pop('_request_started', None)
+	if started is None:
+		return
+	endpoint = request.endpoint or 'not_found'
+	status = g.get('_response_status', 500)
+	REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint, request.method)
+	REQUESTS.inc(endpoint, request.method, str(status))
+	REQUEST_DB_TIME.observe(g.get('_db_time', 0.0), endpoint)
+	REQUEST_DB_QUERIES.observe(g.get('_db_queries', 0), endpoint)
+	if exception is not None:
+		ERRORS.inc(endpoint, type(exception).__name__)
+
+
+# Admission control: how many requests this process runs at once, and who waits
+# or is turned away when there are more (see admission.py)
+admission = AdmissionController(
+	max_in_flight=ADMISSION_MAX_IN_FLIGHT,
+	max_queued=ADMISSION_MAX_QUEUED,
+	queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+	max_checkout_wait=ADMISSION_MAX_CHECKOUT_WAIT
+)
+
+# Always let these through, so monitoring still works under overload
+ADMISSION_EXEMPT = {'metrics_endpoint', 'static'}
+
+def service_unavailable(message):
+	"""A fast 503 telling the client when to try again"""
+	return Response(message, status=503, headers={'Retry-After': str(ADMISSION_RETRY_AFTER)})
+
+def request_priority():
+	"""Writes (including logging in) first, then logged-in users, then anonymous browsing"""
+	if request.method not in ('GET', 'HEAD'):
+		return WRITE
+	if 'user_id' in session:
+		return USER
+	return ANONYMOUS
+
+@app.before_request
+def admit_request():
+	if not ADMISSION_CONTROL or request.endpoint in ADMISSION_EXEMPT:
+		return None
 	try:
-		g.conn.close()
-	except Exception as e:
-		pass
+		admission.admit(request_priority())
+	except Overloaded:
+		return service_unavailable("The server is busy. Please try again in a moment.")
+	g._admitted = True
+	return None
+
+@app.errorhandler(DatabaseUnavailable)
+def database_unavailable(error):
+	return service_unavailable("Database unavailable. Please try again later.")
+
+@app.after_request
+def report_database_unavailable(response):
+	"""
+	Routes that catch every exception would otherwise answer a failed connection
+	with an error page or an empty listing; answer 503 for them too.
+	"""
+	if g.get('_db_conn', False) is None and response.status_code != 503:
+		return service_unavailable("Database unavailable. Please try again later.")
+	return response
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+	return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 #
@@ -106,80 +552,355 @@ def index():
 	# Redirect to restaurant directory as the main landing page
 	return redirect('/restaurants')
 
-#
-# This is an example of a different path.  You can see it at:
-# 
-#     localhost:8111/another
-#
-# Notice that the function name is another() rather than index()
-# The functions for each app.route need to have different names
-#
-# View all restaurants with search/filter functionality
-@app.route('/restaurants')
-def restaurants():
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
+# Helper functions for the directory's keyset pagination cursors.
+# A cursor is the (sort key, restaurantid) of the row a page starts after or ends before,
+# encoded so it can be passed around in a URL. The sort key is the name, or the
+# search rank when the results are ordered by relevance.
+def encode_cursor(sort_key, restaurant_id):
+	raw = json.dumps([sort_key, restaurant_id]).encode('utf-8')
+	return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor_str, key_type=str):
+	"""Returns (sort_key, restaurantid) or None if the cursor is missing or malformed"""
+	if not cursor_str:
+		return None
+	try:
+		sort_key, restaurant_id = json.loads(base64.urlsafe_b64decode(cursor_str.encode('ascii')))
+		return key_type(sort_key), int(restaurant_id)
+	except Exception:
+		return None
+
+
+def estimate_row_count(conn, query, params):
+	"""
+	Returns the planner's row estimate for a query. This is much cheaper than
+	COUNT(*) on a large table, but only approximate.
+	"""
+	cursor = conn.execute(text("EXPLAIN (FORMAT JSON) " + query), params)
+	plan = cursor.scalar()
+	cursor.close()
+	if isinstance(plan, str):
+		plan = json.loads(plan)
+	return int(plan[0]['Plan']['Plan Rows'])
+
+
+def load_restaurant_names():
+	"""Returns (restaurantid, name) rows for building the search index"""
+	# Right after a change a replica may not have it, and the rebuilt index would drop it
+	with (engine if replicas_may_lag() else pick_replica()).connect() as conn:
+		return conn.execute(text("SELECT restaurantid, name FROM restaurant;")).fetchall()
+
+# Restaurant name search. Built on first use, kept current by add_restaurant and
+# delete_restaurant, and fully rebuilt in the background every SEARCH_INDEX_REFRESH seconds.
+restaurant_search = RestaurantSearchIndex(
+	load_restaurant_names,
+	threshold=SEARCH_SIMILARITY_THRESHOLD,
+	max_results=SEARCH_MAX_RESULTS,
+	refresh_interval=SEARCH_INDEX_REFRESH
+)
+
+
+def load_recommender():
+	"""
+	Loads the saved recommendation model, or starts an empty one that fills up from
+	new orders if none has been built yet. Returns None without numpy/scipy.
+	"""
+	if Recommender is None:
+		return None
+	if os.path.exists(RECOMMENDATIONS_FILE):
+		try:
+			return Recommender.load(RECOMMENDATIONS_FILE)
+		except Exception as e:
+			print(f"Could not load recommendations from {RECOMMENDATIONS_FILE}: {e}")
+	return Recommender()
+
+# "People also ordered" and "recommended for you" lists (see recommend.py).
+# Loaded once at startup and updated in every server process as orders come in (see apply_change).
+recommender = load_recommender()
+
+
+# Rendered template fragments, keyed by the {% cache %} tag's key. Changes to a
+# restaurant's dishes or reviews drop that restaurant's fragments (see apply_change).
+fragment_cache = TTLCache(ttl=FRAGMENT_CACHE_TTL, maxsize=FRAGMENT_CACHE_SIZE, may_fill=may_fill_shared_caches)
+app.jinja_env.fragment_cache = fragment_cache
+
+def invalidate_fragments(restaurant_id, dishes=False, reviews=False):
+	"""Drops the cached dish table and/or review list of a restaurant"""
+	if dishes:
+		fragment_cache.invalidate(('restaurant-dishes', restaurant_id))
+		fragment_cache.invalidate(('all-dishes',))
+	if reviews:
+		fragment_cache.invalidate(('restaurant-reviews', restaurant_id))
+
+
+# Version counters behind the catalog pages' ETags, kept in the dataversion table so
+# every server process builds the same tags (see versions.py). Every write bumps the
+# table it changed (see changed_versions), scoped to the restaurant when it knows which one.
+def load_data_versions():
+	with engine.connect() as conn:
+		return conn.execute(text(LOAD_VERSIONS_QUERY)).fetchall()
+
+data_versions = DataVersions(load_data_versions, refresh_interval=ETAG_REFRESH_INTERVAL)
+
+def conditional_page(dependencies):
+	"""
+	Serves a page with an ETag and Last-Modified built from data_versions, and answers
+	a conditional GET for an unchanged page with 304 before the view (or Postgres) runs.
+	dependencies(**view_args) returns the tables, or (table, restaurant_id) pairs,
+	the page is built from. Pages for logged-in users also depend on who they are.
+	
+	The tag names the latest versions, so the page must be built from data that has
+	them: for READ_YOUR_WRITES_WINDOW seconds after one of its dependencies changes,
+	while a replica may still be behind, the page is read from the primary.
+	"""
+	def decorator(view):
+		@functools.wraps(view)
+		def wrapper(**view_args):
+			if not data_versions.ensure_loaded():
+				# Without the current versions there's no tag that could vouch for the page
+				return view(**view_args)
+			logged_in = 'user_id' in session
+			variant = (request.full_path, session.get('user_id'), session.get('username'), session.get('role'))
+			etag, changed_at = data_versions.etag(dependencies(**view_args), variant)
+			last_modified = datetime.fromtimestamp(math.ceil(changed_at), timezone.utc)
+			if time.time() - changed_at < READ_YOUR_WRITES_WINDOW:
+				g._read_primary = True
+			
+			if request.if_none_match:
+				not_modified = request.if_none_match.contains_weak(etag)
+			else:
+				not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+			
+			if not_modified:
+				response = Response(status=304)
+			else:
+				response = make_response(view(**view_args))
+				if response.status_code != 200:
+					return response
+			
+			response.set_etag(etag)
+			response.last_modified = last_modified
+			if logged_in:
+				response.cache_control.private = True
+				response.cache_control.no_cache = True
+			else:
+				response.cache_control.public = True
+				response.cache_control.max_age = CATALOG_MAX_AGE
+			response.vary.add('Cookie')
+			return response
+		return wrapper
+	return decorator
+
+DIRECTORY_TABLES = ['restaurant', 'cuisine', 'review']
+
+def directory_dependencies():
+	tables = list(DIRECTORY_TABLES)
+	if recommender is not None and 'user_id' in session:
+		tables.append('orders')  # "Recommended for you" changes as orders come in
+	return tables
+
+def restaurant_details_dependencies(restaurant_id):
+	return [('restaurant', restaurant_id), ('dish', restaurant_id), ('review', restaurant_id),
+	        ('orders', restaurant_id), 'cuisine']
+
+
+# Loads of the same directory page or restaurant that are running at the same
+# time are shared (see SingleFlight in cache.py), so a burst of identical requests
+# runs the queries once instead of once per request.
+page_loads = SingleFlight(timeout=COALESCE_WAIT)
+
+def coalesced_load(name, params, dependencies, loader):
+	"""
+	Returns loader(), or the result of an identical load another request already
+	has in progress. The key includes the current data versions of dependencies,
+	so requests that arrive after a write never share a load that started before
+	it, and sessions reading from the primary after a write only share with each other.
+	The loader's result is shared between threads and must not be modified.
+	"""
+	if not COALESCE_LOADS:
+		return loader()
+	
+	def load():
+		result = loader()
+		if g.get('_db_conn', False) is None:
+			# Built without the database (the loader caught the error); don't share it
+			raise DatabaseUnavailable()
+		return result
 	
+	versions, _ = data_versions.state(dependencies)
+	return page_loads.do((name, params, versions, reads_primary()), load)
+
+
+# The directory's filter dropdowns hardly ever change, so they are cached for
+# FILTER_OPTIONS_TTL seconds and dropped whenever a restaurant is added or deleted.
+filter_options_cache = TTLCache(ttl=FILTER_OPTIONS_TTL, may_fill=may_fill_shared_caches)
+
+# The directory's "about N results" estimates, by filters, so paging through a search
+# or reloading the directory doesn't ask the planner again each time. They are only
+# approximate anyway, and are dropped when a restaurant is added or deleted.
+count_estimate_cache = TTLCache(ttl=RESTAURANTS_COUNT_ESTIMATE_TTL, maxsize=RESTAURANTS_COUNT_ESTIMATE_CACHE_SIZE,
+                                may_fill=may_fill_shared_caches)
+
+def load_filter_options(conn):
+	"""Returns (cuisines, price_ranges, locations) for the directory's filter dropdowns"""
+	cuisines_query = "SELECT DISTINCT cuisinename FROM cuisine ORDER BY cuisinename;"
+	cursor = conn.execute(text(cuisines_query))
+	cuisines = [row[0] for row in cursor]
+	cursor.close()
+	
+	price_ranges_query = "SELECT DISTINCT pricerange FROM restaurant WHERE pricerange IS NOT NULL ORDER BY pricerange;"
+	cursor = conn.execute(text(price_ranges_query))
+	price_ranges = [row[0] for row in cursor]
+	cursor.close()
+	
+	locations_query = "SELECT DISTINCT location FROM restaurant WHERE location IS NOT NULL ORDER BY location;"
+	cursor = conn.execute(text(locations_query))
+	locations = [row[0] for row in cursor]
+	cursor.close()
+	
+	return cuisines, price_ranges, locations
+
+
+def directory_args(args):
+	"""
+	Returns the query string arguments the directory reads, cleaned up: text stripped
+	and the page size clamped. Any other arguments don't change the page.
+	"""
+	page_size = args.get('per_page', RESTAURANTS_PAGE_SIZE, type=int)
+	return {
+		'search': args.get('search', '').strip(),
+		'cuisine': args.get('cuisine', '').strip(),
+		'price_range': args.get('price_range', '').strip(),
+		'location': args.get('location', '').strip(),
+		'per_page': max(1, min(page_size, RESTAURANTS_MAX_PAGE_SIZE)),
+		'after': args.get('after', '').strip(),
+		'before': args.get('before', '').strip()
+	}
+
+
+def load_restaurant_directory(conn, args):
+	"""
+	Runs the directory's search, filters and paging for args (from directory_args)
+	and returns the restaurants.html template context.
+	"""
 	# Get filter parameters
-	search = request.args.get('search', '').strip()
-	cuisine_filter = request.args.get('cuisine', '')
-	price_filter = request.args.get('price_range', '')
-	location_filter = request.args.get('location', '').strip()
+	search = args['search']
+	cuisine_filter = args['cuisine']
+	price_filter = args['price_range']
+	location_filter = args['location']
+	
+	# Get paging parameters
+	page_size = args['per_page']
+	# Searches are ordered by relevance rank (an int), everything else by name
+	cursor_type = int if search else str
+	after = decode_cursor(args['after'], cursor_type)
+	before = None if after else decode_cursor(args['before'], cursor_type)
+	
+	filters = {
+		'search': search,
+		'cuisine': cuisine_filter,
+		'price_range': price_filter,
+		'location': location_filter
+	}
+	next_url = None
+	prev_url = None
+	total_estimate = None
 	
 	try:
-		# Build dynamic query with filters
-		base_query = """
-		SELECT DISTINCT r.restaurantid, r.name, r.location, r.pricerange
-		FROM restaurant r
-		LEFT JOIN restaurantcuisine rc ON r.restaurantid = rc.restaurantid
-		LEFT JOIN cuisine c ON rc.cuisineid = c.cuisineid
-		WHERE 1=1
-		"""
+		# Build dynamic query with filters.
+		# The cuisine filter is an EXISTS so restaurants with several cuisines
+		# don't need DISTINCT to remove duplicates.
+		where_clause = " WHERE 1=1"
 		params = {}
+		sort_expr = "r.name"
 		
 		if search:
-			base_query += " AND r.name ILIKE :search"
-			params['search'] = f"%{search}%"
+			# The search index returns matching IDs best match first, and the
+			# position in that list becomes the sort key. With other filters, every
+			# match is passed on, since the best max_results may all be filtered out.
+			filtered = bool(cuisine_filter or price_filter or location_filter)
+			params['search_ids'] = restaurant_search.search(search, capped=not filtered)
+			where_clause += " AND r.restaurantid = ANY(CAST(:search_ids AS integer[]))"
+			sort_expr = "array_position(CAST(:search_ids AS integer[]), r.restaurantid)"
 		
 		if cuisine_filter:
-			base_query += " AND c.cuisinename = :cuisine"
+			where_clause += """ AND EXISTS (
+				SELECT 1 FROM restaurantcuisine rc
+				JOIN cuisine c ON rc.cuisineid = c.cuisineid
+				WHERE rc.restaurantid = r.restaurantid AND c.cuisinename = :cuisine)"""
 			params['cuisine'] = cuisine_filter
 		
 		if price_filter:
-			base_query += " AND r.pricerange = :price_range"
+			where_clause += " AND r.pricerange = :price_range"
 			params['price_range'] = price_filter
 		
 		if location_filter:
-			base_query += " AND r.location = :location"
+			where_clause += " AND r.location = :location"
 			params['location'] = location_filter
 		
-		base_query += " ORDER BY r.name;"
+		from_clause = " FROM restaurant r"
+		
+		if RESTAURANTS_COUNT_ESTIMATE:
+			# The same for every page of a search, so cached by its filters (see count_estimate_cache)
+			estimate_key = (search, cuisine_filter, price_filter, location_filter)
+			total_estimate = count_estimate_cache.get_or_load(estimate_key, lambda: estimate_row_count(
+				conn, "SELECT r.restaurantid" + from_clause + where_clause, params))
+		
+		# Keyset pagination: seek to the cursor on (sort key, restaurantid) instead of using OFFSET.
+		# Going backwards reads in reverse order and flips the rows afterwards.
+		# Ratings come from the restaurantstats summary table (see stats.py)
+		base_query = (f"SELECT r.restaurantid, r.name, r.location, r.pricerange, {sort_expr} AS sort_key, {STATS_COLUMNS}"
+			+ from_clause + " LEFT JOIN restaurantstats s ON s.restaurantid = r.restaurantid" + where_clause)
+		page_params = dict(params)
+		if after:
+			base_query += f" AND ({sort_expr}, r.restaurantid) > (:cursor_key, :cursor_id)"
+			page_params['cursor_key'], page_params['cursor_id'] = after
+		elif before:
+			base_query += f" AND ({sort_expr}, r.restaurantid) < (:cursor_key, :cursor_id)"
+			page_params['cursor_key'], page_params['cursor_id'] = before
+		
+		if before:
+			base_query += " ORDER BY sort_key DESC, r.restaurantid DESC"
+		else:
+			base_query += " ORDER BY sort_key, r.restaurantid"
+		
+		# Fetch one extra row to know whether there is another page
+		base_query += " LIMIT :page_limit;"
+		page_params['page_limit'] = page_size + 1
+		
+		cursor = conn.execute(text(base_query), page_params)
+		rows = cursor.fetchall()
+		cursor.close()
+		
+		has_more = len(rows) > page_size
+		rows = rows[:page_size]
+		if before:
+			rows.reverse()
 		
-		cursor = g.conn.execute(text(base_query), params)
 		restaurants = []
-		for result in cursor:
+		for result in rows:
 			restaurants.append({
 				'id': result[0],
 				'name': result[1],
 				'address': result[2] if result[2] else 'N/A',
-				'price_range': result[3] if result[3] else 'N/A'
+				'price_range': result[3] if result[3] else 'N/A',
+				'review_count': result[5],
+				'avg_rating': float(result[6]) if result[6] is not None else None
 			})
-		cursor.close()
 		
-		# Get filter options
-		cuisines_query = "SELECT DISTINCT cuisinename FROM cuisine ORDER BY cuisinename;"
-		cursor = g.conn.execute(text(cuisines_query))
-		cuisines = [row[0] for row in cursor]
-		cursor.close()
+		# Build next/prev links that keep the current filters
+		link_args = {key: value for key, value in filters.items() if value}
+		if page_size != RESTAURANTS_PAGE_SIZE:
+			link_args['per_page'] = page_size
+		if rows:
+			first, last = rows[0], rows[-1]
+			if has_more or before:
+				next_url = '/restaurants?' + urlencode(dict(link_args, after=encode_cursor(last[4], last[0])))
+			if (has_more and before) or after:
+				prev_url = '/restaurants?' + urlencode(dict(link_args, before=encode_cursor(first[4], first[0])))
 		
-		price_ranges_query = "SELECT DISTINCT pricerange FROM restaurant WHERE pricerange IS NOT NULL ORDER BY pricerange;"
-		cursor = g.conn.execute(text(price_ranges_query))
-		price_ranges = [row[0] for row in cursor]
-		cursor.close()
-		
-		locations_query = "SELECT DISTINCT location FROM restaurant WHERE location IS NOT NULL ORDER BY location;"
-		cursor = g.conn.execute(text(locations_query))
-		locations = [row[0] for row in cursor]
-		cursor.close()
+		# Get filter options (cached, see load_filter_options)
+		cuisines, price_ranges, locations = filter_options_cache.get_or_load('filter_options', lambda: load_filter_options(conn))
 		
 		print(f"Found {len(restaurants)} restaurants")
 	except Exception as e:
@@ -196,140 +917,150 @@ def restaurants():
 		cuisines=cuisines,
 		price_ranges=price_ranges,
 		locations=locations,
-		filters={
-			'search': search,
-			'cuisine': cuisine_filter,
-			'price_range': price_filter,
-			'location': location_filter
-		}
+		filters=filters,
+		next_url=next_url,
+		prev_url=prev_url,
+		total_estimate=total_estimate
 	)
+	return context
+
+
+def load_recommended_restaurants(conn, user_id):
+	"""Returns the user's recommended restaurants as dicts with id and name, best first"""
+	if recommender is None or not user_id:
+		return []
+	restaurant_ids = recommender.recommended_restaurants(user_id, RECOMMENDED_RESTAURANTS_SHOWN)
+	if not restaurant_ids:
+		return []
+	query = """
+	SELECT restaurantid, name FROM restaurant
+	WHERE restaurantid = ANY(CAST(:ids AS integer[]))
+	ORDER BY array_position(CAST(:ids AS integer[]), restaurantid);
+	"""
+	cursor = conn.execute(text(query), {'ids': restaurant_ids})
+	recommended = [{'id': row[0], 'name': row[1]} for row in cursor]
+	cursor.close()
+	return recommended
+
+
+# View all restaurants with search/filter functionality
+@app.route('/restaurants')
+@conditional_page(directory_dependencies)
+def restaurants():
+	args = directory_args(request.args)
+	context = dict(coalesced_load('restaurants', tuple(sorted(args.items())), DIRECTORY_TABLES,
+	                              lambda: load_restaurant_directory(g.conn, args)))
+	context['recommended'] = load_recommended_restaurants(g.conn, session.get('user_id'))
 	return render_template("restaurants.html", **context)
 
+# Loads everything the restaurant details page shows in one round trip.
+# Each child collection is aggregated into a JSON array by a correlated subquery,
+# so the restaurant row comes back with its dishes, reviews, cuisines and orders attached.
+# Dates and totals are sent as text so they render exactly as the plain columns did.
+RESTAURANT_DETAILS_QUERY = """
+SELECT r.restaurantid, r.name, r.location,
+	COALESCE((
+		SELECT json_agg(json_build_object(
+			'id', d.dishid, 'name', d.name, 'ingredients', d.ingredients,
+			'price', COALESCE(d.price, 0.0)) ORDER BY d.name)
+		FROM dish d
+		WHERE d.restaurantid = r.restaurantid
+	), '[]') AS dishes,
+	COALESCE((
+		SELECT json_agg(json_build_object(
+			'id', rv.reviewid, 'user_id', rv.userid, 'rating', rv.rating,
+			'text', rv.comment, 'user_name', u.name) ORDER BY rv.reviewid DESC)
+		FROM review rv
+		LEFT JOIN users u ON rv.userid = u.userid
+		WHERE rv.restaurantid = r.restaurantid
+	), '[]') AS reviews,
+	COALESCE((
+		SELECT json_agg(json_build_object('id', c.cuisineid, 'name', c.cuisinename) ORDER BY c.cuisinename)
+		FROM cuisine c
+		JOIN restaurantcuisine rc ON c.cuisineid = rc.cuisineid
+		WHERE rc.restaurantid = r.restaurantid
+	), '[]') AS cuisines,
+	COALESCE((
+		SELECT json_agg(json_build_object(
+			'id', o.orderid, 'user_id', o.userid,
+			'date', CAST(o.date AS text), 'total', CAST(NULLIF(o.totalprice, 0) AS text)) ORDER BY o.date DESC)
+		FROM orders o
+		WHERE o.restaurantid = r.restaurantid
+	), '[]') AS orders,
+""" + STATS_COLUMNS + """
+FROM restaurant r
+LEFT JOIN restaurantstats s ON s.restaurantid = r.restaurantid
+WHERE r.restaurantid = :id;
+"""
+
+
+def load_restaurant_details(conn, restaurant_id):
+	"""
+	Returns the restaurant details page payload as a dict with restaurant, stats,
+	dishes, reviews, cuisines and orders keys, or None if the restaurant doesn't exist.
+	"""
+	cursor = conn.execute(text(RESTAURANT_DETAILS_QUERY), {'id': restaurant_id})
+	row = cursor.fetchone()
+	cursor.close()
+	
+	if not row:
+		return None
+	
+	# The driver normally decodes json columns, but accept raw strings too
+	dishes, reviews, cuisines, orders = [json.loads(col) if isinstance(col, str) else col for col in row[3:7]]
+	
+	for dish in dishes:
+		dish['price'] = float(dish['price']) if dish['price'] else None
+	for review in reviews:
+		review['rating'] = review['rating'] if review['rating'] else 'N/A'
+		review['text'] = review['text'] if review['text'] else 'No text'
+		review['user_name'] = review['user_name'] if review['user_name'] else 'Unknown User'
+	for order in orders:
+		order['date'] = order['date'] if order['date'] else 'N/A'
+		order['total'] = order['total'] if order['total'] else 'N/A'
+	
+	return dict(
+		restaurant={
+			'id': row[0],
+			'name': row[1],
+			'address': row[2] if row[2] else 'N/A'
+		},
+		stats={
+			'review_count': row[7],
+			'avg_rating': float(row[8]) if row[8] is not None else None,
+			'order_count': row[9],
+			'revenue': float(row[10])
+		},
+		dishes=dishes,
+		reviews=reviews,
+		cuisines=cuisines,
+		orders=orders
+	)
+
+
 # View restaurant details - shows all relationships
 @app.route('/restaurants/<int:restaurant_id>')
+@conditional_page(restaurant_details_dependencies)
 def restaurant_details(restaurant_id):
-	# Set search path like the home page does
-	g.conn.execute(text(f"SET search_path TO jcw2239, public;"))
-	
 	try:
-		# Schema has: RestaurantID, Name, Location, PriceRange
-		# PostgreSQL converts to lowercase: restaurantid, name, location, pricerange
-		select_query = "SELECT restaurantid, name, location FROM restaurant WHERE restaurantid = :id;"
-		cursor = g.conn.execute(text(select_query), {'id': restaurant_id})
-		restaurant = cursor.fetchone()
-		cursor.close()
+		context = coalesced_load('restaurant_details', restaurant_id, restaurant_details_dependencies(restaurant_id),
+		                         lambda: load_restaurant_details(g.conn, restaurant_id))
 		
-		if not restaurant:
+		if not context:
 			return "Restaurant not found", 404
-		
-		restaurant_info = {
-			'id': restaurant[0],
-			'name': restaurant[1],
-			'address': restaurant[2] if restaurant[2] else 'N/A'
-		}
-		
-		# Get dishes for this restaurant (including price and ingredients)
-		dishes_query = "SELECT dishid, name, ingredients, COALESCE(price, 0.0) as price FROM dish WHERE restaurantid = :id ORDER BY name;"
-		cursor = g.conn.execute(text(dishes_query), {'id': restaurant_id})
-		dishes = []
-		for result in cursor:
-			dishes.append({
-				'id': result[0], 
-				'name': result[1],
-				'ingredients': result[2],
-				'price': float(result[3]) if result[3] else None
-			})
-		cursor.close()
-		
-		# Get reviews for this restaurant
-		# Schema has: ReviewID, Rating, Comment, UserID, RestaurantID (no date column)
-		reviews_query = """
-		SELECT r.reviewid, r.userid, r.rating, r.comment, u.name as user_name
-		FROM review r
-		LEFT JOIN users u ON r.userid = u.userid
-		WHERE r.restaurantid = :id 
-		ORDER BY r.reviewid DESC;
-		"""
-		cursor = g.conn.execute(text(reviews_query), {'id': restaurant_id})
-		reviews = []
-		for result in cursor:
-			reviews.append({
-				'id': result[0],
-				'user_id': result[1],
-				'rating': result[2] if result[2] else 'N/A',
-				'text': result[3] if result[3] else 'No text',
-				'user_name': result[4] if result[4] else 'Unknown User'
-			})
-		cursor.close()
-		
-		# Get cuisines for this restaurant (through restaurantcuisine table)
-		# Schema uses CuisineName (PostgreSQL converts to lowercase: cuisinename)
-		cuisines_query = """
-		SELECT c.cuisineid, c.cuisinename as cuisine_name
-		FROM cuisine c
-		JOIN restaurantcuisine rc ON c.cuisineid = rc.cuisineid
-		WHERE rc.restaurantid = :id
-		ORDER BY c.cuisinename;
-		"""
-		cursor = g.conn.execute(text(cuisines_query), {'id': restaurant_id})
-		cuisines = []
-		for result in cursor:
-			cuisines.append({'id': result[0], 'name': result[1]})
-		cursor.close()
-		
-		# Get orders for this restaurant
-		# Schema has: OrderID, Date, TotalPrice, UserID, RestaurantID
-		# PostgreSQL converts to lowercase: orderid, date, totalprice, userid, restaurantid
-		orders_query = """
-		SELECT orderid, userid, date, totalprice 
-		FROM orders 
-		WHERE restaurantid = :id 
-		ORDER BY date DESC;
-		"""
-		cursor = g.conn.execute(text(orders_query), {'id': restaurant_id})
-		orders = []
-		for result in cursor:
-			orders.append({
-				'id': result[0],
-				'user_id': result[1],
-				'date': result[2] if result[2] else 'N/A',
-				'total': result[3] if result[3] else 'N/A'
-			})
-		cursor.close()
-		
 	except Exception as e:
 		print(f"Error querying restaurant details: {e}")
 		import traceback
 		traceback.print_exc()
 		return f"Error: {e}", 500
 	
-	context = dict(
-		restaurant=restaurant_info,
-		dishes=dishes,
-		reviews=reviews,
-		cuisines=cuisines,
-		orders=orders
-	)
 	return render_template("restaurant_details.html", **context)
 
-
 # View all users
 @app.route('/users')
 def users():
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
 	try:
-		# Schema has: UserID, Name, Username, Password, Role (NO email)
-		# PostgreSQL converts to lowercase: userid, name, username, password, role
-		select_query = "SELECT userid, username FROM users ORDER BY username;"
-		cursor = g.conn.execute(text(select_query))
-		users_list = []
-		for result in cursor:
-			users_list.append({
-				'id': result[0],
-				'username': result[1]
-			})
-		cursor.close()
+		users_list = repository.list_users(g.conn)
 		print(f"Found {len(users_list)} users")
 	except Exception as e:
 		print(f"Error querying users: {e}")
@@ -340,33 +1071,10 @@ def users():
 	context = dict(users=users_list)
 	return render_template("users.html", **context)
 
-# View all dishes (across all restaurants)
-@app.route('/dishes')
-def dishes():
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
+def load_dishes(conn):
+	"""Returns the dishes.html template context"""
 	try:
-		# Schema has: DishID, Name, Ingredients, RestaurantID, Price
-		# PostgreSQL converts to lowercase: dishid, name, ingredients, restaurantid, price
-		select_query = """
-		SELECT d.dishid, d.name, d.restaurantid, d.price, r.name as restaurant_name
-		FROM dish d
-		LEFT JOIN restaurant r ON d.restaurantid = r.restaurantid
-		ORDER BY d.name;
-		"""
-		cursor = g.conn.execute(text(select_query))
-		
-		dishes = []
-		for result in cursor:
-			dishes.append({
-				'id': result[0],
-				'name': result[1],
-				'restaurant_id': result[2],
-				'price': float(result[3]) if result[3] else None,
-				'restaurant_name': result[4] if result[4] else 'N/A'
-			})
-		
-		cursor.close()
+		dishes = repository.list_dishes(conn)
 		print(f"Found {len(dishes)} dishes")
 	except Exception as e:
 		print(f"Error querying dishes: {e}")
@@ -375,8 +1083,53 @@ def dishes():
 		dishes = []
 	
 	context = dict(dishes=dishes)
+	return context
+
+# View all dishes (across all restaurants)
+@app.route('/dishes')
+@conditional_page(lambda: ['dish', 'restaurant'])
+def dishes():
+	context = load_dishes(g.conn)
 	return render_template("dishes.html", **context)
 
+# Each user's lifetime order count, spend and favourite restaurant, keyed by user_id.
+# Dropped for a user when they place an order or one of their orders changes total.
+order_stats_cache = TTLCache(ttl=ORDER_STATS_TTL, maxsize=ORDER_STATS_CACHE_SIZE, may_fill=may_fill_shared_caches)
+
+def load_user_orders(conn, user_id, args=None):
+	"""
+	Returns the orders.html template context for one page of user_id's orders,
+	newest first. args may hold an ?after= cursor from the previous page's next link.
+	"""
+	args = args or {}
+	after = decode_cursor(args.get('after'))
+	next_url = None
+	try:
+		# Keyset pagination on (date, orderid), fetching one extra row to know whether there is another page
+		rows = repository.user_orders_page(conn, user_id, ORDERS_PAGE_SIZE + 1, after)
+		has_more = len(rows) > ORDERS_PAGE_SIZE
+		rows = rows[:ORDERS_PAGE_SIZE]
+		orders_list = [order for order, sort_date in rows]
+		if has_more:
+			last_order, last_date = rows[-1]
+			next_url = '/orders?' + urlencode({'after': encode_cursor(last_date, last_order.id)})
+		
+		# What each order on the page contained, in one query for the whole page
+		items = repository.order_item_summaries(conn, [order.id for order in orders_list])
+		stats = order_stats_cache.get_or_load(user_id, lambda: repository.user_order_stats(conn, user_id))
+		print(f"Found {len(orders_list)} orders")
+	except Exception as e:
+		print(f"Error querying orders: {e}")
+		import traceback
+		traceback.print_exc()
+		orders_list = []
+		items = {}
+		stats = None
+	
+	context = dict(orders=orders_list, items=items, stats=stats, next_url=next_url,
+	               first_url='/orders' if after else None)
+	return context
+
 # View user's orders
 @app.route('/orders')
 def orders():
@@ -384,96 +1137,105 @@ def orders():
 	if check_result:
 		return check_result
 	
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
+	context = load_user_orders(g.conn, session.get('user_id'), request.args)
+	return render_template("orders.html", **context)
+
+# Columns in an order export, one row per order item
+ORDER_EXPORT_COLUMNS = ['order_id', 'date', 'user_id', 'username', 'restaurant_id', 'restaurant_name',
+                        'order_total', 'dish_id', 'dish_name', 'quantity', 'item_price']
+
+ORDER_EXPORT_QUERY = """
+SELECT o.orderid, o.date, o.userid, u.username, o.restaurantid, r.name,
+       o.totalprice, oi.dishid, d.name, oi.quantity, oi.price
+FROM orders o
+LEFT JOIN users u ON o.userid = u.userid
+LEFT JOIN restaurant r ON o.restaurantid = r.restaurantid
+LEFT JOIN orderitem oi ON oi.orderid = o.orderid
+LEFT JOIN dish d ON oi.dishid = d.dishid
+"""
+
+
+def stream_order_export(db_engine, where_clause, params, export_format):
+	"""
+	Yields an order export as CSV or JSON text, EXPORT_FETCH_SIZE rows at a time.
+	The rows are read through a server-side cursor on a connection of its own from
+	db_engine, because the response keeps streaming after the request's g.conn is
+	returned to the pool. Memory use stays the same however many orders there are.
+	"""
+	query = ORDER_EXPORT_QUERY + where_clause + " ORDER BY o.orderid, oi.dishid;"
+	with db_engine.connect() as conn:
+		result = conn.execution_options(stream_results=True, max_row_buffer=EXPORT_FETCH_SIZE).execute(text(query), params)
+		if export_format == 'json':
+			yield '['
+			first = True
+			for rows in result.partitions(EXPORT_FETCH_SIZE):
+				chunk = []
+				for row in rows:
+					chunk.append(json.dumps(dict(zip(ORDER_EXPORT_COLUMNS, row)), default=str))
+				yield ('' if first else ',') + ','.join(chunk)
+				first = False
+			yield ']'
+		else:
+			buf = io.StringIO()
+			writer = csv.writer(buf)
+			writer.writerow(ORDER_EXPORT_COLUMNS)
+			for rows in result.partitions(EXPORT_FETCH_SIZE):
+				writer.writerows(rows)
+				yield buf.getvalue()
+				buf.seek(0)
+				buf.truncate()
+			yield buf.getvalue()
+		result.close()
+
+
+# Export orders with their items as CSV or JSON.
+# Customers get their own orders. Admins get every order, or one restaurant's with ?restaurant_id=
+@app.route('/orders/export')
+def export_orders():
+	check_result = require_login_check()
+	if check_result:
+		return check_result
 	
-	try:
-		user_id = session.get('user_id')
-		select_query = """
-		SELECT o.orderid, o.userid, o.restaurantid, o.date, o.totalprice,
-		       r.name as restaurant_name, u.username
-		FROM orders o
-		LEFT JOIN restaurant r ON o.restaurantid = r.restaurantid
-		LEFT JOIN users u ON o.userid = u.userid
-		WHERE o.userid = :user_id
-		ORDER BY o.date DESC;
-		"""
-		cursor = g.conn.execute(text(select_query), {'user_id': user_id})
-		
-		orders_list = []
-		for result in cursor:
-			orders_list.append({
-				'id': result[0],
-				'user_id': result[1],
-				'restaurant_id': result[2],
-				'date': result[3] if result[3] else 'N/A',
-				'total': result[4] if result[4] else 'N/A',
-				'restaurant_name': result[5] if result[5] else 'N/A',
-				'username': result[6] if result[6] else 'N/A'
-			})
-		cursor.close()
-		
-		print(f"Found {len(orders_list)} orders")
-	except Exception as e:
-		print(f"Error querying orders: {e}")
-		import traceback
-		traceback.print_exc()
-		orders_list = []
+	export_format = request.args.get('format', 'csv')
+	if export_format not in ('csv', 'json'):
+		return "Error: format must be csv or json", 400
 	
-	context = dict(orders=orders_list)
-	return render_template("orders.html", **context)
+	has_access, user_id, role = verify_user_access(['Admin'])
+	restaurant_id = request.args.get('restaurant_id', type=int)
+	params = {}
+	if has_access:
+		where_clause = ""
+		if restaurant_id:
+			where_clause = " WHERE o.restaurantid = :restaurant_id"
+			params['restaurant_id'] = restaurant_id
+	else:
+		where_clause = " WHERE o.userid = :user_id"
+		params['user_id'] = session.get('user_id')
+	
+	filename = f"orders.{export_format}"
+	mimetype = 'application/json' if export_format == 'json' else 'text/csv'
+	response = Response(
+		stream_order_export(read_engine(), where_clause, params, export_format),
+		mimetype=mimetype,
+		headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+	)
+	if g.pop('_admitted', False):
+		# The export keeps its connection until the download is finished, so it keeps
+		# its admission slot until then too, instead of giving it up at teardown_request
+		response.call_on_close(admission.release)
+	return response
+
 
 # View order details - shows order items
 @app.route('/orders/<int:order_id>')
 def order_details(order_id):
-	g.conn.execute(text(f"SET search_path TO jcw2239, public;"))
-	
 	try:
-		# Get order info
-		# Schema has: OrderID, Date, TotalPrice, UserID, RestaurantID
-		order_query = """
-		SELECT o.orderid, o.userid, o.restaurantid, o.date, o.totalprice,
-		       r.name as restaurant_name, u.username
-		FROM orders o
-		LEFT JOIN restaurant r ON o.restaurantid = r.restaurantid
-		LEFT JOIN users u ON o.userid = u.userid
-		WHERE o.orderid = :id;
-		"""
-		cursor = g.conn.execute(text(order_query), {'id': order_id})
-		order = cursor.fetchone()
-		cursor.close()
+		order_info = repository.find_order(g.conn, order_id)
 		
-		if not order:
+		if not order_info:
 			return "Order not found", 404
 		
-		order_info = {
-			'id': order[0],
-			'user_id': order[1],
-			'restaurant_id': order[2],
-			'date': order[3] if order[3] else 'N/A',
-			'total': order[4] if order[4] else 'N/A',
-			'restaurant_name': order[5] if order[5] else 'N/A',
-			'username': order[6] if order[6] else 'N/A'
-		}
-		
-		# Get order items
-		items_query = """
-		SELECT oi.orderitemid, oi.dishid, oi.quantity,
-		       d.name as dish_name
-		FROM orderitem oi
-		LEFT JOIN dish d ON oi.dishid = d.dishid
-		WHERE oi.orderid = :id;
-		"""
-		cursor = g.conn.execute(text(items_query), {'id': order_id})
-		items = []
-		for result in cursor:
-			items.append({
-				'id': result[0],
-				'dish_id': result[1],
-				'quantity': result[2],
-				'dish_name': result[3] if result[3] else 'N/A'
-			})
-		cursor.close()
-		
+		items = repository.order_items(g.conn, order_id)
 	except Exception as e:
 		print(f"Error querying order details: {e}")
 		import traceback
@@ -483,41 +1245,10 @@ def order_details(order_id):
 	context = dict(order=order_info, items=items)
 	return render_template("order_details.html", **context)
 
-# View user's reviews
-@app.route('/reviews')
-def reviews():
-	check_result = require_login_check()
-	if check_result:
-		return check_result
-	
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
+def load_user_reviews(conn, user_id):
+	"""Returns the reviews.html template context for user_id's reviews"""
 	try:
-		user_id = session.get('user_id')
-		select_query = """
-		SELECT r.reviewid, r.userid, r.restaurantid, r.rating, r.comment,
-		       rest.name as restaurant_name, u.username
-		FROM review r
-		LEFT JOIN restaurant rest ON r.restaurantid = rest.restaurantid
-		LEFT JOIN users u ON r.userid = u.userid
-		WHERE r.userid = :user_id
-		ORDER BY r.reviewid DESC;
-		"""
-		cursor = g.conn.execute(text(select_query), {'user_id': user_id})
-		reviews_list = []
-		for result in cursor:
-			review_dict = {
-				'id': result[0],
-				'user_id': result[1],
-				'restaurant_id': result[2],
-				'rating': result[3] if result[3] else 'N/A',
-				'text': result[4] if result[4] else 'No text',
-				'restaurant_name': result[5] if result[5] else 'N/A',
-				'username': result[6] if result[6] else 'N/A',
-				'date': 'N/A'  # No date column in schema
-			}
-			reviews_list.append(review_dict)
-		cursor.close()
+		reviews_list = repository.list_user_reviews(conn, user_id)
 		print(f"Found {len(reviews_list)} reviews")
 		if len(reviews_list) > 0:
 			print(f"Sample review: {reviews_list[0]}")
@@ -528,25 +1259,24 @@ def reviews():
 		reviews_list = []
 	
 	context = dict(reviews=reviews_list)
+	return context
+
+# View user's reviews
+@app.route('/reviews')
+def reviews():
+	check_result = require_login_check()
+	if check_result:
+		return check_result
+	
+	context = load_user_reviews(g.conn, session.get('user_id'))
 	return render_template("reviews.html", **context)
 
 # View all cuisines (global list)
 @app.route('/cuisines')
+@conditional_page(lambda: ['cuisine'])
 def cuisines():
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
 	try:
-		# Schema has: CuisineID, CuisineName
-		# PostgreSQL converts to lowercase: cuisineid, cuisinename
-		select_query = "SELECT cuisineid, cuisinename FROM cuisine ORDER BY cuisinename;"
-		cursor = g.conn.execute(text(select_query))
-		cuisines_list = []
-		for result in cursor:
-			cuisines_list.append({
-				'id': result[0],
-				'name': result[1]
-			})
-		cursor.close()
+		cuisines_list = repository.list_cuisines(g.conn)
 		print(f"Found {len(cuisines_list)} cuisines")
 		if len(cuisines_list) > 0:
 			print(f"Sample cuisine: {cuisines_list[0]}")
@@ -560,12 +1290,31 @@ def cuisines():
 	return render_template("cuisines.html", **context)
 
 
+# Roles verified against the users table, keyed by user_id. Entries expire after
+# ROLE_CACHE_TTL seconds, so a changed role takes effect within that window
+# (or immediately if revoke_cached_role is called for the user).
+role_cache = TTLCache(ttl=ROLE_CACHE_TTL, maxsize=ROLE_CACHE_SIZE)
+
+def revoke_cached_role(user_id=None):
+	"""
+	Forget the verified role for user_id (or for every user) in every server process,
+	so it is re-read from the database. Call it after changing a user's role.
+	"""
+	try:
+		announce_changes(Change('users', user_id))
+	except Exception as e:
+		print(f"Could not announce role change: {e}")
+		role_cache.invalidate(user_id)
+
+
 # Helper function to check user role
 def check_user_role(user_id, required_roles):
 	"""Check if user_id has one of the required roles. Returns (has_access, role)"""
 	if not user_id:
 		return False, None
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
+	user_role = role_cache.get(user_id)
+	if user_role is not None:
+		return user_role in required_roles, user_role
 	try:
 		query = "SELECT role FROM users WHERE userid = :user_id;"
 		cursor = g.conn.execute(text(query), {'user_id': user_id})
@@ -573,6 +1322,7 @@ def check_user_role(user_id, required_roles):
 		cursor.close()
 		if result:
 			user_role = result[0]
+			role_cache.set(user_id, user_role)
 			return user_role in required_roles, user_role
 		return False, None
 	except Exception as e:
@@ -589,16 +1339,150 @@ def verify_user_access(required_roles):
 	return has_access, user_id, role
 
 
+#
+# Prefork servers (gunicorn, see serve.py) import the app once and fork workers from
+# it. Each worker must open its own database connections: a pooled connection
+# inherited from the parent shares its socket with every other worker.
+#
+def reset_after_fork():
+	"""
+	Runs in each child process right after a fork. Inherited pooled connections are
+	dropped without being closed, since the parent still owns their sockets, and the
+	child loads the data versions afresh rather than trusting the parent's copy.
+	"""
+	for db_engine in ENGINE_NAMES:
+		db_engine.dispose(close=False)
+	data_versions.ready = False
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def require_schema():
+	"""
+	Exits if a table the app writes to on every order and review is missing
+	(restaurantstats, dataversion): those writes would fail and every page would show
+	blank statistics. Run when the server starts.
+	"""
+	try:
+		with engine.connect() as conn:
+			missing = missing_tables(conn)
+	except Exception as e:
+		print(f"Could not check the database schema: {e}")
+		return
+	if missing:
+		raise SystemExit("Missing table(s) %s. Run `python migrations.py migrate` (from webserver/) "
+		                 "to create them, then start the server again." % ', '.join(missing))
+
+
+#
+# Applying writes to the caches. A write route commits with commit_changes(), naming
+# each row it changed; apply_change() then drops whatever this process cached from
+# those rows, and every other process does the same when the notice reaches it.
+#
+VERSIONED_TABLES = ('restaurant', 'cuisine', 'dish', 'review', 'orders')
+
+def changed_versions(change):
+	"""The (table, restaurant_id) data versions a change bumps"""
+	if change.table == ANY_TABLE:
+		return [(table, None) for table in VERSIONED_TABLES]
+	if change.table == 'restaurant':
+		if change.deleted:
+			return [(table, change.id) for table in ('restaurant', 'dish', 'review', 'orders')]
+		return [('restaurant', change.id)]
+	if change.table in ('dish', 'review', 'orders'):
+		return [(change.table, change.restaurant_id)]
+	return []
+
+def apply_change(change):
+	"""Drops this process's cached data built from the changed row"""
+	restaurant_id = change.restaurant_id
+	if change.versions:
+		data_versions.update(change.versions)
+	if change.table == ANY_TABLE:
+		drop_all_cached()
+	elif change.table == 'restaurant':
+		restaurant_id = change.id
+		filter_options_cache.invalidate()
+		count_estimate_cache.invalidate()
+		if change.deleted:
+			restaurant_search.remove(restaurant_id)
+			invalidate_fragments(restaurant_id, dishes=True, reviews=True)
+			order_stats_cache.invalidate()  # the restaurant's orders went with it
+		else:
+			restaurant_search.add(restaurant_id, change.name)
+	elif change.table == 'dish':
+		invalidate_fragments(restaurant_id, dishes=True)
+	elif change.table == 'review':
+		invalidate_fragments(restaurant_id, reviews=True)
+	elif change.table == 'orders':
+		order_stats_cache.invalidate(change.user_id)
+		if change.dish_ids and recommender is not None:
+			recommender.add_order(change.user_id, restaurant_id, change.dish_ids)
+	elif change.table == 'users':
+		role_cache.invalidate(change.id)
+
+def drop_all_cached():
+	"""Drops every cache, for when changes from other processes may have been missed"""
+	for cache in (filter_options_cache, count_estimate_cache, fragment_cache, order_stats_cache, role_cache):
+		cache.invalidate()
+	restaurant_search.invalidate()
+
+def resync_caches():
+	"""Run whenever the invalidation listener (re)connects, since it may have missed changes"""
+	drop_all_cached()
+	data_versions.load()
+
+invalidation_bus = InvalidationBus(DATABASEURI, CACHE_INVALIDATION_CHANNEL, apply_change, resync_caches)
+
+@app.before_request
+def start_invalidation_listener():
+	if CACHE_INVALIDATION:
+		invalidation_bus.start()
+
+def publish_changes(conn, changes):
+	"""
+	Bumps the changes' data versions and queues notices of them in conn's open
+	transaction; the notices go out when it commits. Returns the changes with their
+	new versions, to apply once it has.
+	"""
+	stamped = []
+	for change in changes:
+		change = change._replace(versions=data_versions.record(conn, changed_versions(change)))
+		if CACHE_INVALIDATION:
+			invalidation_bus.publish(conn, change)
+		stamped.append(change)
+	return stamped
+
+def apply_changes(changes):
+	for change in changes:
+		apply_change(change)
+
+def commit_changes(conn, *changes):
+	"""Commits conn's transaction along with notices of the changes, then applies them here"""
+	changes = publish_changes(conn, changes)
+	conn.commit()
+	apply_changes(changes)
+
+def announce_changes(*changes):
+	"""
+	For changes with no transaction of this app's to ride on (already committed on
+	a raw connection, or not in the database at all): sends their notices in a
+	transaction of their own on the primary, then applies them here
+	"""
+	with engine.begin() as conn:
+		changes = publish_changes(conn, changes)
+	apply_changes(changes)
+
+
 # Add Restaurant (Admin only)
 @app.route('/restaurants/add', methods=['GET', 'POST'])
+@uses_primary
 def add_restaurant():
 	# Check login and role
 	check_result = require_login_check(required_roles=['Admin'])
 	if check_result:
 		return check_result
 	
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
 	if request.method == 'POST':
 		# Use logged-in user from session
 		user_id = session.get('user_id')
@@ -623,7 +1507,7 @@ def add_restaurant():
 			})
 			restaurant_id = cursor.fetchone()[0]
 			cursor.close()
-			g.conn.commit()
+			commit_changes(g.conn, Change('restaurant', restaurant_id, name=name))
 			return redirect(f'/restaurants/{restaurant_id}')
 		except Exception as e:
 			print(f"Error adding restaurant: {e}")
@@ -638,14 +1522,13 @@ def add_restaurant():
 
 # Add Dish (Admin only)
 @app.route('/restaurants/<int:restaurant_id>/add-dish', methods=['GET', 'POST'])
+@uses_primary
 def add_dish(restaurant_id):
 	# Check login and role
 	check_result = require_login_check(required_roles=['Admin'])
 	if check_result:
 		return check_result
 	
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
 	if request.method == 'POST':
 		# Use logged-in user from session
 		user_id = session.get('user_id')
@@ -681,7 +1564,7 @@ def add_dish(restaurant_id):
 			})
 			dish_id = cursor.fetchone()[0]
 			cursor.close()
-			g.conn.commit()
+			commit_changes(g.conn, Change('dish', dish_id, restaurant_id))
 			return redirect(f'/restaurants/{restaurant_id}')
 		except Exception as e:
 			print(f"Error adding dish: {e}")
@@ -692,31 +1575,72 @@ def add_dish(restaurant_id):
 	# GET: Show form
 	try:
 		# Get restaurant info
-		rest_query = "SELECT restaurantid, name FROM restaurant WHERE restaurantid = :id;"
-		cursor = g.conn.execute(text(rest_query), {'id': restaurant_id})
-		restaurant = cursor.fetchone()
-		cursor.close()
+		restaurant = repository.find_restaurant(g.conn, restaurant_id)
 		
 		if not restaurant:
 			return "Restaurant not found", 404
 	except Exception as e:
 		return f"Error: {e}", 500
 	
-	context = dict(restaurant={'id': restaurant[0], 'name': restaurant[1]}, 
+	context = dict(restaurant=restaurant, 
 	               current_user={'id': session.get('user_id'), 'username': session.get('username')})
 	return render_template("add_dish.html", **context)
 
 
+# Bulk import dishes from a CSV file (Admin only)
+@app.route('/restaurants/<int:restaurant_id>/import-dishes', methods=['GET', 'POST'])
+@uses_primary
+def import_dishes_csv(restaurant_id):
+	# Check login and role
+	check_result = require_login_check(required_roles=['Admin'])
+	if check_result:
+		return check_result
+	
+	try:
+		# Get restaurant info
+		restaurant = repository.find_restaurant(g.conn, restaurant_id)
+		
+		if not restaurant:
+			return "Restaurant not found", 404
+	except Exception as e:
+		return f"Error: {e}", 500
+	
+	result = None
+	if request.method == 'POST':
+		upload = request.files.get('file')
+		if not upload or not upload.filename:
+			return "Error: A CSV file is required", 400
+		
+		try:
+			# Finish the checks' implicit transaction, then stream the upload
+			# straight into COPY on the same connection
+			g.conn.commit()
+			imported, error_count, errors = import_dishes(g.conn.connection, restaurant_id, csv_lines(upload.stream))
+			# The import commits on its own, so the notice goes out in a transaction of its
+			# own, and only if a row was imported (nothing changed otherwise)
+			if imported:
+				commit_changes(g.conn, Change('dish', restaurant_id=restaurant_id))
+			result = {'imported': imported, 'error_count': error_count, 'errors': errors}
+		except Exception as e:
+			print(f"Error importing dishes: {e}")
+			import traceback
+			traceback.print_exc()
+			return f"Error: {e}", 500
+	
+	context = dict(restaurant=restaurant, result=result,
+	               current_user={'id': session.get('user_id'), 'username': session.get('username')})
+	return render_template("import_dishes.html", **context)
+
+
 # Add Review (Admin or Customer)
 @app.route('/restaurants/<int:restaurant_id>/add-review', methods=['GET', 'POST'])
+@uses_primary
 def add_review(restaurant_id):
 	# Check login and role
 	check_result = require_login_check(required_roles=['Admin', 'Cust'])
 	if check_result:
 		return check_result
 	
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
 	if request.method == 'POST':
 		# Use logged-in user from session
 		user_id = session.get('user_id')
@@ -741,7 +1665,8 @@ def add_review(restaurant_id):
 			})
 			review_id = cursor.fetchone()[0]
 			cursor.close()
-			g.conn.commit()
+			record_review(g.conn, restaurant_id, rating)
+			commit_changes(g.conn, Change('review', review_id, restaurant_id))
 			return redirect(f'/restaurants/{restaurant_id}')
 		except Exception as e:
 			print(f"Error adding review: {e}")
@@ -752,31 +1677,150 @@ def add_review(restaurant_id):
 	# GET: Show form
 	try:
 		# Get restaurant info
-		rest_query = "SELECT restaurantid, name FROM restaurant WHERE restaurantid = :id;"
-		cursor = g.conn.execute(text(rest_query), {'id': restaurant_id})
-		restaurant = cursor.fetchone()
-		cursor.close()
+		restaurant = repository.find_restaurant(g.conn, restaurant_id)
 		
 		if not restaurant:
 			return "Restaurant not found", 404
 	except Exception as e:
 		return f"Error: {e}", 500
 	
-	context = dict(restaurant={'id': restaurant[0], 'name': restaurant[1]},
+	context = dict(restaurant=restaurant,
 	               current_user={'id': session.get('user_id'), 'username': session.get('username')})
 	return render_template("add_review.html", **context)
 
 
+# Helper function to read the cart lines submitted by the order forms
+def parse_order_lines(dish_ids, quantities):
+	"""
+	Turns the dish_id[]/quantity[] form lists into a dict of dish_id -> quantity.
+	Blank lines and quantities <= 0 are skipped, and a dish listed twice has its
+	quantities added together. Raises ValueError on non-numeric input.
+	"""
+	lines = {}
+	for dish_id_str, quantity_str in zip(dish_ids, quantities):
+		if not dish_id_str or not quantity_str:
+			continue
+		dish_id = int(dish_id_str)
+		quantity = int(quantity_str)
+		if quantity <= 0:
+			continue
+		lines[dish_id] = lines.get(dish_id, 0) + quantity
+	return lines
+
+
+# Prices every cart line in one pass. Dish IDs and quantities are passed as two
+# arrays and unnested into rows; only dishes that belong to :restaurant_id are
+# priced, so a dish from another restaurant simply doesn't show up in "priced".
+PRICED_LINES_CTE = """
+lines AS (
+	SELECT l.dishid, l.quantity
+	FROM unnest(CAST(:dish_ids AS integer[]), CAST(:quantities AS integer[])) AS l(dishid, quantity)
+),
+priced AS (
+	SELECT l.dishid, l.quantity, COALESCE(d.price, 0.0) AS price
+	FROM lines l
+	JOIN dish d ON d.dishid = l.dishid AND d.restaurantid = :restaurant_id
+)
+"""
+
+# Creates the order and all of its items in a single statement. The total is
+# computed in SQL, and the HAVING clause means nothing is inserted (and no row
+# is returned) unless every submitted dish was priced for this restaurant.
+# The restaurant's order count and revenue in restaurantstats are updated in the same statement.
+CREATE_ORDER_QUERY = """
+WITH """ + PRICED_LINES_CTE + """,
+new_order AS (
+	INSERT INTO orders (userid, restaurantid, totalprice)
+	SELECT :user_id, :restaurant_id, SUM(p.price * p.quantity)
+	FROM priced p
+	HAVING COUNT(*) = :line_count
+	RETURNING orderid, restaurantid, totalprice
+),
+new_items AS (
+	INSERT INTO orderitem (orderid, dishid, quantity, price)
+	SELECT o.orderid, p.dishid, p.quantity, p.price
+	FROM new_order o CROSS JOIN priced p
+),
+order_stats AS (
+	INSERT INTO restaurantstats (restaurantid, ordercount, revenue)
+	SELECT restaurantid, 1, COALESCE(totalprice, 0) FROM new_order
+	ON CONFLICT (restaurantid) DO UPDATE SET
+		ordercount = restaurantstats.ordercount + EXCLUDED.ordercount,
+		revenue = restaurantstats.revenue + EXCLUDED.revenue
+)
+SELECT orderid FROM new_order;
+"""
+
+# Adds new lines to an existing order. Lines are priced from the order's own
+# restaurant, so RETURNING fewer rows than submitted means a dish was rejected.
+ADD_ORDER_ITEMS_QUERY = """
+WITH """ + PRICED_LINES_CTE.replace(':restaurant_id', '(SELECT restaurantid FROM orders WHERE orderid = :order_id)') + """
+INSERT INTO orderitem (orderid, dishid, quantity, price)
+SELECT :order_id, p.dishid, p.quantity, p.price
+FROM priced p
+RETURNING dishid, price * quantity;
+"""
+
+UPDATE_ORDER_ITEMS_QUERY = """
+UPDATE orderitem oi
+SET quantity = l.quantity
+FROM unnest(CAST(:dish_ids AS integer[]), CAST(:quantities AS integer[])) AS l(dishid, quantity)
+WHERE oi.orderid = :order_id AND oi.dishid = l.dishid;
+"""
+
+DELETE_ORDER_ITEMS_QUERY = """
+DELETE FROM orderitem
+WHERE orderid = :order_id AND dishid = ANY(CAST(:dish_ids AS integer[]));
+"""
+
+
+def diff_order_lines(current_items, submitted):
+	"""
+	Compares an order's current items with the submitted cart.
+	current_items maps dish_id -> list of (quantity, price) rows, submitted maps dish_id -> quantity.
+	Returns (added, changed, removed, total_delta) where added and changed map
+	dish_id -> quantity, removed is a list of dish_ids and total_delta is the
+	change in order total for the changed and removed lines.
+	Existing lines keep the price they were ordered at. A dish stored as more than
+	one row is removed and added back as a single line.
+	"""
+	added, changed, removed = {}, {}, []
+	total_delta = 0
+	for dish_id, rows in current_items.items():
+		new_quantity = submitted.get(dish_id, 0)
+		if len(rows) > 1 or new_quantity == 0:
+			removed.append(dish_id)
+			total_delta -= sum(quantity * price for quantity, price in rows)
+			if new_quantity:
+				added[dish_id] = new_quantity
+		elif new_quantity != rows[0][0]:
+			quantity, price = rows[0]
+			changed[dish_id] = new_quantity
+			total_delta += (new_quantity - quantity) * price
+	for dish_id, quantity in submitted.items():
+		if dish_id not in current_items:
+			added[dish_id] = quantity
+	return added, changed, removed, total_delta
+
+
+def order_line_params(lines):
+	"""Bind parameters for PRICED_LINES_CTE from a parse_order_lines() dict"""
+	return {
+		'dish_ids': list(lines.keys()),
+		'quantities': list(lines.values()),
+		'line_count': len(lines)
+	}
+
+
 # Create Order (Admin or Customer)
 @app.route('/restaurants/<int:restaurant_id>/add-order', methods=['GET', 'POST'])
+@uses_primary
 def create_order(restaurant_id):
 	# Check login and role
 	check_result = require_login_check(required_roles=['Admin', 'Cust'])
 	if check_result:
 		return check_result
 	
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
 	if request.method == 'POST':
 		# Use logged-in user from session
 		user_id = session.get('user_id')
@@ -784,25 +1828,7 @@ def create_order(restaurant_id):
 		if not user_id:
 			return "Error: You must be logged in to create an order", 400
 		
-		# Verify user exists in database (commit any pending transaction first)
-		try:
-			g.conn.commit()
-		except:
-			pass  # If no transaction, that's fine
-		
-		user_check = "SELECT userid FROM users WHERE userid = :user_id;"
-		cursor = g.conn.execute(text(user_check), {'user_id': user_id})
-		user_exists = cursor.fetchone()
-		cursor.close()
-		
-		# Commit the user check query
-		try:
-			g.conn.commit()
-		except:
-			pass
-		
-		if not user_exists:
-			return f"Error: User ID {user_id} not found in database. Please log out and log back in.", 400
+		# A user deleted since logging in fails the order's foreign key (see the error mapping below)
 		
 		# Get dish IDs and quantities from form
 		dish_ids = request.form.getlist('dish_id[]')
@@ -812,78 +1838,29 @@ def create_order(restaurant_id):
 			return "Error: At least one dish is required", 400
 		
 		try:
-			# Calculate total price
-			total_price = 0
-			order_items = []
-			
-			for dish_id_str, quantity_str in zip(dish_ids, quantities):
-				if not dish_id_str or not quantity_str:
-					continue
-				dish_id = int(dish_id_str)
-				quantity = int(quantity_str)
-				
-				if quantity <= 0:
-					continue
-				
-				# Get dish price from dish table (current price)
-				# This preserves the price at the time of order
-				price_query = "SELECT COALESCE(price, 0.0) FROM dish WHERE dishid = :dish_id;"
-				cursor = g.conn.execute(text(price_query), {'dish_id': dish_id})
-				price_result = cursor.fetchone()
-				price = float(price_result[0]) if price_result and price_result[0] else 0.0
-				cursor.close()
-				
-				order_items.append({
-					'dish_id': dish_id,
-					'quantity': quantity,
-					'price': price
-				})
-				total_price += price * quantity
+			order_items = parse_order_lines(dish_ids, quantities)
 			
 			if not order_items:
 				return "Error: At least one valid dish with quantity > 0 is required", 400
 			
-			# Commit any pending queries before starting transaction
-			try:
-				g.conn.commit()
-			except:
-				pass
-			
-			# Create order and items in a transaction
-			trans = g.conn.begin()
+			# Price the dishes, create the order and add its items in one statement.
+			# Prices are copied from the dish table so the order keeps the price at order time.
+			params = order_line_params(order_items)
+			params.update({'user_id': user_id, 'restaurant_id': restaurant_id})
 			try:
-				# Create order
-				order_query = """
-				INSERT INTO orders (userid, restaurantid, totalprice)
-				VALUES (:user_id, :restaurant_id, :total_price)
-				RETURNING orderid;
-				"""
-				cursor = g.conn.execute(text(order_query), {
-					'user_id': user_id,
-					'restaurant_id': restaurant_id,
-					'total_price': total_price
-				})
-				order_id = cursor.fetchone()[0]
+				cursor = g.conn.execute(text(CREATE_ORDER_QUERY), params)
+				result = cursor.fetchone()
 				cursor.close()
-				
-				# Add order items
-				for item in order_items:
-					item_query = """
-					INSERT INTO orderitem (orderid, dishid, quantity, price)
-					VALUES (:order_id, :dish_id, :quantity, :price);
-					"""
-					g.conn.execute(text(item_query), {
-						'order_id': order_id,
-						'dish_id': item['dish_id'],
-						'quantity': item['quantity'],
-						'price': item['price']
-					})
-				
-				# Commit the transaction
-				trans.commit()
+				if not result:
+					g.conn.rollback()
+					return "Error: One or more dishes are not on this restaurant's menu. Please refresh the page and try again.", 400
+				order_id = result[0]
+				# apply_change folds the order into every process's recommendations
+				commit_changes(g.conn, Change('orders', order_id, restaurant_id, user_id,
+				                              dish_ids=list(order_items.keys())))
 			except Exception as e:
 				# Rollback on error
-				trans.rollback()
+				g.conn.rollback()
 				raise e
 			
 			return redirect(f'/orders/{order_id}')
@@ -905,34 +1882,24 @@ def create_order(restaurant_id):
 	# GET: Show form
 	try:
 		# Get restaurant info
-		rest_query = "SELECT restaurantid, name FROM restaurant WHERE restaurantid = :id;"
-		cursor = g.conn.execute(text(rest_query), {'id': restaurant_id})
-		restaurant = cursor.fetchone()
-		cursor.close()
+		restaurant = repository.find_restaurant(g.conn, restaurant_id)
 		
 		if not restaurant:
 			return "Restaurant not found", 404
 		
 		# Get dishes for this restaurant (including price)
-		dishes_query = """
-		SELECT dishid, name, COALESCE(price, 0.0) as price
-		FROM dish 
-		WHERE restaurantid = :id 
-		ORDER BY name;
-		"""
-		cursor = g.conn.execute(text(dishes_query), {'id': restaurant_id})
-		dishes = []
-		for row in cursor:
-			dishes.append({
-				'id': row[0], 
-				'name': row[1],
-				'price': float(row[2]) if row[2] else 0.0
-			})
-		cursor.close()
+		dishes = repository.restaurant_menu(g.conn, restaurant_id)
 	except Exception as e:
 		return f"Error: {e}", 500
 	
-	context = dict(restaurant={'id': restaurant[0], 'name': restaurant[1]}, dishes=dishes,
+	# Every dish an order can contain is on this menu, so the names are already here
+	also_ordered = {}
+	if recommender is not None:
+		names = {dish.id: dish.name for dish in dishes}
+		for dish in dishes:
+			also_ordered[dish.id] = [names[d] for d in recommender.also_ordered(dish.id, ALSO_ORDERED_SHOWN) if d in names]
+	
+	context = dict(restaurant=restaurant, dishes=dishes, also_ordered=also_ordered,
 	               current_user={'id': session.get('user_id'), 'username': session.get('username')})
 	return render_template("create_order.html", **context)
 
@@ -940,8 +1907,6 @@ def create_order(restaurant_id):
 # Login page
 @app.route('/login', methods=['GET', 'POST'])
 def login():
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
 	if request.method == 'POST':
 		username = request.form.get('username', '').strip()
 		password = request.form.get('password', '').strip()
@@ -960,6 +1925,7 @@ def login():
 				session['user_id'] = user[0]
 				session['username'] = user[1]
 				session['role'] = user[2]
+				role_cache.set(user[0], user[2])
 				return redirect(request.args.get('next', '/'))
 			else:
 				return render_template("login.html", error="Invalid username or password")
@@ -972,12 +1938,8 @@ def login():
 
 # Register route
 @app.route('/register', methods=['GET', 'POST'])
+@uses_primary
 def register():
-	if g.conn is None:
-		return "Database unavailable. Please try again later.", 503
-	
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
 	if request.method == 'POST':
 		name = request.form.get('name', '').strip()
 		username = request.form.get('username', '').strip()
@@ -1011,46 +1973,43 @@ def register():
 # Logout
 @app.route('/logout')
 def logout():
+	if session.get('user_id'):
+		# Logging out changes nobody's role, so there's nothing to tell the other processes
+		role_cache.invalidate(session['user_id'])
 	session.clear()
 	return redirect('/')
 
 # Delete Restaurant (Admin only)
 @app.route('/restaurants/<int:restaurant_id>/delete', methods=['POST'])
+@uses_primary
 def delete_restaurant(restaurant_id):
 	check_result = require_login_check(required_roles=['Admin'])
 	if check_result:
 		return check_result
 	
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
 	try:
 		delete_query = "DELETE FROM restaurant WHERE restaurantid = :id;"
 		g.conn.execute(text(delete_query), {'id': restaurant_id})
-		g.conn.commit()
+		commit_changes(g.conn, Change('restaurant', restaurant_id, deleted=True))
 		return redirect('/')
 	except Exception as e:
 		return f"Error deleting restaurant: {e}", 500
 
 # Delete Dish (Admin only)
 @app.route('/dishes/<int:dish_id>/delete', methods=['POST'])
+@uses_primary
 def delete_dish(dish_id):
 	check_result = require_login_check(required_roles=['Admin'])
 	if check_result:
 		return check_result
 	
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
 	try:
 		# Get restaurant ID before deleting
-		rest_query = "SELECT restaurantid FROM dish WHERE dishid = :id;"
-		cursor = g.conn.execute(text(rest_query), {'id': dish_id})
-		result = cursor.fetchone()
-		restaurant_id = result[0] if result else None
-		cursor.close()
+		restaurant_id = repository.dish_restaurant_id(g.conn, dish_id)
 		
 		delete_query = "DELETE FROM dish WHERE dishid = :id;"
 		g.conn.execute(text(delete_query), {'id': dish_id})
-		g.conn.commit()
+		commit_changes(g.conn, Change('dish', dish_id, restaurant_id, deleted=True))
 		
 		if restaurant_id:
 			return redirect(f'/restaurants/{restaurant_id}')
@@ -1060,30 +2019,34 @@ def delete_dish(dish_id):
 
 # Delete Review (Admin only)
 @app.route('/reviews/<int:review_id>/delete', methods=['POST'])
+@uses_primary
 def delete_review(review_id):
 	check_result = require_login_check(required_roles=['Admin'])
 	if check_result:
 		return check_result
 	
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
 	try:
-		delete_query = "DELETE FROM review WHERE reviewid = :id;"
-		g.conn.execute(text(delete_query), {'id': review_id})
-		g.conn.commit()
+		delete_query = "DELETE FROM review WHERE reviewid = :id RETURNING restaurantid, rating;"
+		cursor = g.conn.execute(text(delete_query), {'id': review_id})
+		deleted = cursor.fetchone()
+		cursor.close()
+		if deleted:
+			record_review(g.conn, deleted[0], deleted[1], removed=True)
+			commit_changes(g.conn, Change('review', review_id, deleted[0], deleted=True))
+		else:
+			g.conn.commit()
 		return redirect('/')
 	except Exception as e:
 		return f"Error deleting review: {e}", 500
 
 # Edit Dish (Admin only)
 @app.route('/dishes/<int:dish_id>/edit', methods=['GET', 'POST'])
+@uses_primary
 def edit_dish(dish_id):
 	check_result = require_login_check(required_roles=['Admin'])
 	if check_result:
 		return check_result
 	
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
 	if request.method == 'POST':
 		name = request.form.get('name', '').strip()
 		ingredients = request.form.get('ingredients', '').strip() or None
@@ -1114,14 +2077,10 @@ def edit_dish(dish_id):
 				'price': price,
 				'dish_id': dish_id
 			})
-			g.conn.commit()
 			
 			# Get restaurant ID to redirect back
-			rest_query = "SELECT restaurantid FROM dish WHERE dishid = :id;"
-			cursor = g.conn.execute(text(rest_query), {'id': dish_id})
-			result = cursor.fetchone()
-			restaurant_id = result[0] if result else None
-			cursor.close()
+			restaurant_id = repository.dish_restaurant_id(g.conn, dish_id)
+			commit_changes(g.conn, Change('dish', dish_id, restaurant_id))
 			
 			if restaurant_id:
 				return redirect(f'/restaurants/{restaurant_id}')
@@ -1131,30 +2090,13 @@ def edit_dish(dish_id):
 	
 	# GET: Show edit form
 	try:
-		dish_query = """
-		SELECT d.dishid, d.name, d.ingredients, d.price, d.restaurantid, r.name as restaurant_name
-		FROM dish d
-		LEFT JOIN restaurant r ON d.restaurantid = r.restaurantid
-		WHERE d.dishid = :id
-		"""
-		cursor = g.conn.execute(text(dish_query), {'id': dish_id})
-		dish = cursor.fetchone()
-		cursor.close()
+		dish = repository.find_dish(g.conn, dish_id)
 		
 		if not dish:
 			return "Dish not found", 404
 		
-		dish_info = {
-			'id': dish[0],
-			'name': dish[1],
-			'ingredients': dish[2] or '',
-			'price': float(dish[3]) if dish[3] else 0.0,
-			'restaurant_id': dish[4],
-			'restaurant_name': dish[5]
-		}
-		
 		context = dict(
-			dish=dish_info,
+			dish=dish,
 			current_user={'id': session.get('user_id'), 'username': session.get('username')}
 		)
 		return render_template("edit_dish.html", **context)
@@ -1163,23 +2105,18 @@ def edit_dish(dish_id):
 
 # Edit Order (Customer can edit their own orders, Admin can edit any)
 @app.route('/orders/<int:order_id>/edit', methods=['GET', 'POST'])
+@uses_primary
 def edit_order(order_id):
 	check_result = require_login_check(required_roles=['Admin', 'Cust'])
 	if check_result:
 		return check_result
 	
-	g.conn.execute(text("SET search_path TO jcw2239, public;"))
-	
 	user_id = session.get('user_id')
 	user_role = session.get('role')
 	
 	# Check if user can edit this order (own order or admin)
 	if user_role != 'Admin':
-		order_check = "SELECT userid FROM orders WHERE orderid = :id;"
-		cursor = g.conn.execute(text(order_check), {'id': order_id})
-		result = cursor.fetchone()
-		cursor.close()
-		if not result or result[0] != user_id:
+		if repository.order_owner(g.conn, order_id) != user_id:
 			return "Access denied: You can only edit your own orders", 403
 	
 	if request.method == 'POST':
@@ -1188,58 +2125,67 @@ def edit_order(order_id):
 			dish_ids = request.form.getlist('dish_id[]')
 			quantities = request.form.getlist('quantity[]')
 			
-			# Calculate new total
-			total_price = 0
-			order_items = []
-			
-			for dish_id_str, quantity_str in zip(dish_ids, quantities):
-				if not dish_id_str or not quantity_str:
-					continue
-				dish_id = int(dish_id_str)
-				quantity = int(quantity_str)
-				
-				if quantity <= 0:
-					continue
-				
-				# Get current dish price
-				price_query = "SELECT COALESCE(price, 0.0) FROM dish WHERE dishid = :dish_id;"
-				cursor = g.conn.execute(text(price_query), {'dish_id': dish_id})
-				price_result = cursor.fetchone()
-				price = float(price_result[0]) if price_result and price_result[0] else 0.0
-				cursor.close()
-				
-				order_items.append({
-					'dish_id': dish_id,
-					'quantity': quantity,
-					'price': price
-				})
-				total_price += price * quantity
+			order_items = parse_order_lines(dish_ids, quantities)
 			
 			if not order_items:
 				return "Error: At least one dish with quantity > 0 is required", 400
 			
-			# Delete existing order items
-			delete_items = "DELETE FROM orderitem WHERE orderid = :order_id;"
-			g.conn.execute(text(delete_items), {'order_id': order_id})
-			
-			# Update order total
-			update_order = "UPDATE orders SET totalprice = :total WHERE orderid = :order_id;"
-			g.conn.execute(text(update_order), {'total': total_price, 'order_id': order_id})
+			# Finish the access check's implicit transaction so the edit runs in its own
+			if g.conn.in_transaction():
+				g.conn.commit()
 			
-			# Insert new order items
-			for item in order_items:
-				item_query = """
-				INSERT INTO orderitem (orderid, dishid, quantity, price)
-				VALUES (:order_id, :dish_id, :quantity, :price);
+			trans = g.conn.begin()
+			try:
+				# Lock the order's items and work out what actually changed
+				items_query = """
+				SELECT dishid, quantity, COALESCE(price, 0.0)
+				FROM orderitem
+				WHERE orderid = :order_id
+				FOR UPDATE;
 				"""
-				g.conn.execute(text(item_query), {
-					'order_id': order_id,
-					'dish_id': item['dish_id'],
-					'quantity': item['quantity'],
-					'price': item['price']
-				})
-			
-			g.conn.commit()
+				cursor = g.conn.execute(text(items_query), {'order_id': order_id})
+				current_items = {}
+				for result in cursor:
+					current_items.setdefault(result[0], []).append((result[1], result[2]))
+				cursor.close()
+				
+				added, changed, removed, total_delta = diff_order_lines(current_items, order_items)
+				
+				# Only the rows that changed are touched
+				if removed:
+					g.conn.execute(text(DELETE_ORDER_ITEMS_QUERY), {'order_id': order_id, 'dish_ids': removed})
+				
+				if changed:
+					params = order_line_params(changed)
+					params['order_id'] = order_id
+					g.conn.execute(text(UPDATE_ORDER_ITEMS_QUERY), params)
+				
+				if added:
+					params = order_line_params(added)
+					params['order_id'] = order_id
+					cursor = g.conn.execute(text(ADD_ORDER_ITEMS_QUERY), params)
+					added_rows = cursor.fetchall()
+					cursor.close()
+					if len(added_rows) != len(added):
+						trans.rollback()
+						return "Error: One or more dishes are not on this restaurant's menu. Please refresh the page and try again.", 400
+					total_delta += sum(row[1] for row in added_rows)
+				
+				if total_delta:
+					update_order = "UPDATE orders SET totalprice = COALESCE(totalprice, 0) + :delta WHERE orderid = :order_id RETURNING restaurantid, userid;"
+					cursor = g.conn.execute(text(update_order), {'delta': total_delta, 'order_id': order_id})
+					restaurant_id, owner_id = cursor.fetchone()
+					cursor.close()
+					record_order(g.conn, restaurant_id, 0, total_delta)
+				
+				changes = [Change('orders', order_id, restaurant_id, owner_id)] if total_delta else []
+				changes = publish_changes(g.conn, changes)
+				trans.commit()
+				apply_changes(changes)
+			except Exception as e:
+				# Rollback on error
+				trans.rollback()
+				raise e
 			
 			return redirect(f'/orders/{order_id}')
 		except Exception as e:
@@ -1248,59 +2194,19 @@ def edit_order(order_id):
 	# GET: Show edit form
 	try:
 		# Get order info
-		order_query = """
-		SELECT o.orderid, o.userid, o.restaurantid, o.totalprice,
-		       r.name as restaurant_name
-		FROM orders o
-		LEFT JOIN restaurant r ON o.restaurantid = r.restaurantid
-		WHERE o.orderid = :id;
-		"""
-		cursor = g.conn.execute(text(order_query), {'id': order_id})
-		order = cursor.fetchone()
-		cursor.close()
+		order = repository.find_order(g.conn, order_id)
 		
 		if not order:
 			return "Order not found", 404
 		
-		restaurant_id = order[2]
-		
-		# Get current order items
-		items_query = """
-		SELECT oi.dishid, oi.quantity, d.name as dish_name
-		FROM orderitem oi
-		LEFT JOIN dish d ON oi.dishid = d.dishid
-		WHERE oi.orderid = :id;
-		"""
-		cursor = g.conn.execute(text(items_query), {'id': order_id})
-		current_items = {}
-		for result in cursor:
-			current_items[result[0]] = {
-				'quantity': result[1],
-				'name': result[2]
-			}
-		cursor.close()
-		
-		# Get all dishes for this restaurant
-		dishes_query = """
-		SELECT dishid, name, COALESCE(price, 0.0) as price
-		FROM dish 
-		WHERE restaurantid = :id 
-		ORDER BY name;
-		"""
-		cursor = g.conn.execute(text(dishes_query), {'id': restaurant_id})
-		dishes = []
-		for row in cursor:
-			dishes.append({
-				'id': row[0], 
-				'name': row[1],
-				'price': float(row[2]) if row[2] else 0.0,
-				'current_quantity': current_items.get(row[0], {}).get('quantity', 0)
-			})
-		cursor.close()
+		# The restaurant's menu, with the quantities already on the order
+		dishes = repository.restaurant_menu(g.conn, order.restaurant_id)
+		current_quantities = repository.order_quantities(g.conn, order_id)
 		
 		context = dict(
-			order={'id': order[0], 'restaurant_name': order[4]}, 
+			order=order,
 			dishes=dishes,
+			current_quantities=current_quantities,
 			current_user={'id': session.get('user_id'), 'username': session.get('username')}
 		)
 		return render_template("edit_order.html", **context)
@@ -1341,7 +2247,15 @@ if __name__ == "__main__":
 		"""
 
 		HOST, PORT = host, port
+		require_schema()
+		
+		# Build the search index now rather than on the first search
+		try:
+			restaurant_search.ensure_built()
+		except Exception as e:
+			print(f"Could not build search index yet: {e}")
+		
 		print("running on %s:%d" % (HOST, PORT))
 		app.run(host=HOST, port=PORT, debug=debug, threaded=threaded)
 
-run()
\ No newline at end of file
+	run()
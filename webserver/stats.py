@@ -0,0 +1,132 @@
+"""
+Per-restaurant rating and order statistics.
+
+The restaurantstats table keeps one row per restaurant with running totals that
+the write routes in server.py adjust in the same transaction as their own
+changes, so pages can show average ratings and order counts without aggregating
+the review and orders tables on every request.
+
+The table is created and filled by migration 1 (see migrations.py), which must
+be applied before the server starts. If the totals ever drift (for example after
+editing data by hand in psql), rebuild them from scratch with:
+
+	python stats.py rebuild
+"""
+from sqlalchemy import text
+
+
+CREATE_STATS_TABLE = """
+CREATE TABLE IF NOT EXISTS restaurantstats (
+	restaurantid integer PRIMARY KEY REFERENCES restaurant(restaurantid) ON DELETE CASCADE,
+	reviewcount integer NOT NULL DEFAULT 0,
+	ratingcount integer NOT NULL DEFAULT 0,
+	ratingsum bigint NOT NULL DEFAULT 0,
+	ordercount integer NOT NULL DEFAULT 0,
+	revenue numeric(14, 2) NOT NULL DEFAULT 0
+);
+"""
+
+# Columns to select from a restaurantstats row aliased as "s". Restaurants with
+# no row yet (no reviews or orders) come back as zeros and a NULL average.
+STATS_COLUMNS = """
+	COALESCE(s.reviewcount, 0) AS reviewcount,
+	ROUND(CAST(s.ratingsum AS numeric) / NULLIF(s.ratingcount, 0), 1) AS avgrating,
+	COALESCE(s.ordercount, 0) AS ordercount,
+	COALESCE(s.revenue, 0) AS revenue
+"""
+
+# Adds to a restaurant's review totals, creating its row if needed
+RECORD_REVIEW_QUERY = """
+INSERT INTO restaurantstats (restaurantid, reviewcount, ratingcount, ratingsum)
+VALUES (:restaurant_id, :review_delta, :rating_count_delta, :rating_delta)
+ON CONFLICT (restaurantid) DO UPDATE SET
+	reviewcount = restaurantstats.reviewcount + EXCLUDED.reviewcount,
+	ratingcount = restaurantstats.ratingcount + EXCLUDED.ratingcount,
+	ratingsum = restaurantstats.ratingsum + EXCLUDED.ratingsum;
+"""
+
+# Adds to a restaurant's order totals, creating its row if needed
+RECORD_ORDER_QUERY = """
+INSERT INTO restaurantstats (restaurantid, ordercount, revenue)
+VALUES (:restaurant_id, :order_delta, :revenue_delta)
+ON CONFLICT (restaurantid) DO UPDATE SET
+	ordercount = restaurantstats.ordercount + EXCLUDED.ordercount,
+	revenue = restaurantstats.revenue + EXCLUDED.revenue;
+"""
+
+# Recomputes every restaurant's totals from the review and orders tables
+REBUILD_STATS_QUERY = """
+INSERT INTO restaurantstats (restaurantid, reviewcount, ratingcount, ratingsum, ordercount, revenue)
+SELECT r.restaurantid,
+	COALESCE(rv.reviewcount, 0), COALESCE(rv.ratingcount, 0), COALESCE(rv.ratingsum, 0),
+	COALESCE(o.ordercount, 0), COALESCE(o.revenue, 0)
+FROM restaurant r
+LEFT JOIN (
+	SELECT restaurantid, COUNT(*) AS reviewcount, COUNT(rating) AS ratingcount, SUM(rating) AS ratingsum
+	FROM review
+	GROUP BY restaurantid
+) rv ON rv.restaurantid = r.restaurantid
+LEFT JOIN (
+	SELECT restaurantid, COUNT(*) AS ordercount, SUM(totalprice) AS revenue
+	FROM orders
+	GROUP BY restaurantid
+) o ON o.restaurantid = r.restaurantid
+ON CONFLICT (restaurantid) DO UPDATE SET
+	reviewcount = EXCLUDED.reviewcount,
+	ratingcount = EXCLUDED.ratingcount,
+	ratingsum = EXCLUDED.ratingsum,
+	ordercount = EXCLUDED.ordercount,
+	revenue = EXCLUDED.revenue;
+"""
+
+
+def record_review(conn, restaurant_id, rating, removed=False):
+	"""Counts a new review (or un-counts a deleted one) in the caller's transaction"""
+	sign = -1 if removed else 1
+	conn.execute(text(RECORD_REVIEW_QUERY), {
+		'restaurant_id': restaurant_id,
+		'review_delta': sign,
+		'rating_count_delta': sign if rating is not None else 0,
+		'rating_delta': sign * (rating or 0)
+	})
+
+
+def record_order(conn, restaurant_id, order_delta, revenue_delta):
+	"""Adjusts a restaurant's order count and revenue in the caller's transaction"""
+	conn.execute(text(RECORD_ORDER_QUERY), {
+		'restaurant_id': restaurant_id,
+		'order_delta': order_delta,
+		'revenue_delta': revenue_delta
+	})
+
+
+def rebuild_stats(conn):
+	"""
+	Creates the stats table if needed and recomputes every row.
+	Takes a lock that blocks the routes' incremental updates until the caller
+	commits, so no update is lost or counted twice during the rebuild.
+	"""
+	conn.execute(text(CREATE_STATS_TABLE))
+	conn.execute(text("LOCK TABLE restaurantstats IN SHARE ROW EXCLUSIVE MODE;"))
+	conn.execute(text(REBUILD_STATS_QUERY))
+
+
+if __name__ == "__main__":
+	import click
+
+	@click.group()
+	def cli():
+		"""Manage the restaurantstats summary table"""
+
+	@cli.command()
+	def rebuild():
+		"""Create restaurantstats if needed and recompute it from review and orders"""
+		from server import engine, publish_changes
+		from invalidation import Change, ANY_TABLE
+		with engine.begin() as conn:
+			rebuild_stats(conn)
+			# Running servers drop every cached page and count that shows the stats
+			publish_changes(conn, [Change(ANY_TABLE)])
+		print("restaurantstats rebuilt")
+
+	cli()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app's modules are imported by name, as they are when run from webserver/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,55 @@
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('sqlalchemy')
+
+import server
+
+
+class FakeResult:
+	def __init__(self, rows=()):
+		self.rows = list(rows)
+
+	def fetchall(self):
+		return self.rows
+
+	def __iter__(self):
+		return iter(self.rows)
+
+	def close(self):
+		pass
+
+
+class FakeConn:
+	"""Records the parameters of each statement and returns no rows"""
+	def __init__(self):
+		self.params = []
+
+	def execute(self, statement, params=None):
+		self.params.append(params or {})
+		return FakeResult()
+
+
+@pytest.fixture
+def many_pizza_places(monkeypatch):
+	index = server.RestaurantSearchIndex(lambda: [(i, 'Pizza Place %d' % i) for i in range(1, 601)], max_results=500)
+	monkeypatch.setattr(server, 'restaurant_search', index)
+	monkeypatch.setattr(server, 'RESTAURANTS_COUNT_ESTIMATE', False)
+	server.filter_options_cache.invalidate()
+
+
+def search_ids(filters):
+	conn = FakeConn()
+	args = dict(search='pizza', cuisine='', price_range='', location='', per_page=25, after='', before='')
+	args.update(filters)
+	server.load_restaurant_directory(conn, args)
+	return next(params['search_ids'] for params in conn.params if 'search_ids' in params)
+
+
+def test_search_alone_is_capped(many_pizza_places):
+	assert len(search_ids({})) == 500
+
+
+def test_filtered_search_passes_every_match(many_pizza_places):
+	assert len(search_ids({'cuisine': 'Italian'})) == 600
+	assert len(search_ids({'location': 'Brooklyn'})) == 600
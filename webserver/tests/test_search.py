@@ -0,0 +1,37 @@
+from search import RestaurantSearchIndex
+
+
+def make_index(rows, max_results=500):
+	return RestaurantSearchIndex(lambda: rows, max_results=max_results)
+
+
+def test_misspelled_name_still_matches():
+	index = make_index([(1, 'Pizza Palace'), (2, 'Burger Barn')])
+	assert index.search('piza') == [1]
+
+
+def test_results_are_capped():
+	index = make_index([(i, 'Pizza Place %d' % i) for i in range(1, 601)])
+	assert len(index.search('pizza')) == 500
+
+
+def test_uncapped_search_returns_every_match():
+	rows = [(i, 'Pizza Place %d' % i) for i in range(1, 601)]
+	index = make_index(rows)
+	ids = index.search('pizza', capped=False)
+	assert sorted(ids) == [restaurant_id for restaurant_id, name in rows]
+
+
+def test_uncapped_search_finds_matches_past_the_cap():
+	# A SQL filter may reject the top max_results, so the rest must be passed on too
+	index = make_index([(i, 'Pizza Place %d' % i) for i in range(1, 601)])
+	past_cap = set(index.search('pizza', capped=False)) - set(index.search('pizza'))
+	assert len(past_cap) == 100
+
+
+def test_add_and_remove():
+	index = make_index([(1, 'Pizza Palace')])
+	index.search('pizza')
+	index.add(2, 'Pizza Hut')
+	index.remove(1)
+	assert index.search('pizza') == [2]
@@ -0,0 +1,44 @@
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('sqlalchemy')
+
+import serve
+import server
+
+
+@pytest.fixture
+def admission(monkeypatch):
+	monkeypatch.setattr(server, 'ADMISSION_CONTROL', True)
+	monkeypatch.setattr(server.admission, 'max_in_flight', 15)
+	monkeypatch.setattr(server.admission, 'max_queued', 50)
+	return server.admission
+
+
+def test_a_thread_for_every_admitted_or_queued_request(admission, monkeypatch):
+	monkeypatch.setattr(serve, 'WEB_THREADS', 0)
+	options = serve.gunicorn_options('127.0.0.1:0')
+	assert options['threads'] == 65
+	assert (admission.max_in_flight, admission.max_queued) == (15, 50)
+
+
+def test_fewer_threads_shrink_the_admission_limits(admission, monkeypatch):
+	monkeypatch.setattr(serve, 'WEB_THREADS', 20)
+	options = serve.gunicorn_options('127.0.0.1:0')
+	assert options['threads'] == 20
+	assert admission.max_in_flight + admission.max_queued <= options['threads']
+	assert admission.max_in_flight == 15
+
+
+def test_very_few_threads(admission, monkeypatch):
+	monkeypatch.setattr(serve, 'WEB_THREADS', 4)
+	options = serve.gunicorn_options('127.0.0.1:0')
+	assert options['threads'] == 4
+	assert (admission.max_in_flight, admission.max_queued) == (4, 0)
+
+
+def test_without_admission_control_threads_fit_the_pool(monkeypatch):
+	monkeypatch.setattr(server, 'ADMISSION_CONTROL', False)
+	monkeypatch.setattr(serve, 'WEB_THREADS', 0)
+	options = serve.gunicorn_options('127.0.0.1:0')
+	assert options['threads'] == min(4, server.DB_POOL_SIZE + server.DB_MAX_OVERFLOW)
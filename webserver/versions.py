@@ -0,0 +1,130 @@
+"""
+Data version counters for conditional GETs.
+
+Every write bumps a version for the table it changed, optionally scoped to one
+restaurant. A page lists the tables (or (table, restaurant_id) pairs) it is
+built from, and its ETag is a hash of their current versions, so an unchanged
+page can be answered with 304 Not Modified before any query runs.
+
+The versions are rows of the dataversion table, bumped by record() in the same
+transaction as the write. Each server process keeps a copy in memory: it loads
+the table once, then takes each write's new versions from the write itself or
+from its invalidation notice (see invalidation.py), so every worker of a
+prefork server computes the same tag for the same data and a conditional
+request can be answered by whichever worker gets it. Tags also roll over every
+refresh_interval seconds to pick up changes made outside the app (psql, ...).
+"""
+import time
+import hashlib
+import threading
+
+from sqlalchemy import text
+
+
+CREATE_VERSIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS dataversion (
+	name text PRIMARY KEY,
+	version bigint NOT NULL,
+	changedat double precision NOT NULL
+);
+"""
+
+# Bumps each named version, creating it if needed, and returns the new values.
+# Names are sorted so concurrent writes lock the rows in the same order.
+BUMP_VERSIONS_QUERY = """
+INSERT INTO dataversion (name, version, changedat)
+SELECT name, 1, EXTRACT(EPOCH FROM clock_timestamp())
+FROM unnest(CAST(:names AS text[])) AS name
+ON CONFLICT (name) DO UPDATE SET
+	version = dataversion.version + 1,
+	changedat = EXCLUDED.changedat
+RETURNING name, version, changedat;
+"""
+
+LOAD_VERSIONS_QUERY = "SELECT name, version, changedat FROM dataversion;"
+
+
+def version_names(table, scope=None):
+	"""
+	The versions a change to table bumps. With a scope (a restaurant ID), only pages
+	that depend on (table, scope) or on the whole table change; without one, every
+	page that depends on the table does.
+	"""
+	return [table, '%s:%s' % (table, '*' if scope is None else scope)]
+
+
+class DataVersions:
+	def __init__(self, loader, refresh_interval=300):
+		self.loader = loader  # returns every (name, version, changedat) row
+		self.refresh_interval = refresh_interval
+		self.ready = False
+		self.last_bump = 0.0  # when this process last learned of a change
+		self._versions = {}  # name -> (version, time of the change)
+		self._lock = threading.Lock()
+
+	def record(self, conn, changed):
+		"""
+		Bumps the versions of changed, a list of (table, scope) pairs, in conn's open
+		transaction. Returns {name: (version, changedat)}, for update() once it commits.
+		"""
+		names = sorted({name for table, scope in changed for name in version_names(table, scope)})
+		if not names:
+			return {}
+		rows = conn.execute(text(BUMP_VERSIONS_QUERY), {'names': names})
+		return {name: (version, changed_at) for name, version, changed_at in rows}
+
+	def update(self, versions):
+		"""Takes in {name: (version, changedat)} from record(), here or in another process"""
+		self._merge(versions.items())
+
+	def load(self):
+		"""(Re)loads every version, for a process that just started or may have missed changes"""
+		rows = self.loader()
+		self._merge((name, (version, changed_at)) for name, version, changed_at in rows)
+		self.ready = True
+
+	def ensure_loaded(self):
+		"""Returns True once versions are loaded, loading them if needed"""
+		if not self.ready:
+			try:
+				self.load()
+			except Exception as e:
+				print(f"Could not load data versions: {e}")
+		return self.ready
+
+	def _merge(self, items):
+		# Versions only go up, so an older value arriving late never wins
+		with self._lock:
+			for name, (version, changed_at) in items:
+				if version > self._versions.get(name, (0, 0.0))[0]:
+					self._versions[name] = (version, changed_at)
+			self.last_bump = time.time()
+
+	def state(self, dependencies):
+		"""
+		Returns (versions, last_modified) for a list of dependencies, each a table
+		name or a (table, scope) pair. A scoped dependency also changes when the
+		table is bumped without a scope.
+		"""
+		names = []
+		for dependency in dependencies:
+			if isinstance(dependency, tuple):
+				table, scope = dependency
+				names += ['%s:*' % table, '%s:%s' % (table, scope)]
+			else:
+				names.append(dependency)
+		with self._lock:
+			entries = [self._versions.get(name, (0, 0.0)) for name in names]
+		return tuple(version for version, changed_at in entries), max([0.0] + [changed_at for version, changed_at in entries])
+
+	def etag(self, dependencies, variant=()):
+		"""
+		Returns (etag, last_modified) for a page built from dependencies. variant
+		holds anything else the page depends on (its URL, who is logged in).
+		last_modified rolls over with the tag, so If-Modified-Since does too.
+		"""
+		versions, last_modified = self.state(dependencies)
+		epoch = int(time.time() // self.refresh_interval)
+		raw = repr((epoch, versions, variant)).encode('utf-8')
+		last_modified = max(last_modified, epoch * self.refresh_interval)
+		return hashlib.sha1(raw).hexdigest()[:20], last_modified